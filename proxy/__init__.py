@@ -3,11 +3,14 @@
 from .decorators import override
 from .proxyserver import ProxyServer
 from .proxydispatcher import ProxyDispatcher
-from .rulematcher import Rule, RuleMatcher
+from .proxysupervisor import ProxySupervisor
+from .rulematcher import Rule, RuleIndex, MappedRuleIndex, RuleMatcher
 from .connections import (
     BaseConnection,
     NULLConnection,
+    SocketConnection,
     TCPConnection,
+    ProtocolConnection,
     WSConnection,
 )
 from .connectors import (
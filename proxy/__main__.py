@@ -10,12 +10,44 @@ from .defaults import (
     PEER_PORT,
     RULES_DEFAULT,
     RULES_FILE,
+    RULES_INDEX,
+    RULES_CACHE_SIZE,
+    RULES_RELOAD_INTERVAL,
+    TCP_READ_SIZE_MIN,
+    TCP_READ_SIZE_MAX,
+    TCP_WRITE_HIGH,
+    TCP_WRITE_LOW,
+    CONNECTION_TYPE,
+    LOOP_TYPE,
+    DISPATCH_STRATEGY,
+    RESOLVER_THREADS,
+    RESOLVER_CACHE_SIZE,
+    RESOLVER_TTL,
+    RESOLVER_NEGATIVE_TTL,
+    HEDGE_DELAY,
+    POOL_SIZE,
+    POOL_TTL,
+    OPTIMISTIC,
+    HTTP_KEEPALIVE,
+    HTTP_POOL_SIZE,
+    HTTP_IDLE_TIMEOUT,
+    TCP_FAST_OPEN,
+    HAPPY_EYEBALLS_DELAY,
+    HEALTH_PROBE_URL,
+    HEALTH_PROBE_ADDR,
+    HEALTH_PROBE_PORT,
+    HEALTH_INTERVAL,
+    HEALTH_TIMEOUT,
+    WORKERS,
     LOG_FORMAT,
     LOG_DATEFMT,
 )
 from .proxyserver import ProxyServer
+from .proxysupervisor import ProxySupervisor
 from .proxydispatcher import ProxyDispatcher
 from .rulematcher import RuleMatcher
+from .resolver import Resolver
+from .connections import TCPConnection
 from .connectors import (
     BaseConnector,
     WrappedConnector,
@@ -32,6 +64,70 @@ def main():
     parser.add_argument('-p', '--peer-urls', action='append', default=[])
     parser.add_argument('-D', '--rules-default', default=RULES_DEFAULT)
     parser.add_argument('-r', '--rules-file', default=RULES_FILE)
+    parser.add_argument('-R', '--rules-index', default=RULES_INDEX)
+    parser.add_argument('--compile-rules', action='store_true')
+    parser.add_argument('--rules-cache-size',
+                        type=int,
+                        default=RULES_CACHE_SIZE)
+    parser.add_argument('--rules-reload-interval',
+                        type=float,
+                        default=RULES_RELOAD_INTERVAL)
+    parser.add_argument('--tcp-read-size-min',
+                        type=int,
+                        default=TCP_READ_SIZE_MIN)
+    parser.add_argument('--tcp-read-size-max',
+                        type=int,
+                        default=TCP_READ_SIZE_MAX)
+    parser.add_argument('--tcp-write-high', type=int, default=TCP_WRITE_HIGH)
+    parser.add_argument('--tcp-write-low', type=int, default=TCP_WRITE_LOW)
+    parser.add_argument('--connection-type',
+                        choices=('stream', 'protocol'),
+                        default=CONNECTION_TYPE)
+    parser.add_argument('--loop',
+                        choices=('asyncio', 'uvloop'),
+                        default=LOOP_TYPE)
+    parser.add_argument('--dispatch-strategy',
+                        choices=('weight', 'p2c', 'least-outstanding'),
+                        default=DISPATCH_STRATEGY)
+    parser.add_argument('--resolver-threads',
+                        type=int,
+                        default=RESOLVER_THREADS)
+    parser.add_argument('--resolver-cache-size',
+                        type=int,
+                        default=RESOLVER_CACHE_SIZE)
+    parser.add_argument('--resolver-ttl', type=float, default=RESOLVER_TTL)
+    parser.add_argument('--resolver-negative-ttl',
+                        type=float,
+                        default=RESOLVER_NEGATIVE_TTL)
+    parser.add_argument('--hedge-delay', type=float, default=HEDGE_DELAY)
+    parser.add_argument('--happy-eyeballs-delay',
+                        type=float,
+                        default=HAPPY_EYEBALLS_DELAY)
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE)
+    parser.add_argument('--pool-ttl', type=float, default=POOL_TTL)
+    parser.add_argument('--optimistic',
+                        action='store_true',
+                        default=OPTIMISTIC)
+    parser.add_argument('--tcp-fast-open',
+                        action='store_true',
+                        default=TCP_FAST_OPEN)
+    parser.add_argument('--http-keepalive',
+                        action='store_true',
+                        default=HTTP_KEEPALIVE)
+    parser.add_argument('--http-pool-size',
+                        type=int,
+                        default=HTTP_POOL_SIZE)
+    parser.add_argument('--http-idle-timeout',
+                        type=float,
+                        default=HTTP_IDLE_TIMEOUT)
+    parser.add_argument('--health-probe-url', default=HEALTH_PROBE_URL)
+    parser.add_argument('--health-interval',
+                        type=float,
+                        default=HEALTH_INTERVAL)
+    parser.add_argument('--health-timeout',
+                        type=float,
+                        default=HEALTH_TIMEOUT)
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS)
     args = parser.parse_args()
 
     debug = args.debug
@@ -41,31 +137,98 @@ def main():
     peer_urls = args.peer_urls
     rules_default = args.rules_default
     rules_file = args.rules_file
+    rules_index = args.rules_index
+    compile_rules = args.compile_rules
+    tcp_read_size_min = args.tcp_read_size_min
+    tcp_read_size_max = args.tcp_read_size_max
+    tcp_write_high = args.tcp_write_high
+    tcp_write_low = args.tcp_write_low
+    connection_type = args.connection_type
+    loop_type = args.loop
+    dispatch_strategy = args.dispatch_strategy
+    resolver_threads = args.resolver_threads
+    resolver_cache_size = args.resolver_cache_size
+    resolver_ttl = args.resolver_ttl
+    resolver_negative_ttl = args.resolver_negative_ttl
+    hedge_delay = args.hedge_delay
+    happy_eyeballs_delay = args.happy_eyeballs_delay
+    pool_size = args.pool_size
+    pool_ttl = args.pool_ttl
+    optimistic = args.optimistic
+    tcp_fast_open = args.tcp_fast_open
+    http_keepalive = args.http_keepalive
+    http_pool_size = args.http_pool_size
+    http_idle_timeout = args.http_idle_timeout
+    health_probe_url = urlparse(args.health_probe_url)
+    health_probe_addr = health_probe_url.hostname or HEALTH_PROBE_ADDR
+    health_probe_port = health_probe_url.port or HEALTH_PROBE_PORT
+    health_interval = args.health_interval
+    health_timeout = args.health_timeout
+    workers = args.workers
+    rules_cache_size = args.rules_cache_size
+    rules_reload_interval = args.rules_reload_interval
 
     logging.basicConfig(level='DEBUG' if debug else 'INFO',
                         format=LOG_FORMAT,
                         datefmt=LOG_DATEFMT)
-    rule_matcher = \
-        RuleMatcher(rules_default=rules_default, rules_file=rules_file)
-    rule_matcher.load_rules()
+    rule_matcher = RuleMatcher(rules_default=rules_default,
+                               rules_file=rules_file,
+                               rules_index=rules_index,
+                               rules_cache_size=rules_cache_size,
+                               rules_reload_interval=rules_reload_interval)
+    if compile_rules:
+        rule_matcher.compile_rules()
+        return
+    if workers <= 0:
+        rule_matcher.load_rules()
+    TCPConnection.set_buffer_sizes(read_size_min=tcp_read_size_min,
+                                   read_size_max=tcp_read_size_max,
+                                   write_high=tcp_write_high,
+                                   write_low=tcp_write_low)
+    TCPConnector.set_connection_type(connection_type)
+    TCPConnector.set_fast_open(tcp_fast_open)
+    resolver = Resolver(threads=resolver_threads,
+                        cache_size=resolver_cache_size,
+                        ttl=resolver_ttl,
+                        negative_ttl=resolver_negative_ttl)
     connectors: list[BaseConnector] = []
     for url in peer_urls:
         peer_url = urlparse(url)
         peer_addr = peer_url.hostname or PEER_ADDR
         peer_port = peer_url.port or PEER_PORT
-        wrapped_connector = WrappedConnector(base_connector=TCPConnector(),
-                                             addr=peer_addr,
-                                             port=peer_port)
-        http_connector = HTTPConnector(base_connector=wrapped_connector)
+        wrapped_connector = WrappedConnector(
+            base_connector=TCPConnector(resolver=resolver),
+            addr=peer_addr,
+            port=peer_port,
+            pool_size=pool_size,
+            pool_ttl=pool_ttl)
+        http_connector = HTTPConnector(base_connector=wrapped_connector,
+                                       optimistic=optimistic)
         connectors.append(http_connector)
     proxy_dispatcher = \
-        ProxyDispatcher(rule_matcher=rule_matcher, connectors=connectors)
+        ProxyDispatcher(rule_matcher=rule_matcher, connectors=connectors,
+                        dispatch_strategy=dispatch_strategy,
+                        hedge_delay=hedge_delay,
+                        happy_eyeballs_delay=happy_eyeballs_delay,
+                        resolver=resolver,
+                        health_probe_addr=health_probe_addr,
+                        health_probe_port=health_probe_port,
+                        health_interval=health_interval,
+                        health_timeout=health_timeout)
     http_acceptor = HTTPAcceptor()
     proxy_server = \
         ProxyServer(acceptor=http_acceptor, dispatcher=proxy_dispatcher,
-                    server_addr=server_addr, server_port=server_port)
+                    server_addr=server_addr, server_port=server_port,
+                    connection_type=connection_type,
+                    loop_factory=ProxyServer.get_loop_factory(loop_type),
+                    http_keepalive=http_keepalive,
+                    http_pool_size=http_pool_size,
+                    http_idle_timeout=http_idle_timeout)
     try:
-        proxy_server.run()
+        if workers > 0:
+            ProxySupervisor(proxy_server=proxy_server, workers=workers).run()
+        else:
+            proxy_server.run()
     except KeyboardInterrupt:
         pass
 
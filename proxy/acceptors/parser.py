@@ -0,0 +1,262 @@
+import re
+import socket
+
+from typing import Union, Optional
+
+from ..defaults import ACCEPT_HEADERS_MAX
+from ..decorators import override
+
+
+class HTTPHeaderParser:
+    """Incremental parser of an HTTP message header over bytes.
+
+    Reads are fed until the header is complete, then the start line is
+    parsed by the subclass. Header fields are searched for on demand.
+    """
+    limit: int
+    buf: Union[bytes, bytearray]
+    scanned: int
+    done: bool
+    version: bytes
+    start: int
+    end: int
+
+    content_length_re = re.compile(
+        rb'\r\ncontent-length:[ \t]*([0-9]+)[ \t]*\r\n', re.IGNORECASE)
+    chunked_re = re.compile(
+        rb'\r\ntransfer-encoding:[^\r\n]*chunked[ \t]*\r\n', re.IGNORECASE)
+    connection_re = re.compile(rb'\r\nconnection:[ \t]*([^\r\n]*)\r\n',
+                               re.IGNORECASE)
+
+    def __init__(self, limit: int = ACCEPT_HEADERS_MAX):
+        self.limit = limit
+        self.buf = b''
+        self.scanned = 0
+        self.done = False
+
+    def feed(self, data: bytes) -> bool:
+        """Return whether the header is complete."""
+        if len(self.buf) == 0:
+            self.buf = data
+        else:
+            # copied once the header spans reads, appended in place after
+            if isinstance(self.buf, bytes):
+                self.buf = bytearray(self.buf)
+            self.buf += data
+        buf = self.buf
+        # resume the search, the terminator may straddle two reads
+        end = buf.find(b'\r\n\r\n', max(self.scanned - 3, 0))
+        if end < 0:
+            self.scanned = len(buf)
+            if len(buf) > self.limit:
+                raise RuntimeError('http header too large')
+            return False
+        self.end = end + 4
+        self.parse(end)
+        self.done = True
+        return True
+
+    def parse(self, end: int):
+        raise NotImplementedError
+
+    @property
+    def rest(self) -> bytes:
+        """Data read past the header."""
+        return bytes(self.buf[self.end:])
+
+    def header(self) -> bytes:
+        return bytes(self.buf[:self.end])
+
+    def content_length(self) -> Optional[int]:
+        match = self.content_length_re.search(self.buf, self.start,
+                                              self.end - 2)
+        return int(match[1]) if match is not None else None
+
+    def chunked(self) -> bool:
+        return self.chunked_re.search(self.buf, self.start,
+                                      self.end - 2) is not None
+
+    def keep_alive(self) -> bool:
+        """Whether the connection persists after this message."""
+        match = self.connection_re.search(self.buf, self.start,
+                                          self.end - 2)
+        if match is not None:
+            tokens = match[1].lower()
+            if b'close' in tokens:
+                return False
+            if b'keep-alive' in tokens:
+                return True
+        return self.version == b'HTTP/1.1'
+
+
+class HTTPRequestParser(HTTPHeaderParser):
+    """Parser of a proxy request header, only the address is decoded and
+    Proxy-* header lines are cut out by position."""
+    method: bytes
+    target: bytes
+    addr: str
+    port: int
+
+    req_re = re.compile(rb'([A-Z]+) ([^ \r\n]+) (HTTP/[^ \r\n]+)\r\n')
+    host_re = re.compile(rb'\r\nhost:[ \t]*([^\r\n]*?)[ \t]*\r\n',
+                         re.IGNORECASE)
+    proxy_re = re.compile(rb'\r\nproxy-[^\r\n]*', re.IGNORECASE)
+    authority_re = re.compile(
+        rb'(?:([^:\[\]\s]+)|\[([0-9a-fA-F:.]+)\])(?::([0-9]{1,5}))?')
+    connect_re = re.compile(
+        rb'CONNECT (?:([^:\[\]\s]+)|\[([0-9a-fA-F:.]+)\])(?::([0-9]{1,5}))?'
+        rb' (HTTP/[^ \r\n]+)\r\n')
+
+    @classmethod
+    def parse_connect(
+            cls, buf: bytes) -> Optional[tuple[str, int, bytes, bytes]]:
+        """Parse a CONNECT request complete in buf in a single pass, return
+        addr, port, version and the data past the header, or None to
+        leave it to the incremental parser."""
+        match = cls.connect_re.match(buf)
+        if match is None:
+            return None
+        end = buf.find(b'\r\n\r\n', match.end() - 2)
+        if end < 0:
+            return None
+        addr, addr6, port, version = match.groups()
+        port = int(port) if port is not None else 80
+        if not 0 < port < 65536:
+            return None
+        return (addr or addr6).decode(), port, version, buf[end + 4:]
+
+    @override(HTTPHeaderParser)
+    def parse(self, end: int):
+        buf = self.buf
+        req = self.req_re.match(buf, 0, end + 2)
+        if req is None:
+            raise RuntimeError('invalid http request')
+        self.method, self.target, self.version = req.groups()
+        self.start = req.end() - 2
+        # the target of CONNECT is the authority, others name a Host
+        if self.method == b'CONNECT':
+            authority = self.target
+        else:
+            # the \r\n before the blank line ends the last header
+            host = self.host_re.search(buf, self.start, end + 2)
+            if host is None:
+                raise RuntimeError('invalid http request')
+            authority = host[1]
+        match = self.authority_re.fullmatch(authority)
+        if match is None:
+            raise RuntimeError('invalid http host')
+        addr, addr6, port = match.groups()
+        self.addr = (addr or addr6).decode()
+        self.port = int(port) if port is not None else 80
+        if not 0 < self.port < 65536:
+            raise RuntimeError('invalid http host')
+
+    @override(HTTPHeaderParser)
+    def header(self) -> bytes:
+        """Return the header, Proxy-* header lines removed."""
+        return self.strip_proxy(self.end)
+
+    def request(self) -> bytes:
+        """Return all data read, Proxy-* header lines removed."""
+        return self.strip_proxy(len(self.buf))
+
+    def strip_proxy(self, stop: int) -> bytes:
+        view = memoryview(self.buf)
+        parts = []
+        pos = 0
+        for strip in self.proxy_re.finditer(self.buf, self.start,
+                                            self.end - 4):
+            parts.append(view[pos:strip.start()])
+            pos = strip.end()
+        if pos == 0:
+            return bytes(view[:stop])
+        parts.append(view[pos:stop])
+        return b''.join(parts)
+
+
+class HTTPResponseParser(HTTPHeaderParser):
+    """Parser of a response header for the framing of its body."""
+    status: int
+
+    status_re = re.compile(rb'(HTTP/[0-9.]+) ([0-9]{3})[^\r\n]*\r\n')
+
+    @override(HTTPHeaderParser)
+    def parse(self, end: int):
+        res = self.status_re.match(self.buf, 0, end + 2)
+        if res is None:
+            raise RuntimeError('invalid http response')
+        self.version = res[1]
+        self.status = int(res[2])
+        self.start = res.end() - 2
+
+
+class Socks5Parser:
+    """Incremental parser of a SOCKS5 greeting and CONNECT request, which
+    may be split over reads or pipelined into one."""
+    buf: bytearray
+    state: int
+    addr: str
+    port: int
+
+    STATE_GREETING = 0
+    STATE_REQUEST = 1
+    STATE_DONE = 2
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.state = self.STATE_GREETING
+
+    @property
+    def done(self) -> bool:
+        return self.state == self.STATE_DONE
+
+    @property
+    def rest(self) -> bytes:
+        """Data read past the request."""
+        return bytes(self.buf)
+
+    def feed(self, data: bytes) -> bytes:
+        """Return what to answer to the client, b'' when more is needed."""
+        buf = self.buf
+        buf += data
+        res = b''
+        if self.state == self.STATE_GREETING:
+            if len(buf) < 2:
+                return res
+            if buf[0] != 5:
+                raise RuntimeError('invalid socks5 request')
+            size = 2 + buf[1]
+            if len(buf) < size:
+                return res
+            if 0 not in buf[2:size]:
+                raise RuntimeError('invalid socks5 request')
+            del buf[:size]
+            self.state = self.STATE_REQUEST
+            res += b'\x05\x00'
+        if self.state == self.STATE_REQUEST:
+            if len(buf) < 5:
+                return res
+            if buf[0] != 5 or buf[1] != 1 or buf[2] != 0:
+                raise RuntimeError('invalid socks5 header')
+            atyp = buf[3]
+            if atyp == 1:  # ipv4
+                size = 10
+            elif atyp == 3:  # domain
+                size = 7 + buf[4]
+            elif atyp == 4:  # ipv6
+                size = 22
+            else:
+                raise RuntimeError('invalid socks5 header')
+            if len(buf) < size:
+                return res
+            if atyp == 1:
+                self.addr = socket.inet_ntop(socket.AF_INET, buf[4:8])
+            elif atyp == 3:
+                self.addr = buf[5:size - 2].decode()
+            else:
+                self.addr = socket.inet_ntop(socket.AF_INET6, buf[4:20])
+            self.port = int.from_bytes(buf[size - 2:size], 'big')
+            del buf[:size]
+            self.state = self.STATE_DONE
+            res += b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+        return res
@@ -1,6 +1,9 @@
 # flake8: noqa
 
-from .base import BaseConnection
+from .base import BaseConnection, RelayError
 from .null import NULLConnection
+from .sock import SocketConnection
 from .tcp import TCPConnection
+from .protocol import ConnectionProtocol, ProtocolConnection
 from .ws import WSConnection
+from .optimistic import OptimisticConnection
@@ -18,3 +18,16 @@ class BaseConnection:
 
     async def write_eof(self):
         raise NotImplementedError
+
+    def at_eof(self) -> bool:
+        """Whether the peer is known to have closed, without reading."""
+        return False
+
+
+class RelayError(Exception):
+    """Failure of conn while relaying, tells which side failed."""
+    conn: BaseConnection
+
+    def __init__(self, conn: BaseConnection, error: Exception):
+        super().__init__(str(error))
+        self.conn = conn
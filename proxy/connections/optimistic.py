@@ -0,0 +1,66 @@
+from ..defaults import OPTIMISTIC_HEADERS_MAX
+from ..decorators import override
+from .base import BaseConnection
+
+
+class OptimisticConnection(BaseConnection):
+    """Connection used before its handshake response arrived.
+
+    Writes go out at once, pipelined behind the handshake request. The
+    first read takes the response headers off the stream and raises
+    unless they start with expect.
+    """
+    base_connection: BaseConnection
+    expect: bytes
+    validated: bool
+
+    def __init__(self, base_connection: BaseConnection, expect: bytes,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.base_connection = base_connection
+        self.expect = expect
+        self.validated = False
+
+    @override(BaseConnection)
+    async def close(self):
+        await self.base_connection.close()
+
+    @override(BaseConnection)
+    async def read(self) -> bytes:
+        if not self.validated:
+            await self.validate()
+        if len(self.unread) != 0:
+            return self.read_nonblock()
+        return await self.base_connection.read()
+
+    async def validate(self):
+        """Read the handshake response, data past it is left unread."""
+        buf = self.unread
+        while (pos := buf.find(b'\r\n\r\n')) < 0:
+            if len(buf) > OPTIMISTIC_HEADERS_MAX:
+                raise RuntimeError('invalid handshake response')
+            data = await self.base_connection.read()
+            if len(data) == 0:
+                raise RuntimeError('connection closed in handshake')
+            buf += data
+        if not buf.startswith(self.expect):
+            raise RuntimeError('invalid handshake response')
+        self.validated = True
+        self.unread = buf[pos + 4:]
+
+    @override(BaseConnection)
+    def read_nonblock(self) -> bytes:
+        buf, self.unread = self.unread, b''
+        return buf
+
+    @override(BaseConnection)
+    async def write(self, buf: bytes):
+        await self.base_connection.write(buf)
+
+    @override(BaseConnection)
+    async def write_eof(self):
+        await self.base_connection.write_eof()
+
+    @override(BaseConnection)
+    def at_eof(self) -> bool:
+        return self.base_connection.at_eof()
@@ -0,0 +1,183 @@
+import asyncio
+
+from typing import Optional, cast
+from collections.abc import Callable, Awaitable
+
+from ..defaults import PROTOCOL_BUFFER_SIZE
+from ..decorators import override
+from .base import BaseConnection
+from .sock import SocketConnection
+
+
+class ConnectionProtocol(asyncio.BufferedProtocol):
+    """BufferedProtocol receiving into one preallocated buffer.
+
+    The transport writes straight into the free tail of the buffer, which
+    a read empties as a whole, reading is paused while it is full.
+    """
+    transport: Optional[asyncio.Transport]
+    buf: bytearray
+    view: memoryview
+    end: int
+    eof: bool
+    exc: Optional[Exception]
+    read_waiter: Optional[asyncio.Future]
+    drain_waiter: Optional[asyncio.Future]
+    paused_reading: bool
+    paused_writing: bool
+    closed: asyncio.Future
+    connected_cb: Optional[Callable[['ProtocolConnection'], Awaitable]]
+
+    tasks: set[asyncio.Task] = set()
+
+    def __init__(self,
+                 connected_cb: Optional[Callable[['ProtocolConnection'],
+                                                 Awaitable]] = None,
+                 buffer_size: int = PROTOCOL_BUFFER_SIZE):
+        self.transport = None
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        self.end = 0
+        self.eof = False
+        self.exc = None
+        self.read_waiter = None
+        self.drain_waiter = None
+        self.paused_reading = False
+        self.paused_writing = False
+        self.closed = asyncio.get_running_loop().create_future()
+        self.connected_cb = connected_cb
+
+    @staticmethod
+    def wakeup(waiter: Optional[asyncio.Future]):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        # uvloop transports are not asyncio.Transport subclasses
+        self.transport = cast(asyncio.Transport, transport)
+        if self.connected_cb is not None:
+            task = asyncio.create_task(
+                self.connected_cb(ProtocolConnection(self)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.eof = True
+        self.exc = exc
+        self.wakeup(self.read_waiter)
+        self.wakeup(self.drain_waiter)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes: int):
+        self.end += nbytes
+        if self.end == len(self.buf) and not self.paused_reading:
+            assert self.transport is not None
+            self.transport.pause_reading()
+            self.paused_reading = True
+        self.wakeup(self.read_waiter)
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        self.wakeup(self.read_waiter)
+        # keep the transport open for writing, as a half close
+        return True
+
+    def pause_writing(self):
+        self.paused_writing = True
+
+    def resume_writing(self):
+        self.paused_writing = False
+        self.wakeup(self.drain_waiter)
+
+    async def wait_readable(self):
+        while self.end == 0 and not self.eof:
+            self.read_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.read_waiter
+            finally:
+                self.read_waiter = None
+
+    def take(self, resume: bool = True) -> bytes:
+        buf = bytes(self.view[:self.end])
+        self.end = 0
+        if resume and self.paused_reading and not self.eof:
+            assert self.transport is not None
+            self.transport.resume_reading()
+            self.paused_reading = False
+        return buf
+
+    async def drain(self):
+        if self.exc is not None:
+            raise self.exc
+        assert self.transport is not None
+        if self.transport.is_closing():
+            raise ConnectionResetError('connection lost')
+        while self.paused_writing:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.drain_waiter
+            finally:
+                self.drain_waiter = None
+            if self.transport.is_closing():
+                raise ConnectionResetError('connection lost')
+
+
+class ProtocolConnection(SocketConnection):
+    """TCP connection on a ConnectionProtocol, bypassing asyncio streams."""
+    protocol: ConnectionProtocol
+
+    def __init__(self, protocol: ConnectionProtocol, **kwargs):
+        assert protocol.transport is not None
+        super().__init__(transport=protocol.transport, **kwargs)
+        self.protocol = protocol
+
+    @override(BaseConnection)
+    async def close(self):
+        self.shutdown()
+        self.transport.close()
+        await self.protocol.closed
+
+    @override(BaseConnection)
+    async def read(self) -> bytes:
+        if len(self.unread) != 0:
+            return self.read_nonblock()
+        await self.protocol.wait_readable()
+        if self.protocol.end == 0 and self.protocol.exc is not None:
+            raise self.protocol.exc
+        return self.protocol.take()
+
+    @override(BaseConnection)
+    def read_nonblock(self) -> bytes:
+        buf, self.unread = self.unread, b''
+        return buf
+
+    @override(BaseConnection)
+    async def write(self, buf: bytes):
+        self.transport.write(buf)
+        if self.protocol.paused_writing or self.transport.is_closing():
+            await self.protocol.drain()
+
+    @override(BaseConnection)
+    async def write_eof(self):
+        if self.transport.can_write_eof() and not self.transport.is_closing():
+            self.transport.write_eof()
+
+    @override(BaseConnection)
+    def at_eof(self) -> bool:
+        return self.protocol.eof or self.transport.is_closing()
+
+    @override(SocketConnection)
+    async def read_buffered(self) -> bytes:
+        await self.protocol.wait_readable()
+        self.transport.pause_reading()
+        self.protocol.paused_reading = True
+        return self.protocol.take(resume=False)
+
+    @override(SocketConnection)
+    async def write_flush(self, buf: bytes):
+        self.transport.write(buf)
+        await self.protocol.drain()
@@ -0,0 +1,133 @@
+import os
+import asyncio
+import socket
+
+from typing import Optional
+from collections.abc import Callable
+
+from ..defaults import (
+    TCP_WRITE_HIGH,
+    TCP_WRITE_LOW,
+    SPLICE_SIZE,
+    SPLICE_PIPE_SIZE,
+)
+from .base import BaseConnection
+
+
+async def wait_fd(add: Callable, remove: Callable, fd: int):
+    """Wait until fd is ready, add/remove are loop.add_reader/remove_reader
+    or loop.add_writer/remove_writer."""
+    fut = asyncio.get_running_loop().create_future()
+    add(fd, lambda: fut.done() or fut.set_result(None))
+    try:
+        await fut
+    finally:
+        remove(fd)
+
+
+class SocketConnection(BaseConnection):
+    """Connection over a socket transport, can be relayed in the kernel."""
+    transport: asyncio.Transport
+    splicing: bool
+
+    write_high: int = TCP_WRITE_HIGH
+    write_low: int = TCP_WRITE_LOW
+
+    def __init__(self, transport: asyncio.Transport, **kwargs):
+        super().__init__(**kwargs)
+        self.transport = transport
+        self.splicing = False
+        transport.set_write_buffer_limits(high=self.write_high,
+                                          low=self.write_low)
+
+    @classmethod
+    def set_write_limits(cls,
+                         write_high: int = TCP_WRITE_HIGH,
+                         write_low: int = TCP_WRITE_LOW):
+        if not 0 <= write_low <= write_high:
+            raise ValueError('invalid write limits')
+        cls.write_high = write_high
+        cls.write_low = write_low
+
+    def get_socket(self) -> Optional[socket.socket]:
+        if self.transport.get_extra_info('sslcontext') is not None:
+            return None
+        return self.transport.get_extra_info('socket')
+
+    def shutdown(self):
+        """Shut the socket down, which also wakes up a pending splice_to
+        that holds its own dup of the socket."""
+        if not self.splicing:
+            return
+        sock = self.transport.get_extra_info('socket')
+        if sock is None:
+            return
+        try:
+            # transport sockets of uvloop refuse shutdown, a dup does not
+            with socket.fromfd(sock.fileno(), sock.family, sock.type) as dup:
+                dup.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    async def read_buffered(self) -> bytes:
+        """Wait for data, return everything buffered in user space and
+        pause reading of the transport."""
+        raise NotImplementedError
+
+    async def write_flush(self, buf: bytes):
+        """Write buf and wait until the transport buffer is empty."""
+        raise NotImplementedError
+
+    def can_splice_to(self, other: BaseConnection) -> bool:
+        return hasattr(os, 'splice') and \
+            isinstance(other, SocketConnection) and \
+            self.get_socket() is not None and other.get_socket() is not None
+
+    async def splice_to(self, other: 'SocketConnection'):
+        """Relay everything read from self to other in the kernel.
+
+        The user space buffers are flushed first, then reading of self's
+        transport is paused and bytes move socket to pipe to socket with
+        os.splice, on dups of the sockets so the transports stay intact.
+        """
+        if len(self.unread) != 0:
+            await other.write(self.read_nonblock())
+        buf = await self.read_buffered()
+        if len(buf) == 0:
+            await other.write_eof()
+            return
+        other.transport.set_write_buffer_limits(0)
+        await other.write_flush(buf)
+
+        src_sock, dst_sock = self.get_socket(), other.get_socket()
+        assert src_sock is not None and dst_sock is not None
+        loop = asyncio.get_running_loop()
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        self.splicing = other.splicing = True
+        src = os.dup(src_sock.fileno())
+        dst = os.dup(dst_sock.fileno())
+        r, w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            try:
+                import fcntl
+                fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+            except (ImportError, AttributeError, OSError):
+                pass
+            while True:
+                try:
+                    n = os.splice(src, w, SPLICE_SIZE, flags=flags)
+                except BlockingIOError:
+                    await wait_fd(loop.add_reader, loop.remove_reader, src)
+                    continue
+                if n == 0:
+                    break
+                while n > 0:
+                    try:
+                        n -= os.splice(r, dst, n, flags=flags)
+                    except BlockingIOError:
+                        await wait_fd(loop.add_writer, loop.remove_writer,
+                                      dst)
+        finally:
+            for fd in (src, dst, r, w):
+                os.close(fd)
+        await other.write_eof()
@@ -1,20 +1,46 @@
 from asyncio import StreamReader, StreamWriter
 
+from ..defaults import (
+    TCP_READ_SIZE_MIN,
+    TCP_READ_SIZE_MAX,
+    TCP_WRITE_HIGH,
+    TCP_WRITE_LOW,
+    SPLICE_DRAIN_SIZE,
+)
 from ..decorators import override
 from .base import BaseConnection
+from .sock import SocketConnection
 
 
-class TCPConnection(BaseConnection):
+class TCPConnection(SocketConnection):
     reader: StreamReader
     writer: StreamWriter
+    read_size: int
+
+    read_size_min: int = TCP_READ_SIZE_MIN
+    read_size_max: int = TCP_READ_SIZE_MAX
 
     def __init__(self, reader: StreamReader, writer: StreamWriter, **kwargs):
-        super().__init__(**kwargs)
+        super().__init__(transport=writer.transport, **kwargs)
         self.reader = reader
         self.writer = writer
+        self.read_size = self.read_size_min
+
+    @classmethod
+    def set_buffer_sizes(cls,
+                         read_size_min: int = TCP_READ_SIZE_MIN,
+                         read_size_max: int = TCP_READ_SIZE_MAX,
+                         write_high: int = TCP_WRITE_HIGH,
+                         write_low: int = TCP_WRITE_LOW):
+        if not 0 < read_size_min <= read_size_max:
+            raise ValueError('invalid buffer sizes')
+        cls.read_size_min = read_size_min
+        cls.read_size_max = read_size_max
+        SocketConnection.set_write_limits(write_high, write_low)
 
     @override(BaseConnection)
     async def close(self):
+        self.shutdown()
         self.writer.close()
         await self.writer.wait_closed()
 
@@ -22,7 +48,13 @@ class TCPConnection(BaseConnection):
     async def read(self) -> bytes:
         if len(self.unread) != 0:
             return self.read_nonblock()
-        return await self.reader.read(4096)
+        buf = await self.reader.read(self.read_size)
+        # grow while reads come back full, shrink once the stream runs dry
+        if len(buf) == self.read_size:
+            self.read_size = min(self.read_size * 2, self.read_size_max)
+        elif len(buf) < self.read_size // 2:
+            self.read_size = max(self.read_size // 2, self.read_size_min)
+        return buf
 
     @override(BaseConnection)
     def read_nonblock(self) -> bytes:
@@ -32,9 +64,32 @@ class TCPConnection(BaseConnection):
     @override(BaseConnection)
     async def write(self, buf: bytes):
         self.writer.write(buf)
-        await self.writer.drain()
+        # drain only under backpressure, it then waits for the low mark
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() > self.write_high or \
+           transport.is_closing():
+            await self.writer.drain()
 
     @override(BaseConnection)
     async def write_eof(self):
         if self.writer.can_write_eof():
             self.writer.write_eof()
+
+    @override(BaseConnection)
+    def at_eof(self) -> bool:
+        return self.reader.at_eof() or self.transport.is_closing()
+
+    @override(SocketConnection)
+    async def read_buffered(self) -> bytes:
+        # the stream buffer never grows beyond twice its limit plus one
+        # recv, one large read takes all of it, and nothing is fed before
+        # the pause
+        buf = await self.reader.read(2 * self.read_size_max +
+                                     SPLICE_DRAIN_SIZE)
+        self.transport.pause_reading()
+        return buf
+
+    @override(SocketConnection)
+    async def write_flush(self, buf: bytes):
+        self.writer.write(buf)
+        await self.writer.drain()
@@ -1,13 +1,91 @@
 import random
 import struct
 
+from typing import Union
+
+from ..defaults import WS_FRAME_MAX
 from ..decorators import override
 from .base import BaseConnection
 
 
+def ws_mask(buf: Union[bytes, bytearray, memoryview], mask: bytes) -> bytes:
+    """XOR buf with the repeated 4 bytes mask, as one big integer."""
+    blen = len(buf)
+    if blen == 0:
+        return b''
+    key = (mask * ((blen + 3) >> 2))[:blen]
+    return (int.from_bytes(buf, 'little') ^
+            int.from_bytes(key, 'little')).to_bytes(blen, 'little')
+
+
+class WSFrameDecoder:
+    """Incremental WebSocket frame decoder.
+
+    Complete frames are decoded straight from the received buffer, only
+    a trailing partial frame is kept, so each payload is copied once.
+    Frames announcing more than limit bytes raise WSFrameTooLarge before
+    their payload is buffered.
+    """
+    buf: bytearray
+    limit: int
+
+    def __init__(self, limit: int = WS_FRAME_MAX):
+        self.buf = bytearray()
+        self.limit = limit
+
+    def feed(self, data: bytes) -> list[tuple[bool, int, bytes]]:
+        """Return (fin, opcode, payload) of every completed frame."""
+        buffered = len(self.buf) != 0
+        if buffered:
+            self.buf += data
+        frames = []
+        with memoryview(self.buf if buffered else data) as view:
+            pos, end = 0, len(view)
+            while end - pos >= 2:
+                flags, blen = view[pos], view[pos + 1]
+                m, blen = blen & 0x80, blen & 0x7f
+                hlen = 2
+                if blen == 126:
+                    hlen = 4
+                elif blen == 127:
+                    hlen = 10
+                if m != 0:
+                    hlen += 4
+                if end - pos < hlen:
+                    break
+                if blen == 126:
+                    blen, = struct.unpack_from('!H', view, pos + 2)
+                elif blen == 127:
+                    blen, = struct.unpack_from('!Q', view, pos + 2)
+                if blen > self.limit:
+                    raise WSFrameTooLarge('ws frame too large')
+                start = pos + hlen
+                if end - start < blen:
+                    break
+                with view[start:start + blen] as payload:
+                    if m != 0:
+                        buf = ws_mask(payload, bytes(view[start - 4:start]))
+                    else:
+                        buf = bytes(payload)
+                frames.append((flags & 0x80 != 0, flags & 0xf, buf))
+                pos = start + blen
+            if not buffered:
+                self.buf += view[pos:]
+        if buffered:
+            del self.buf[:pos]
+        return frames
+
+
+class WSFrameTooLarge(RuntimeError):
+    """A frame over the size limit of the decoder."""
+
+
 class WSConnection(BaseConnection):
     base_connection: BaseConnection
     mask_payload: bool
+    decoder: WSFrameDecoder
+    fragmented: bool
+    eof: bool
 
     def __init__(self,
                  base_connection: BaseConnection,
@@ -16,12 +94,15 @@ class WSConnection(BaseConnection):
         super().__init__(**kwargs)
         self.base_connection = base_connection
         self.mask_payload = mask_paload
+        self.decoder = WSFrameDecoder()
+        self.fragmented = False
+        self.eof = False
 
     async def _write(self, flags: int, buf: bytes):
         if self.mask_payload:
             m = 0x80
             mask = random.randbytes(4)
-            buf = bytes(c ^ mask[i % 4] for i, c in enumerate(buf))
+            buf = ws_mask(buf, mask)
         else:
             m = 0
             mask = b''
@@ -37,40 +118,53 @@ class WSConnection(BaseConnection):
 
     @override(BaseConnection)
     async def close(self):
-        await self._write(0x88, b'')
+        try:
+            await self._write(0x88, b'')
+        finally:
+            await self.base_connection.close()
 
     @override(BaseConnection)
     async def read(self) -> bytes:
         if len(self.unread) != 0:
             return self.read_nonblock()
-        buf = await self.base_connection.read()
-        flags, blen = struct.unpack_from('!BB', buffer=buf, offset=0)
-        buf = buf[2:]
-        m, blen = blen & 0x80, blen & 0x7f
-        if blen == 126:
-            blen = struct.unpack_from('!H', buffer=buf, offset=0)
-            buf = buf[2:]
-        elif blen == 127:
-            blen = struct.unpack_from('!Q', buffer=buf, offset=0)
-            buf = buf[8:]
-        if m != 0:
-            mask, buf = buf[:4], buf[4:]
-        while len(buf) < blen:
-            buf += await self.base_connection.read()
-        if len(buf) > blen:
-            buf, self.base_connection.unread = buf[:blen], buf[blen:]
-        if m != 0:
-            buf = bytes(c ^ mask[i % 4] for i, c in enumerate(buf))
-        op = flags & 0xf
-        if op == 8:  # close
-            return b''
-        if op in (1, 2):  # text or binary
-            return buf
-        if op == 9:  # ping
-            await self._write(0x8a, buf)
-        if op in (0, 9, 0xa):  # continue, ping, pong
-            return await self.read()
-        raise RuntimeError('invalid server data')
+        while not self.eof:
+            buf = await self.base_connection.read()
+            if len(buf) == 0:
+                self.eof = True
+                break
+            try:
+                frames = self.decoder.feed(buf)
+            except WSFrameTooLarge:
+                # message too big
+                try:
+                    await self._write(0x88, struct.pack('!H', 1009))
+                finally:
+                    self.eof = True
+                    await self.base_connection.close()
+                raise
+            bufs = []
+            for fin, op, payload in frames:
+                if op in (1, 2):  # text or binary
+                    if self.fragmented:
+                        raise RuntimeError('invalid server data')
+                    bufs.append(payload)
+                    self.fragmented = not fin
+                elif op == 0:  # continue
+                    if not self.fragmented:
+                        raise RuntimeError('invalid server data')
+                    bufs.append(payload)
+                    self.fragmented = not fin
+                elif op == 8:  # close
+                    self.eof = True
+                    break
+                elif op == 9:  # ping
+                    await self._write(0x8a, payload)
+                elif op != 0xa:  # pong
+                    raise RuntimeError('invalid server data')
+            buf = b''.join(bufs)
+            if len(buf) != 0:
+                return buf
+        return b''
 
     @override(BaseConnection)
     def read_nonblock(self) -> bytes:
@@ -84,3 +178,7 @@ class WSConnection(BaseConnection):
     @override(BaseConnection)
     async def write_eof(self):
         pass
+
+    @override(BaseConnection)
+    def at_eof(self) -> bool:
+        return self.eof or self.base_connection.at_eof()
@@ -1,3 +1,9 @@
+import time
+import asyncio
+import logging
+
+from array import array
+from collections import deque
 from typing import Optional
 
 from ..defaults import (
@@ -6,30 +12,120 @@ from ..defaults import (
     WEIGHT_MAXIMAL,
     WEIGHT_INCREASE_STEP,
     WEIGHT_DECREASE_STEP,
+    EWMA_ALPHA,
+    COST_LATENCY_PRIOR,
+    POOL_SIZE,
+    POOL_TTL,
 )
 from ..decorators import override
 from ..connections import BaseConnection
 
 
 class BaseConnector:
+    """Base of connectors.
+
+    Dispatch statistics live in stats, a memoryview of doubles, which can
+    be moved into memory shared by forked workers with bind_stats. Besides
+    the weight, it keeps EWMAs of connect latency, time to first byte and
+    error rate, the mean deviation of connect latency, and whether health
+    checks consider it up. Outstanding connections are counted per
+    process.
+    """
     name: str
-    weight: float
+    stats: memoryview
+    outstanding: int
+
+    STAT_WEIGHT = 0
+    STAT_CONNECT = 1
+    STAT_CONNECT_DEV = 2
+    STAT_TTFB = 3
+    STAT_ERRORS = 4
+    STAT_UP = 5
+    STATS_SLOTS = 6
 
     def __init__(self,
                  name: Optional[str] = None,
                  weight: float = WEIGHT_INITIAL):
         self.name = name if name is not None else type(self).__name__
+        self.stats = memoryview(array('d', bytes(8 * self.STATS_SLOTS)))
         self.weight = weight
+        self.up = True
+        self.outstanding = 0
 
     def __str__(self) -> str:
         return f'{self.name} W{self.weight}'
 
+    @property
+    def weight(self) -> float:
+        return self.stats[self.STAT_WEIGHT]
+
+    @weight.setter
+    def weight(self, weight: float):
+        self.stats[self.STAT_WEIGHT] = weight
+
+    @property
+    def up(self) -> bool:
+        return self.stats[self.STAT_UP] != 0
+
+    @up.setter
+    def up(self, up: bool):
+        self.stats[self.STAT_UP] = 1.0 if up else 0.0
+
+    def bind_stats(self, stats: memoryview):
+        """Keep stats in the given view of STATS_SLOTS doubles, the current
+        values are copied over."""
+        if stats.format != 'd' or len(stats) != self.STATS_SLOTS:
+            raise ValueError('invalid stats buffer')
+        stats[:] = self.stats
+        self.stats = stats
+
     def weight_increase(self):
         self.weight = min(self.weight + WEIGHT_INCREASE_STEP, WEIGHT_MAXIMAL)
 
     def weight_decrease(self):
         self.weight = max(self.weight - WEIGHT_DECREASE_STEP, WEIGHT_MINIMAL)
 
+    def update_ewma(self, slot: int, value: float):
+        # latencies start from their first sample, error rate from zero
+        old = self.stats[slot]
+        if old == 0 and slot != self.STAT_ERRORS:
+            self.stats[slot] = value
+        else:
+            self.stats[slot] = old + EWMA_ALPHA * (value - old)
+
+    def record_connect(self, latency: float):
+        mean = self.stats[self.STAT_CONNECT]
+        if mean != 0:
+            self.update_ewma(self.STAT_CONNECT_DEV, abs(latency - mean))
+        self.update_ewma(self.STAT_CONNECT, latency)
+
+    def connect_estimate(self, deviations: float) -> float:
+        """Connect latency mean plus deviations times its mean deviation,
+        0 without samples."""
+        return self.stats[self.STAT_CONNECT] + \
+            deviations * self.stats[self.STAT_CONNECT_DEV]
+
+    def record_connect_failure(self, latency: float):
+        """Record a failed connect as an error taking latency, so a
+        connector that only fails does not look fast."""
+        self.record_connect(latency)
+        self.record_result(False)
+
+    def record_ttfb(self, latency: float):
+        self.update_ewma(self.STAT_TTFB, latency)
+
+    def record_result(self, ok: bool):
+        self.update_ewma(self.STAT_ERRORS, 0.0 if ok else 1.0)
+
+    def cost(self) -> float:
+        """Expected latency of a new connection, inflated by the connections
+        already outstanding and by the error rate. Without samples the
+        connect latency is COST_LATENCY_PRIOR."""
+        latency = self.stats[self.STAT_CONNECT] or COST_LATENCY_PRIOR
+        latency += self.stats[self.STAT_TTFB]
+        errors = min(self.stats[self.STAT_ERRORS], 0.99)
+        return latency * (self.outstanding + 1) / (1 - errors)
+
     async def connect_to(
         self,
         addr: str,
@@ -40,23 +136,100 @@ class BaseConnector:
 
 
 class WrappedConnector(BaseConnector):
+    """Connector to a fixed peer, keeping a pool of prewarmed connections.
+
+    Pooling is off unless pool_size is set. After a connection is taken,
+    the pool is refilled to pool_size in the background. Connections idle
+    for pool_ttl are closed and not replaced, so an idle connector drains
+    its pool.
+    """
     base_connector: BaseConnector
     addr: str
     port: int
+    pool_size: int
+    pool_ttl: float
+    pool: deque[tuple[float, BaseConnection]]
+    pool_refill: asyncio.Event
+    pool_task: Optional[asyncio.Task]
+
+    logger = logging.getLogger('wrapped_connector')
 
     def __init__(self,
                  base_connector: BaseConnector,
                  addr: str = '',
                  port: int = -1,
+                 pool_size: int = POOL_SIZE,
+                 pool_ttl: float = POOL_TTL,
                  **kwargs):
         super().__init__(**kwargs)
         self.base_connector = base_connector
         self.addr = addr
         self.port = port
+        self.pool_size = pool_size
+        self.pool_ttl = pool_ttl
+        self.pool = deque()
+        self.pool_refill = asyncio.Event()
+        self.pool_task = None
 
     async def connect(self, unwrite: bytes = b'') -> BaseConnection:
-        return await self.base_connector.connect_to(self.addr, self.port,
-                                                    unwrite)
+        if self.pool_size <= 0:
+            return await self.base_connector.connect_to(
+                self.addr, self.port, unwrite)
+        conn = self.take_pooled()
+        self.pool_refill.set()
+        if self.pool_task is None or self.pool_task.done():
+            self.pool_task = asyncio.create_task(self.maintain_pool())
+        if conn is None:
+            return await self.base_connector.connect_to(
+                self.addr, self.port, unwrite)
+        if len(unwrite) != 0:
+            await conn.write(unwrite)
+        return conn
+
+    def take_pooled(self) -> Optional[BaseConnection]:
+        now = time.monotonic()
+        for _ in range(len(self.pool)):
+            expire, conn = self.pool.pop()
+            if expire > now and not conn.at_eof():
+                return conn
+            # expired first, maintain_pool closes it
+            self.pool.appendleft((0, conn))
+        return None
+
+    async def fill_pool(self):
+        missing = self.pool_size - len(self.pool)
+        results = await asyncio.gather(
+            *(self.base_connector.connect_to(self.addr, self.port)
+              for _ in range(missing)),
+            return_exceptions=True)
+        for res in results:
+            if isinstance(res, BaseConnection):
+                self.pool.append((time.monotonic() + self.pool_ttl, res))
+            else:
+                self.logger.debug('except while prewarming %s: %.40s',
+                                  self, res)
+
+    async def maintain_pool(self):
+        while True:
+            now = time.monotonic()
+            while len(self.pool) != 0 and \
+                    (self.pool[0][0] <= now or self.pool[0][1].at_eof()):
+                _, conn = self.pool.popleft()
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+            if self.pool_refill.is_set():
+                self.pool_refill.clear()
+                await self.fill_pool()
+                continue
+            if len(self.pool) == 0:
+                return
+            timeout = self.pool[0][0] - now
+            try:
+                await asyncio.wait_for(self.pool_refill.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
     @override(BaseConnector)
     async def connect_to(
@@ -1,14 +1,20 @@
+from ..defaults import OPTIMISTIC
 from ..decorators import override
-from ..connections import BaseConnection
+from ..connections import BaseConnection, OptimisticConnection
 from .base import BaseConnector, WrappedConnector
 
 
 class HTTPConnector(BaseConnector):
     base_connector: WrappedConnector
+    optimistic: bool
 
-    def __init__(self, base_connector: WrappedConnector, **kwargs):
+    def __init__(self,
+                 base_connector: WrappedConnector,
+                 optimistic: bool = OPTIMISTIC,
+                 **kwargs):
         super().__init__(**kwargs)
         self.base_connector = base_connector
+        self.optimistic = optimistic
 
     @override(BaseConnector)
     async def connect_to(
@@ -21,6 +27,10 @@ class HTTPConnector(BaseConnector):
             addr = f'[{addr}]'
         host = f'{addr}:{port}'
         req = 'CONNECT {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(host, host)
+        if self.optimistic:
+            # save a round trip, the response is checked on the first read
+            conn = await self.base_connector.connect(req.encode() + unwrite)
+            return OptimisticConnection(conn, b'HTTP/1.1 200')
         conn = await self.base_connector.connect(req.encode())
         buf = await conn.read()
         headers, conn.unread = buf.split(b'\r\n\r\n', 1)
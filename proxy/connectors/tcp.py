@@ -1,22 +1,68 @@
+import sys
+import socket
 import asyncio
+import ipaddress
 
-from typing import Any
+from typing import Any, Optional
+from contextvars import ContextVar
 
+from ..defaults import CONNECTION_TYPE, TCP_FAST_OPEN, TCP_FASTOPEN_CONNECT
 from ..decorators import override
-from ..connections import BaseConnection, TCPConnection
+from ..staggered import staggered_race
+from ..resolver import Resolver
+from ..connections import (
+    BaseConnection,
+    TCPConnection,
+    ConnectionProtocol,
+    ProtocolConnection,
+)
 from .base import BaseConnector
 
+# cleared where connects race or are timed, a TFO connect returns before
+# the handshake and would win every race in no time
+fast_open_allowed: ContextVar[bool] = ContextVar('fast_open_allowed',
+                                                 default=True)
+
 
 class TCPConnector(BaseConnector):
     tcp_kwargs: dict[str, Any]
+    happy_eyeballs_delay: float
+    resolver: Optional[Resolver]
+
+    connection_type: str = CONNECTION_TYPE
+    fast_open: bool = TCP_FAST_OPEN
 
-    def __init__(self, **kwargs):
+    def __init__(self,
+                 happy_eyeballs_delay: float = 0.0,
+                 resolver: Optional[Resolver] = None,
+                 **kwargs):
         super().__init__(**kwargs)
         self.tcp_kwargs = dict()
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.resolver = resolver
 
     def set_tcp_kwargs(self, **kwargs):
         self.tcp_kwargs = kwargs
 
+    @classmethod
+    def set_connection_type(cls, connection_type: str):
+        if connection_type not in ('stream', 'protocol'):
+            raise ValueError('invalid connection type')
+        cls.connection_type = connection_type
+
+    @classmethod
+    def set_fast_open(cls, fast_open: bool):
+        """Send the first write in the SYN, where the kernel supports
+        TCP_FASTOPEN_CONNECT, Linux only."""
+        if fast_open and not sys.platform.startswith('linux'):
+            raise ValueError('tcp fast open not supported')
+        cls.fast_open = fast_open
+
+    @staticmethod
+    def disable_fast_open():
+        """Connect without TFO from the current task on."""
+        fast_open_allowed.set(False)
+
     @override(BaseConnector)
     async def connect_to(
         self,
@@ -24,9 +70,112 @@ class TCPConnector(BaseConnector):
         port: int,
         unwrite: bytes = b'',
     ) -> BaseConnection:
-        reader, writer = await \
-            asyncio.open_connection(addr, port, **self.tcp_kwargs)
-        conn = TCPConnection(reader, writer)
+        if self.is_ip(addr) or (self.resolver is None and
+                                self.happy_eyeballs_delay <= 0 and
+                                not self.fast_open):
+            conn = await self.open_connection(addr, port)
+        else:
+            conn = await self.connect_resolved(addr, port)
         if len(unwrite) != 0:
             await conn.write(unwrite)
         return conn
+
+    async def open_connection(self, addr: str, port: int,
+                              **kwargs) -> BaseConnection:
+        kwargs = {**self.tcp_kwargs, **kwargs}
+        if self.fast_open and fast_open_allowed.get() and self.is_ip(addr):
+            kwargs['sock'] = await self.fast_open_socket(addr, port)
+            if kwargs.get('ssl'):
+                kwargs.setdefault('server_hostname', addr)
+        else:
+            kwargs.update(host=addr, port=port)
+        if self.connection_type == 'protocol':
+            loop = asyncio.get_running_loop()
+            _, protocol = await loop.create_connection(
+                ConnectionProtocol, **kwargs)
+            return ProtocolConnection(protocol)
+        kwargs.setdefault('limit', TCPConnection.read_size_max)
+        reader, writer = await asyncio.open_connection(**kwargs)
+        return TCPConnection(reader, writer)
+
+    @staticmethod
+    async def fast_open_socket(addr: str, port: int) -> socket.socket:
+        """Return a socket connected with TCP_FASTOPEN_CONNECT, connect
+        returns at once and the SYN leaves with the first write."""
+        family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            try:
+                sock.setsockopt(
+                    socket.IPPROTO_TCP,
+                    getattr(socket, 'TCP_FASTOPEN_CONNECT',
+                            TCP_FASTOPEN_CONNECT), 1)
+            except OSError:
+                pass  # a plain connect then
+            loop = asyncio.get_running_loop()
+            await loop.sock_connect(sock, (addr, port))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def connect_resolved(self, addr: str,
+                               port: int) -> BaseConnection:
+        """Connect to the resolved addresses of addr as RFC 8305 does,
+        families interleaved and attempts staggered by happy_eyeballs_delay,
+        or tried in turn without it."""
+        if self.resolver is not None:
+            ips = await self.resolver.resolve(addr)
+        else:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(addr,
+                                           port,
+                                           type=socket.SOCK_STREAM,
+                                           proto=socket.IPPROTO_TCP)
+            ips = [info[4][0] for info in infos]
+        ips = self.interleave_families(ips)
+        if len(ips) == 0:
+            raise OSError(f'no address for {addr}')
+        kwargs: dict[str, Any] = dict()
+        if self.tcp_kwargs.get('ssl') and \
+           'server_hostname' not in self.tcp_kwargs:
+            kwargs['server_hostname'] = addr
+        delay = self.happy_eyeballs_delay \
+            if self.happy_eyeballs_delay > 0 else None
+        # the attempts inherit it, a failed address must fail its connect
+        token = fast_open_allowed.set(False) if len(ips) > 1 else None
+        try:
+            _, conn = await staggered_race(
+                [
+                    lambda ip=ip: self.open_connection(ip, port, **kwargs)
+                    for ip in ips
+                ],
+                delay,
+                lambda conn: conn.close(),
+            )
+        finally:
+            if token is not None:
+                fast_open_allowed.reset(token)
+        return conn
+
+    @staticmethod
+    def is_ip(addr: str) -> bool:
+        try:
+            ipaddress.ip_address(addr)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def interleave_families(ips: list[str]) -> list[str]:
+        """Alternate IPv6 and IPv4 addresses, the first family first."""
+        ips = list(dict.fromkeys(ips))
+        v6 = [ip for ip in ips if ':' in ip]
+        v4 = [ip for ip in ips if ':' not in ip]
+        first, second = (v6, v4) if ips and ips[0] in v6 else (v4, v6)
+        res: list[str] = []
+        for i in range(max(len(first), len(second))):
+            res.extend(first[i:i + 1])
+            res.extend(second[i:i + 1])
+        return res
@@ -1,8 +1,9 @@
 import random
 import base64
 
+from ..defaults import OPTIMISTIC
 from ..decorators import override
-from ..connections import BaseConnection, WSConnection
+from ..connections import BaseConnection, WSConnection, OptimisticConnection
 from .base import BaseConnector
 
 
@@ -10,11 +11,19 @@ class WSConnector(BaseConnector):
     base_connector: BaseConnector
     path: str
     host: str
+    optimistic: bool
 
-    def __init__(self, path: str = '/', host: str = 'localhost', **kwargs):
+    def __init__(self,
+                 base_connector: BaseConnector,
+                 path: str = '/',
+                 host: str = 'localhost',
+                 optimistic: bool = OPTIMISTIC,
+                 **kwargs):
         super().__init__(**kwargs)
+        self.base_connector = base_connector
         self.path = path
         self.host = host
+        self.optimistic = optimistic
 
     @override(BaseConnector)
     async def connect_to(
@@ -33,10 +42,14 @@ class WSConnector(BaseConnector):
                    base64.b64encode(random.randbytes(16)).decode())
         base_conn = await self.base_connector.connect_to(
             addr, port, req.encode())
-        buf = await base_conn.read()
-        headers, base_conn.unread = buf.split(b'\r\n\r\n', 1)
-        if not headers.startswith(b'HTTP/1.1 101'):
-            raise RuntimeError('invalid ws response')
+        if self.optimistic:
+            # frames follow the upgrade, the response is checked on read
+            base_conn = OptimisticConnection(base_conn, b'HTTP/1.1 101')
+        else:
+            buf = await base_conn.read()
+            headers, base_conn.unread = buf.split(b'\r\n\r\n', 1)
+            if not headers.startswith(b'HTTP/1.1 101'):
+                raise RuntimeError('invalid ws response')
         conn = WSConnection(base_connection=base_conn)
         if len(unwrite) != 0:
             await conn.write(unwrite)
@@ -6,8 +6,21 @@ PEER_URL = 'http://localhost:443'
 PEER_ADDR = 'localhost'
 PEER_PORT = 443
 
+ACCEPT_HEADERS_MAX = 65536
+
+# frames announcing a larger payload are refused with status 1009
+WS_FRAME_MAX = 16777216
+
+HTTP_KEEPALIVE = False
+HTTP_POOL_SIZE = 8
+HTTP_IDLE_TIMEOUT = 30.0
+
 RULES_DEFAULT = 'direct'
 RULES_FILE = 'rules.txt'
+RULES_INDEX = 'rules.idx'
+RULES_CACHE_SIZE = 4096
+RULES_CACHE_REPORT = 10000
+RULES_RELOAD_INTERVAL = 5.0
 
 WEIGHT_INITIAL = 10.0
 WEIGHT_MINIMAL = 1.0
@@ -15,5 +28,56 @@ WEIGHT_MAXIMAL = 100.0
 WEIGHT_INCREASE_STEP = 1.0
 WEIGHT_DECREASE_STEP = 1.0
 
+EWMA_ALPHA = 0.2
+# connect latency assumed without samples, and recorded for a failure
+COST_LATENCY_PRIOR = 0.5
+CONNECT_FAILURE_LATENCY = 5.0
+DISPATCH_STRATEGY = 'weight'
+
+RESOLVER_THREADS = 8
+RESOLVER_CACHE_SIZE = 4096
+RESOLVER_TTL = 60.0
+RESOLVER_NEGATIVE_TTL = 10.0
+RESOLVER_REPORT = 1000
+
+HEDGE_DELAY = 0.0
+HEDGE_DELAY_MIN = 0.05
+HEDGE_DEVIATIONS = 2.0
+HAPPY_EYEBALLS_DELAY = 0.25
+
+POOL_SIZE = 0
+POOL_TTL = 30.0
+
+OPTIMISTIC = False
+OPTIMISTIC_HEADERS_MAX = 65536
+
+HEALTH_PROBE_URL = 'http://www.gstatic.com:80'
+HEALTH_PROBE_ADDR = 'www.gstatic.com'
+HEALTH_PROBE_PORT = 80
+HEALTH_INTERVAL = 30.0
+HEALTH_TIMEOUT = 5.0
+HEALTH_RISE = 2
+HEALTH_FALL = 3
+
+TCP_READ_SIZE_MIN = 4096
+TCP_READ_SIZE_MAX = 262144
+TCP_WRITE_HIGH = 262144
+TCP_WRITE_LOW = 65536
+TCP_FAST_OPEN = False
+# linux value, older pythons do not export it
+TCP_FASTOPEN_CONNECT = 30
+
+CONNECTION_TYPE = 'stream'
+LOOP_TYPE = 'asyncio'
+PROTOCOL_BUFFER_SIZE = 262144
+
+SPLICE_SIZE = 262144
+SPLICE_PIPE_SIZE = 262144
+SPLICE_DRAIN_SIZE = 1048576
+
+WORKERS = 0
+WORKER_RESTART_DELAY = 1.0
+WORKER_STOP_TIMEOUT = 5.0
+
 LOG_FORMAT = '%(asctime)s %(name)s %(levelname)s %(message)s'
 LOG_DATEFMT = '%y-%m-%d %H:%M:%S'
@@ -0,0 +1,322 @@
+import time
+import asyncio
+import logging
+
+from typing import Optional
+from collections import deque
+from collections.abc import Awaitable, Callable
+
+from .defaults import (
+    ACCEPT_HEADERS_MAX,
+    HTTP_POOL_SIZE,
+    HTTP_IDLE_TIMEOUT,
+)
+from .proxydispatcher import ProxyDispatcher
+from .connections import BaseConnection, RelayError
+from .connectors import BaseConnector
+from .acceptors.parser import HTTPRequestParser, HTTPResponseParser
+
+PoolKey = tuple[str, int, BaseConnector]
+Connect = Callable[[BaseConnector, str, int],
+                   Awaitable[tuple[BaseConnector, BaseConnection]]]
+Tunnel = Callable[[BaseConnection, BaseConnection], Awaitable[None]]
+
+
+class HTTPForwarder:
+    """HTTP/1.1 forward proxy for plain requests.
+
+    Requests and responses are framed by Content-Length or chunked
+    encoding, so the client connection is kept alive across requests to
+    any host and upstream connections are pooled per (host, port,
+    connector), evicted after idle_timeout. A connection switching
+    protocols with 101 becomes a raw tunnel to its upstream.
+    """
+    dispatcher: ProxyDispatcher
+    connect: Connect
+    tunnel: Tunnel
+    pool_size: int
+    idle_timeout: float
+    pool: dict[PoolKey, deque[tuple[float, BaseConnection]]]
+    reused: int
+    requests: int
+
+    logger = logging.getLogger('http_forwarder')
+
+    def __init__(self,
+                 dispatcher: ProxyDispatcher,
+                 connect: Connect,
+                 tunnel: Tunnel,
+                 pool_size: int = HTTP_POOL_SIZE,
+                 idle_timeout: float = HTTP_IDLE_TIMEOUT):
+        self.dispatcher = dispatcher
+        self.connect = connect
+        self.tunnel = tunnel
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.pool = dict()
+        self.reused = 0
+        self.requests = 0
+
+    @staticmethod
+    def is_forwardable(buf: bytes) -> bool:
+        """Whether buf starts a plain proxy request, which carries an
+        absolute target, unlike requests tunneled to an origin."""
+        req = HTTPRequestParser.req_re.match(buf)
+        return req is not None and req[1] != b'CONNECT' and \
+            req[2].startswith(b'http://')
+
+    async def forward(self, client: BaseConnection, buf: bytes):
+        """Serve requests of client until either side ends the
+        connection, buf holds the first one."""
+        try:
+            while True:
+                req = HTTPRequestParser()
+                while not req.feed(buf):
+                    buf = await client.read()
+                    if len(buf) == 0:
+                        raise RuntimeError('connection closed in request')
+                if req.method == b'CONNECT':
+                    raise RuntimeError('connect after plain request')
+                client.unread = req.rest
+                if not await self.exchange(client, req):
+                    break
+                try:
+                    buf = await asyncio.wait_for(client.read(),
+                                                 self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if len(buf) == 0:
+                    break
+        finally:
+            await self.close_quietly(client)
+
+    async def exchange(self, client: BaseConnection,
+                       req: HTTPRequestParser) -> bool:
+        """Forward one request and its response, return whether client
+        may send another."""
+        self.requests += 1
+        connector = self.dispatcher.dispatch(req.addr, req.port)
+        key = (req.addr, req.port, connector)
+        has_body = req.chunked() or bool(req.content_length())
+        upstream = await self.take(key)
+        if upstream is not None:
+            self.reused += 1
+            try:
+                return await self.relay(client, req, connector, key,
+                                        upstream)
+            except UpstreamClosed:
+                # raced with the idle upstream closing, resend if nothing
+                # of the request was consumed
+                if has_body:
+                    raise
+        connector, upstream = await self.connect(connector, req.addr,
+                                                 req.port)
+        try:
+            return await self.relay(client, req, connector, key, upstream)
+        except UpstreamClosed as e:
+            raise RuntimeError(str(e))
+
+    async def relay(self, client: BaseConnection, req: HTTPRequestParser,
+                    connector: BaseConnector, key: PoolKey,
+                    upstream: BaseConnection) -> bool:
+        start = time.perf_counter()
+        connector.outstanding += 1
+        body_task: Optional[asyncio.Task] = None
+        try:
+            try:
+                await upstream.write(req.header())
+            except ConnectionError as e:
+                raise UpstreamClosed(str(e))
+            # concurrent with the response, for 100-continue and early
+            # error responses
+            body_task = asyncio.create_task(self.copy_body(
+                client, upstream, req.chunked(), req.content_length() or 0))
+            res = await self.read_response(client, upstream)
+            connector.record_ttfb(time.perf_counter() - start)
+            upstream.unread = res.rest
+            await self.write_to(client, res.header())
+            framed = True
+            if res.status == 101:
+                # switched protocols, neither side speaks HTTP any more
+                await body_task
+                framed = False
+                await self.tunnel(client, upstream)
+            elif req.method == b'HEAD' or res.status in (204, 304):
+                pass
+            elif res.chunked():
+                await self.copy_chunked(upstream, client)
+            elif (length := res.content_length()) is not None:
+                await self.copy_length(upstream, client, length)
+            else:
+                # delimited by close, neither side can persist
+                framed = False
+                while len(buf := await self.read_from(upstream)) != 0:
+                    await self.write_to(client, buf)
+            done = body_task.done()
+            if done:
+                await body_task
+            else:
+                body_task.cancel()
+        except BaseException as e:
+            if body_task is not None and not body_task.done():
+                body_task.cancel()
+            await self.close_quietly(upstream)
+            # a reused upstream closing, or the client failing, tells
+            # nothing about the peer
+            if isinstance(e, Exception) and \
+               not isinstance(e, UpstreamClosed) and \
+               not (isinstance(e, RelayError) and e.conn is client):
+                connector.weight_decrease()
+                connector.record_result(False)
+            raise
+        finally:
+            connector.outstanding -= 1
+        connector.weight_increase()
+        connector.record_result(True)
+        persist = framed and done and req.keep_alive()
+        if persist and res.keep_alive():
+            await self.put(key, upstream)
+        else:
+            await self.close_quietly(upstream)
+        return persist
+
+    async def read_response(self, client: BaseConnection,
+                            upstream: BaseConnection) -> HTTPResponseParser:
+        """Read the final response header, interim ones are forwarded.
+        101 is final, the response to an upgrade."""
+        res = HTTPResponseParser()
+        answered = False
+        buf = b''
+        while True:
+            if len(buf) == 0:
+                try:
+                    buf = await upstream.read()
+                except ConnectionError:
+                    if answered:
+                        raise
+                    buf = b''
+                if len(buf) == 0:
+                    if not answered:
+                        raise UpstreamClosed('upstream closed')
+                    raise RuntimeError('connection closed in response')
+                answered = True
+            if not res.feed(buf):
+                buf = b''
+                continue
+            if res.status == 101 or not 100 <= res.status < 200:
+                return res
+            await self.write_to(client, res.header())
+            buf, res = res.rest, HTTPResponseParser()
+
+    async def take(self, key: PoolKey) -> Optional[BaseConnection]:
+        conns = self.pool.get(key)
+        now = time.monotonic()
+        while conns:
+            expire, conn = conns.pop()
+            if expire > now and not conn.at_eof() and len(conn.unread) == 0:
+                return conn
+            await self.close_quietly(conn)
+        return None
+
+    async def put(self, key: PoolKey, conn: BaseConnection):
+        conns = self.pool.setdefault(key, deque())
+        conns.append((time.monotonic() + self.idle_timeout, conn))
+        while len(conns) > self.pool_size:
+            _, old = conns.popleft()
+            await self.close_quietly(old)
+
+    async def evict_idle(self):
+        """Close pooled connections idle for idle_timeout."""
+        if self.idle_timeout <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            for key, conns in list(self.pool.items()):
+                while conns and (conns[0][0] <= now or conns[0][1].at_eof()):
+                    _, conn = conns.popleft()
+                    await self.close_quietly(conn)
+                if len(conns) == 0:
+                    del self.pool[key]
+            self.logger.debug('pooled %d requests %d reused %d',
+                              sum(map(len, self.pool.values())),
+                              self.requests, self.reused)
+
+    @classmethod
+    async def copy_body(cls, reader: BaseConnection, writer: BaseConnection,
+                        chunked: bool, length: int):
+        if chunked:
+            await cls.copy_chunked(reader, writer)
+        else:
+            await cls.copy_length(reader, writer, length)
+
+    @classmethod
+    async def copy_length(cls, reader: BaseConnection, writer: BaseConnection,
+                          length: int):
+        while length > 0:
+            buf = await cls.read_from(reader)
+            if len(buf) == 0:
+                raise RelayError(reader,
+                                 RuntimeError('connection closed in body'))
+            if len(buf) > length:
+                # the start of the next message, left for its parser
+                buf, reader.unread = buf[:length], buf[length:]
+            length -= len(buf)
+            await cls.write_to(writer, buf)
+
+    @classmethod
+    async def copy_chunked(cls, reader: BaseConnection,
+                           writer: BaseConnection):
+        while True:
+            line = await cls.read_line(reader)
+            await cls.write_to(writer, line)
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise RelayError(reader, RuntimeError('invalid chunk size'))
+            if size == 0:
+                break
+            await cls.copy_length(reader, writer, size + 2)
+        # trailer fields up to the blank line
+        while (line := await cls.read_line(reader)) != b'\r\n':
+            await cls.write_to(writer, line)
+        await cls.write_to(writer, line)
+
+    @classmethod
+    async def read_line(cls, reader: BaseConnection) -> bytes:
+        buf = b''
+        while (pos := buf.find(b'\r\n')) < 0:
+            if len(buf) > ACCEPT_HEADERS_MAX:
+                raise RelayError(reader, RuntimeError('line too long'))
+            data = await cls.read_from(reader)
+            if len(data) == 0:
+                raise RelayError(reader,
+                                 RuntimeError('connection closed in chunk'))
+            buf += data
+        buf, reader.unread = buf[:pos + 2], buf[pos + 2:]
+        return buf
+
+    @staticmethod
+    async def read_from(conn: BaseConnection) -> bytes:
+        try:
+            return await conn.read()
+        except Exception as e:
+            raise RelayError(conn, e) from e
+
+    @staticmethod
+    async def write_to(conn: BaseConnection, buf: bytes):
+        try:
+            await conn.write(buf)
+        except Exception as e:
+            raise RelayError(conn, e) from e
+
+    @staticmethod
+    async def close_quietly(conn: BaseConnection):
+        try:
+            await conn.close()
+        except Exception:
+            pass
+
+
+class UpstreamClosed(RuntimeError):
+    """A reused upstream closed before answering."""
@@ -0,0 +1,60 @@
+from typing import Generic, TypeVar, Optional
+from collections import OrderedDict
+from collections.abc import Callable
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+class LRUCache(Generic[K, V]):
+    """Size-bounded LRU cache that keeps hit/miss counters."""
+    maxsize: int
+    hits: int
+    misses: int
+    data: OrderedDict[K, V]
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __str__(self) -> str:
+        return 'hits {} misses {} ratio {:.2%} size {}/{}'.format(
+            self.hits, self.misses, self.hit_ratio, len(self.data),
+            self.maxsize)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total != 0 else 0.0
+
+    def get(self,
+            key: K,
+            valid: Optional[Callable[[V], bool]] = None) -> Optional[V]:
+        """Return the value of key, a value failing valid is dropped and
+        counts as a miss."""
+        value = self.data.get(key)
+        if value is not None and valid is not None and not valid(value):
+            del self.data[key]
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: K, value: V):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
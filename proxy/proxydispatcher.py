@@ -1,8 +1,28 @@
+import mmap
+import time
 import random
+import asyncio
 import logging
 
+from typing import Optional
+
+from .defaults import (
+    DISPATCH_STRATEGY,
+    HEDGE_DELAY,
+    HEDGE_DELAY_MIN,
+    HEDGE_DEVIATIONS,
+    HAPPY_EYEBALLS_DELAY,
+    HEALTH_PROBE_ADDR,
+    HEALTH_PROBE_PORT,
+    HEALTH_INTERVAL,
+    HEALTH_TIMEOUT,
+    HEALTH_RISE,
+    HEALTH_FALL,
+)
+from .resolver import Resolver
 from .rulematcher import Rule, RuleMatcher
 from .connectors import BaseConnector, NULLConnector, TCPConnector
+from .connections import BaseConnection, OptimisticConnection
 
 
 class ProxyDispatcher:
@@ -10,18 +30,68 @@ class ProxyDispatcher:
     block_connector: NULLConnector
     direct_connector: TCPConnector
     forward_connectors: list[BaseConnector]
+    dispatch_strategy: str
+    hedge_delay: float
+    shared_stats: Optional[mmap.mmap]
+    health_probe_addr: str
+    health_probe_port: int
+    health_interval: float
+    health_timeout: float
+    health_streaks: dict[BaseConnector, int]
 
     logger = logging.getLogger('proxy_dispatcher')
 
-    def __init__(self, rule_matcher: RuleMatcher,
-                 connectors: list[BaseConnector]):
+    def __init__(self,
+                 rule_matcher: RuleMatcher,
+                 connectors: list[BaseConnector],
+                 dispatch_strategy: str = DISPATCH_STRATEGY,
+                 hedge_delay: float = HEDGE_DELAY,
+                 happy_eyeballs_delay: float = HAPPY_EYEBALLS_DELAY,
+                 resolver: Optional[Resolver] = None,
+                 health_probe_addr: str = HEALTH_PROBE_ADDR,
+                 health_probe_port: int = HEALTH_PROBE_PORT,
+                 health_interval: float = HEALTH_INTERVAL,
+                 health_timeout: float = HEALTH_TIMEOUT):
+        if dispatch_strategy not in ('weight', 'p2c', 'least-outstanding'):
+            raise ValueError('invalid dispatch strategy')
         self.rule_matcher = rule_matcher
         self.block_connector = NULLConnector(name='BLOCK')
-        self.direct_connector = TCPConnector(name='DIRECT')
+        self.direct_connector = TCPConnector(
+            name='DIRECT',
+            happy_eyeballs_delay=happy_eyeballs_delay,
+            resolver=resolver)
         if len(connectors) == 0:
-            connectors.append(TCPConnector(name='FORWARD'))
+            connectors.append(TCPConnector(name='FORWARD', resolver=resolver))
             self.logger.warning('auto add forward connector')
         self.forward_connectors = connectors
+        self.dispatch_strategy = dispatch_strategy
+        self.hedge_delay = hedge_delay
+        self.shared_stats = None
+        self.health_probe_addr = health_probe_addr
+        self.health_probe_port = health_probe_port
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.health_streaks = dict()
+
+    @property
+    def connectors(self) -> list[BaseConnector]:
+        return [
+            self.block_connector,
+            self.direct_connector,
+            *self.forward_connectors,
+        ]
+
+    def share_stats(self):
+        """Move the stats of connectors to an anonymous shared mapping, so
+        processes forked afterwards dispatch on the same weights."""
+        if self.shared_stats is not None:
+            return
+        connectors = self.connectors
+        slots = BaseConnector.STATS_SLOTS
+        self.shared_stats = mmap.mmap(-1, 8 * slots * len(connectors))
+        view = memoryview(self.shared_stats).cast('d')
+        for i, connector in enumerate(connectors):
+            connector.bind_stats(view[i * slots:(i + 1) * slots])
 
     def dispatch(self, addr: str, port: int) -> BaseConnector:
         rule = self.rule_matcher.match(addr)
@@ -38,6 +108,100 @@ class ProxyDispatcher:
     def choice_forward_connector(self) -> BaseConnector:
         if len(self.forward_connectors) <= 1:
             return self.forward_connectors[0]
-        weights = [connector.weight for connector in self.forward_connectors]
-        connector, = random.choices(self.forward_connectors, weights)
+        # skip connectors down, unless all of them are
+        connectors = [
+            connector for connector in self.forward_connectors if connector.up
+        ] or self.forward_connectors
+        if len(connectors) == 1:
+            return connectors[0]
+        if self.dispatch_strategy == 'p2c':
+            # power of two choices, the cheaper of two random connectors
+            a, b = random.sample(connectors, 2)
+            return a if a.cost() <= b.cost() else b
+        if self.dispatch_strategy == 'least-outstanding':
+            return min(connectors,
+                       key=lambda connector:
+                       (connector.outstanding, connector.cost()))
+        weights = [connector.weight for connector in connectors]
+        connector, = random.choices(connectors, weights)
         return connector
+
+    def choice_hedge_connectors(
+            self, connector: BaseConnector) -> list[BaseConnector]:
+        """Return connector, followed by the cheapest other forward
+        connector up if hedging applies to it."""
+        if self.hedge_delay <= 0 or \
+           not any(connector is c for c in self.forward_connectors):
+            return [connector]
+        others = [
+            c for c in self.forward_connectors if c is not connector and c.up
+        ]
+        if len(others) == 0:
+            return [connector]
+        return [connector, min(others, key=lambda c: c.cost())]
+
+    def get_hedge_delay(self, connector: BaseConnector) -> float:
+        """Return the estimated p90 connect latency of connector, within
+        HEDGE_DELAY_MIN and hedge_delay."""
+        estimate = connector.connect_estimate(HEDGE_DEVIATIONS)
+        if estimate == 0:
+            return self.hedge_delay
+        return min(max(estimate, HEDGE_DELAY_MIN), self.hedge_delay)
+
+    async def check_health(self):
+        """Probe forward connectors every health_interval, a connector goes
+        down after HEALTH_FALL failed probes in a row and comes back up
+        after HEALTH_RISE successful ones."""
+        # with a single connector there is nothing to choose from
+        if self.health_interval <= 0 or len(self.forward_connectors) <= 1:
+            return
+        while True:
+            await asyncio.gather(*(self.probe(connector)
+                                   for connector in self.forward_connectors))
+            await asyncio.sleep(self.health_interval)
+
+    async def probe_connect(self, connector: BaseConnector) -> BaseConnection:
+        conn = await connector.connect_to(self.health_probe_addr,
+                                          self.health_probe_port)
+        # an optimistic handshake is only known good once answered
+        if isinstance(conn, OptimisticConnection):
+            try:
+                await conn.validate()
+            except Exception:
+                await conn.close()
+                raise
+        return conn
+
+    async def probe(self, connector: BaseConnector):
+        # probes run as tasks of their own, timed up to the handshake
+        TCPConnector.disable_fast_open()
+        start = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(
+                self.probe_connect(connector), self.health_timeout)
+        except Exception as e:
+            self.logger.debug('probe %s failed: %.40s', connector, e)
+            # a failure costs at least the whole probe timeout
+            connector.record_connect_failure(max(
+                time.perf_counter() - start, self.health_timeout))
+            ok = False
+        else:
+            connector.record_connect(time.perf_counter() - start)
+            connector.record_result(True)
+            try:
+                await conn.close()
+            except Exception:
+                pass
+            ok = True
+        streak = self.health_streaks.get(connector, 0)
+        if ok:
+            streak = max(streak, 0) + 1
+        else:
+            streak = min(streak, 0) - 1
+        self.health_streaks[connector] = streak
+        if connector.up and streak <= -HEALTH_FALL:
+            connector.up = False
+            self.logger.warning('forward connector %s down', connector)
+        elif not connector.up and streak >= HEALTH_RISE:
+            connector.up = True
+            self.logger.info('forward connector %s up', connector)
@@ -1,23 +1,46 @@
+import time
 import asyncio
 import logging
 
-from typing import Optional
-from asyncio import Task, StreamReader, StreamWriter
+from typing import TypeVar, Optional
+from asyncio import Task, StreamReader, StreamWriter, AbstractEventLoop
+from collections.abc import Callable, Coroutine
 
 from .defaults import (
     SERVER_ADDR,
     SERVER_PORT,
+    CONNECTION_TYPE,
+    LOOP_TYPE,
+    HTTP_KEEPALIVE,
+    HTTP_POOL_SIZE,
+    HTTP_IDLE_TIMEOUT,
+    CONNECT_FAILURE_LATENCY,
 )
+from .staggered import staggered_race
 from .proxydispatcher import ProxyDispatcher
-from .connections import BaseConnection, TCPConnection
+from .httpforwarder import HTTPForwarder
+from .connections import (
+    BaseConnection,
+    RelayError,
+    SocketConnection,
+    TCPConnection,
+    ConnectionProtocol,
+)
+from .connectors import BaseConnector, TCPConnector
 from .acceptors import BaseAcceptor
 
+T = TypeVar('T')
+
 
 class ProxyServer:
     acceptor: BaseAcceptor
     dispatcher: ProxyDispatcher
     server_addr: str
     server_port: int
+    connection_type: str
+    reuse_port: bool
+    loop_factory: Optional[Callable[[], AbstractEventLoop]]
+    http_forwarder: Optional[HTTPForwarder]
 
     logger = logging.getLogger('proxy_server')
 
@@ -29,81 +52,301 @@ class ProxyServer:
         dispatcher: ProxyDispatcher,
         server_addr: str = SERVER_ADDR,
         server_port: int = SERVER_PORT,
+        connection_type: str = CONNECTION_TYPE,
+        reuse_port: bool = False,
+        loop_factory: Optional[Callable[[], AbstractEventLoop]] = None,
+        http_keepalive: bool = HTTP_KEEPALIVE,
+        http_pool_size: int = HTTP_POOL_SIZE,
+        http_idle_timeout: float = HTTP_IDLE_TIMEOUT,
     ):
         self.acceptor = acceptor
         self.dispatcher = dispatcher
         self.server_addr = server_addr
         self.server_port = server_port
+        self.connection_type = connection_type
+        self.reuse_port = reuse_port
+        self.loop_factory = loop_factory
+        self.http_forwarder = HTTPForwarder(
+            dispatcher=dispatcher,
+            connect=self.connect,
+            tunnel=self.pipe,
+            pool_size=http_pool_size,
+            idle_timeout=http_idle_timeout) if http_keepalive else None
+
+    @classmethod
+    def get_loop_factory(
+        cls,
+        loop_type: str = LOOP_TYPE,
+    ) -> Optional[Callable[[], AbstractEventLoop]]:
+        """Return the event loop factory of loop_type, None for the default
+        asyncio loop, which is also the fallback if uvloop is missing."""
+        if loop_type == 'asyncio':
+            return None
+        if loop_type != 'uvloop':
+            raise ValueError('invalid loop type')
+        try:
+            import uvloop
+        except ImportError:
+            cls.logger.warning('uvloop not installed, use asyncio loop')
+            return None
+        return uvloop.new_event_loop
 
     def run(self):
         try:
-            asyncio.run(self.start_server())
+            self.run_main(self.start_server(), self.loop_factory)
         except Exception as e:
             self.logger.error('error while serving: %s', e)
 
+    @staticmethod
+    def run_main(
+        main: Coroutine[None, None, T],
+        loop_factory: Optional[Callable[[], AbstractEventLoop]] = None,
+    ) -> T:
+        """Run main on a loop of loop_factory, with asyncio.Runner from
+        python 3.11 on."""
+        if hasattr(asyncio, 'Runner'):
+            with asyncio.Runner(loop_factory=loop_factory) as runner:
+                return runner.run(main)
+        return ProxyServer.run_loop(main, loop_factory)
+
+    @staticmethod
+    def run_loop(
+        main: Coroutine[None, None, T],
+        loop_factory: Optional[Callable[[], AbstractEventLoop]] = None,
+    ) -> T:
+        """Run main on a loop of loop_factory before python 3.11, cleaned
+        up as asyncio.Runner does."""
+        loop = loop_factory() if loop_factory is not None \
+            else asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(main)
+        finally:
+            try:
+                tasks = asyncio.all_tasks(loop)
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+
     async def start_server(self):
-        server = await asyncio.start_server(self.open_connection,
-                                            self.server_addr,
-                                            self.server_port,
-                                            reuse_address=True)
+        server: asyncio.AbstractServer
+        if self.connection_type == 'protocol':
+            loop = asyncio.get_running_loop()
+            server = await loop.create_server(
+                lambda: ConnectionProtocol(self.serve_connection),
+                self.server_addr,
+                self.server_port,
+                reuse_address=True,
+                reuse_port=self.reuse_port)
+        else:
+            server = await asyncio.start_server(
+                self.open_connection,
+                self.server_addr,
+                self.server_port,
+                reuse_address=True,
+                reuse_port=self.reuse_port,
+                limit=TCPConnection.read_size_max)
         addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
         self.logger.info('server start at %s', addrs)
+        coros = [
+            self.dispatcher.rule_matcher.watch_rules(),
+            self.dispatcher.check_health(),
+        ]
+        if self.http_forwarder is not None:
+            coros.append(self.http_forwarder.evict_idle())
+        for coro in coros:
+            task = asyncio.create_task(coro)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
         async with server:
             await server.serve_forever()
 
     async def open_connection(self, reader: StreamReader,
                               writer: StreamWriter):
+        await self.serve_connection(TCPConnection(reader, writer))
+
+    async def serve_connection(self, client: BaseConnection):
         try:
-            client = TCPConnection(reader, writer)
             addr, port, unwrite = await self.acceptor.accept(client)
-            connector = self.dispatcher.dispatch(addr, port)
+            forward = self.http_forwarder is not None and \
+                self.http_forwarder.is_forwardable(unwrite)
+            if not forward:
+                connector = self.dispatcher.dispatch(addr, port)
         except Exception as e:
             self.logger.warning('except while accepting: %.40s', e)
+            await self.close_quietly(client)
+            return
+
+        if forward:
+            assert self.http_forwarder is not None
+            try:
+                await self.http_forwarder.forward(client, unwrite)
+            except Exception as e:
+                self.logger.warning('except while forwarding: %.40s', e)
             return
 
         try:
-            peer = await connector.connect_to(addr, port, unwrite)
-            await self.proxy(client, peer)
-            connector.weight_increase()
+            connector, peer = await self.connect(connector, addr, port,
+                                                 unwrite)
         except Exception as e:
             self.logger.warning('except while connecting via %s: %.40s',
                                 connector, e)
-            connector.weight_decrease()
+            await self.close_quietly(client)
             return
 
+        connected = time.perf_counter()
+        connector.outstanding += 1
+        try:
+            await self.proxy(
+                client, peer, lambda: connector.record_ttfb(
+                    time.perf_counter() - connected))
+            connector.weight_increase()
+            connector.record_result(True)
+        except Exception as e:
+            self.logger.warning('except while proxying via %s: %.40s',
+                                connector, e)
+            # failures of the client tell nothing about the peer
+            if not (isinstance(e, RelayError) and e.conn is client):
+                connector.weight_decrease()
+                connector.record_result(False)
+        finally:
+            connector.outstanding -= 1
+
+    async def connect(
+        self,
+        connector: BaseConnector,
+        addr: str,
+        port: int,
+        unwrite: bytes = b'',
+    ) -> tuple[BaseConnector, BaseConnection]:
+        """Connect via connector, hedged with a second forward connector
+        started if the first has not connected within its usual time.
+
+        Without a race unwrite goes to connect_to, which may send it with
+        the handshake. A race holds it back until the winner is known."""
+        connectors = self.dispatcher.choice_hedge_connectors(connector)
+
+        async def attempt(connector: BaseConnector,
+                          unwrite: bytes = b'') -> BaseConnection:
+            if len(connectors) > 1:
+                # each attempt is a task of its own
+                TCPConnector.disable_fast_open()
+            start = time.perf_counter()
+            connector.outstanding += 1
+            try:
+                peer = await connector.connect_to(addr, port, unwrite)
+            except asyncio.CancelledError:
+                # lost the race, at least this slow
+                connector.record_connect(time.perf_counter() - start)
+                raise
+            except Exception:
+                connector.weight_decrease()
+                connector.record_connect_failure(max(
+                    time.perf_counter() - start, CONNECT_FAILURE_LATENCY))
+                raise
+            finally:
+                connector.outstanding -= 1
+            connector.record_connect(time.perf_counter() - start)
+            return peer
+
+        if len(connectors) == 1:
+            return connector, await attempt(connector, unwrite)
+        index, peer = await staggered_race(
+            [lambda c=c: attempt(c) for c in connectors],
+            self.dispatcher.get_hedge_delay(connector),
+            self.close_quietly)
+        if index != 0:
+            self.logger.info('hedged %s with %s', connector,
+                             connectors[index])
+        connector = connectors[index]
+        # written only now, the loser of a race must not have seen it
+        if len(unwrite) != 0:
+            await peer.write(unwrite)
+        return connector, peer
+
+    @staticmethod
+    async def close_quietly(conn: BaseConnection):
+        try:
+            await conn.close()
+        except Exception:
+            pass
+
     @classmethod
-    async def proxy(cls, client: BaseConnection, peer: BaseConnection):
+    async def pipe(cls,
+                   client: BaseConnection,
+                   peer: BaseConnection,
+                   first_read: Optional[Callable[[], None]] = None):
+        """Copy both ways until both ends are done, neither is closed."""
         task1 = asyncio.create_task(cls.io_copy(client, peer))
-        task2 = asyncio.create_task(cls.io_copy(peer, client))
+        task2 = asyncio.create_task(cls.io_copy(peer, client, first_read))
         for task in (task1, task2):
             cls.tasks.add(task)
             task.add_done_callback(cls.tasks.discard)
+        try:
+            await asyncio.gather(task1, task2)
+        except BaseException:
+            for task in (task1, task2):
+                if not task.done():
+                    task.cancel()
+            raise
 
+    @classmethod
+    async def proxy(cls,
+                    client: BaseConnection,
+                    peer: BaseConnection,
+                    first_read: Optional[Callable[[], None]] = None):
         exc: Optional[Exception] = None
 
         try:
-            await asyncio.gather(task1, task2)
+            await cls.pipe(client, peer, first_read)
         except Exception as e:
             exc = e
-            for task in (task1, task2):
-                if not task.cancelled():
-                    task.done()
 
         for conn in (client, peer):
             try:
                 await conn.close()
             except Exception as e:
-                if exc is not None:
-                    exc = e
+                if exc is None:
+                    exc = RelayError(conn, e)
 
         if exc is not None:
             raise exc
 
     @staticmethod
-    async def io_copy(reader: BaseConnection, writer: BaseConnection):
-        while True:
-            buf = await reader.read()
-            if len(buf) == 0:
-                await writer.write_eof()
-                break
-            await writer.write(buf)
+    async def io_copy(reader: BaseConnection,
+                      writer: BaseConnection,
+                      first_read: Optional[Callable[[], None]] = None):
+        # the side of the pending call, failures are raised as RelayError
+        conn: Optional[BaseConnection] = reader
+        try:
+            if first_read is not None:
+                buf = await reader.read()
+                first_read()
+                conn = writer
+                if len(buf) == 0:
+                    await writer.write_eof()
+                    return
+                await writer.write(buf)
+            if isinstance(reader, SocketConnection) and \
+               reader.can_splice_to(writer):
+                # either side may fail a splice, left unattributed
+                conn = None
+                await reader.splice_to(writer)
+                return
+            while True:
+                conn = reader
+                buf = await reader.read()
+                conn = writer
+                if len(buf) == 0:
+                    await writer.write_eof()
+                    break
+                await writer.write(buf)
+        except Exception as e:
+            if conn is None:
+                raise
+            raise RelayError(conn, e) from e
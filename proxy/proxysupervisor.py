@@ -0,0 +1,176 @@
+import os
+import time
+import signal
+import logging
+
+from typing import Optional
+
+from .defaults import (
+    WORKERS,
+    WORKER_RESTART_DELAY,
+    WORKER_STOP_TIMEOUT,
+)
+from .proxyserver import ProxyServer
+
+
+class ProxySupervisor:
+    """Run a ProxyServer in forked worker processes.
+
+    Every worker binds the server address with SO_REUSEPORT and runs its
+    own event loop. The supervisor restarts workers that exit, compiles
+    and loads rules before forking so workers share the mapped index, and
+    forwards rule reloads to the workers, which stop polling themselves.
+    Connector stats live in shared memory, so dispatching is consistent,
+    and only the first worker runs health checks.
+    """
+    proxy_server: ProxyServer
+    workers: int
+    restart_delay: float
+    pids: dict[int, tuple[int, float]]
+    restarts: list[tuple[float, int]]
+
+    logger = logging.getLogger('proxy_supervisor')
+
+    signals = {signal.SIGCHLD, signal.SIGHUP, signal.SIGINT, signal.SIGTERM}
+
+    def __init__(self,
+                 proxy_server: ProxyServer,
+                 workers: int = WORKERS,
+                 restart_delay: float = WORKER_RESTART_DELAY):
+        if workers <= 0:
+            raise ValueError('invalid workers')
+        self.proxy_server = proxy_server
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.pids = dict()
+        self.restarts = list()
+
+    def run(self):
+        self.proxy_server.reuse_port = True
+        self.proxy_server.dispatcher.share_stats()
+        self.update_rules(forced=True)
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.signals)
+        try:
+            for slot in range(self.workers):
+                self.spawn(slot)
+            self.supervise()
+        finally:
+            self.stop()
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+
+    def spawn(self, slot: int):
+        pid = os.fork()
+        if pid != 0:
+            self.pids[pid] = (slot, time.monotonic())
+            self.logger.info('start worker %d pid %d', slot, pid)
+            return
+        code = 1
+        try:
+            # interrupts go to the supervisor, which stops the workers
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+            dispatcher = self.proxy_server.dispatcher
+            dispatcher.rule_matcher.rules_reload_interval = 0
+            # one worker probes, the up states are shared
+            if slot != 0:
+                dispatcher.health_interval = 0
+            self.proxy_server.run()
+            code = 0
+        except Exception as e:
+            self.logger.error('error in worker %d: %s', slot, e)
+        finally:
+            os._exit(code)
+
+    def supervise(self):
+        rule_matcher = self.proxy_server.dispatcher.rule_matcher
+        interval = rule_matcher.rules_reload_interval \
+            if rule_matcher.rules_reload_interval > 0 else None
+        check_at = time.monotonic() + interval \
+            if interval is not None else None
+        while True:
+            deadlines = [when for when, _ in self.restarts]
+            if check_at is not None:
+                deadlines.append(check_at)
+            info: Optional[signal.struct_siginfo]
+            if len(deadlines) != 0:
+                timeout = max(min(deadlines) - time.monotonic(), 0)
+                info = signal.sigtimedwait(self.signals, timeout)
+            else:
+                info = signal.sigwaitinfo(self.signals)
+            signo = info.si_signo if info is not None else None
+            if signo in (signal.SIGINT, signal.SIGTERM):
+                self.logger.info('stop workers')
+                return
+            if signo == signal.SIGCHLD:
+                self.reap()
+            elif signo == signal.SIGHUP:
+                self.update_rules(forced=True)
+            now = time.monotonic()
+            if check_at is not None and interval is not None and \
+               now >= check_at:
+                check_at = now + interval
+                self.update_rules()
+            for when, slot in list(self.restarts):
+                if now >= when:
+                    self.restarts.remove((when, slot))
+                    self.spawn(slot)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid not in self.pids:
+                continue
+            slot, started = self.pids.pop(pid)
+            self.logger.warning('worker %d pid %d exit with %d', slot, pid,
+                                os.waitstatus_to_exitcode(status))
+            # back off workers dying at once, e.g. when the bind fails
+            delay = self.restart_delay \
+                if time.monotonic() - started < self.restart_delay else 0
+            self.restarts.append((time.monotonic() + delay, slot))
+
+    def update_rules(self, forced: bool = False):
+        """Compile a stale index once here, then let workers map it."""
+        rule_matcher = self.proxy_server.dispatcher.rule_matcher
+        if not forced and \
+           rule_matcher.get_rules_stamp() == rule_matcher.rules_stamp:
+            return
+        try:
+            if len(rule_matcher.rules_index) != 0 and \
+               os.path.exists(rule_matcher.rules_file) and \
+               not rule_matcher.index_usable():
+                rule_matcher.compile_rules()
+            rule_matcher.load_rules()
+        except Exception as e:
+            self.logger.warning('except while updating rules: %s', e)
+            return
+        self.kill(signal.SIGHUP)
+
+    def kill(self, signo: int):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signo)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        self.kill(signal.SIGTERM)
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        while len(self.pids) != 0:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid != 0:
+                self.pids.pop(pid, None)
+            elif time.monotonic() < deadline:
+                time.sleep(0.05)
+            else:
+                self.kill(signal.SIGKILL)
+                deadline = float('inf')
+        self.pids.clear()
@@ -0,0 +1,103 @@
+import time
+import socket
+import asyncio
+import logging
+
+from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+
+from .defaults import (
+    RESOLVER_THREADS,
+    RESOLVER_CACHE_SIZE,
+    RESOLVER_TTL,
+    RESOLVER_NEGATIVE_TTL,
+    RESOLVER_REPORT,
+)
+from .lrucache import LRUCache
+
+Answer = Union[list[str], OSError]
+
+
+class Resolver:
+    """Caching resolver over getaddrinfo in a dedicated thread pool.
+
+    Answers are cached for ttl and failures for negative_ttl, getaddrinfo
+    does not tell the TTL of records. Concurrent lookups of one name share
+    a single getaddrinfo call.
+    """
+    ttl: float
+    negative_ttl: float
+    executor: ThreadPoolExecutor
+    cache: LRUCache[str, tuple[float, Answer]]
+    inflight: dict[str, asyncio.Task[Answer]]
+    coalesced: int
+    lookups: int
+    lookup_time: float
+
+    logger = logging.getLogger('resolver')
+
+    def __init__(self,
+                 threads: int = RESOLVER_THREADS,
+                 cache_size: int = RESOLVER_CACHE_SIZE,
+                 ttl: float = RESOLVER_TTL,
+                 negative_ttl: float = RESOLVER_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix='resolver')
+        self.cache = LRUCache(cache_size)
+        self.inflight = dict()
+        self.coalesced = 0
+        self.lookups = 0
+        self.lookup_time = 0.0
+
+    def __str__(self) -> str:
+        return 'cache {} coalesced {} lookups {} latency {:.1f}ms'.format(
+            self.cache, self.coalesced, self.lookups,
+            self.lookup_latency * 1000)
+
+    @property
+    def lookup_latency(self) -> float:
+        return self.lookup_time / self.lookups if self.lookups != 0 else 0.0
+
+    async def resolve(self, host: str) -> list[str]:
+        """Return the addresses of host, in the order of getaddrinfo."""
+        entry = self.cache.get(host, lambda entry: entry[0] > time.monotonic())
+        if entry is not None:
+            answer = entry[1]
+        else:
+            # a task of its own, a cancelled requester leaves it running
+            task = self.inflight.get(host)
+            if task is None:
+                task = asyncio.create_task(self.lookup(host))
+                self.inflight[host] = task
+                task.add_done_callback(
+                    lambda _: self.inflight.pop(host, None))
+            else:
+                self.coalesced += 1
+            answer = await asyncio.shield(task)
+        if isinstance(answer, OSError):
+            # a fresh copy, raising the cached one would grow its traceback
+            raise type(answer)(*answer.args)
+        return answer
+
+    async def lookup(self, host: str) -> Answer:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        answer: Answer
+        try:
+            infos = await loop.run_in_executor(self.executor,
+                                               socket.getaddrinfo, host, None,
+                                               0, socket.SOCK_STREAM,
+                                               socket.IPPROTO_TCP)
+            answer = list(dict.fromkeys(str(info[4][0]) for info in infos))
+            ttl = self.ttl
+        except OSError as e:
+            answer = e
+            ttl = self.negative_ttl
+        self.lookup_time += time.perf_counter() - start
+        self.lookups += 1
+        self.cache.put(host, (time.monotonic() + ttl, answer))
+        if self.lookups % RESOLVER_REPORT == 0:
+            self.logger.info('resolver %s', self)
+        return answer
@@ -1,15 +1,33 @@
+import os
 import os.path
+import sys
 import enum
-import functools
+import time
+import signal
+import asyncio
+import socket
+import ipaddress
+import re
+import struct
+import hashlib
+import bisect
+import mmap
 import logging
 
 from typing_extensions import Self
-from typing import Optional
+from typing import Optional, Union
+from array import array
+from collections.abc import Sequence, Iterator, Hashable
 
 from .defaults import (
     RULES_DEFAULT,
     RULES_FILE,
+    RULES_INDEX,
+    RULES_CACHE_SIZE,
+    RULES_CACHE_REPORT,
+    RULES_RELOAD_INTERVAL,
 )
+from .lrucache import LRUCache
 
 
 class Rule(enum.Enum):
@@ -23,7 +41,7 @@ class Rule(enum.Enum):
         if self is self.Direct:
             return 'direct'
         if self is self.Forward:
-            return 'direct'
+            return 'forward'
         raise KeyError
 
     @classmethod
@@ -38,46 +56,806 @@ class Rule(enum.Enum):
         raise ValueError
 
 
+def suffix_starts(domain: str, maxdepth: int) -> list[int]:
+    """Offsets of the suffixes of domain, indexed by label depth."""
+    starts = [len(domain)]
+    pos = len(domain)
+    while len(starts) <= maxdepth and pos >= 0:
+        pos = domain.rfind('.', 0, pos)
+        starts.append(pos + 1)
+    return starts
+
+
+def rule_hash(domain: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(domain.encode(), digest_size=8).digest(), 'little')
+
+
+# Binary index layout (little endian):
+#   header  : magic(4s) version(I) nsections(I)
+#   section : tag(4s) offset(Q) size(Q), repeated nsections times
+#   data    : sections, each aligned to 8 bytes
+# Sections are optional, a missing one reads as empty.
+INDEX_MAGIC = b'PXRI'
+INDEX_VERSION = 1
+index_header = struct.Struct('<4sII')
+index_section = struct.Struct('<4sQQ')
+
+
+def write_index(path: str, sections: dict[bytes, bytes]):
+    offset = index_header.size + len(sections) * index_section.size
+    table, data = [], []
+    for tag, buf in sections.items():
+        pad = -offset % 8
+        data.append(bytes(pad))
+        data.append(buf)
+        offset += pad
+        table.append(index_section.pack(tag, offset, len(buf)))
+        offset += len(buf)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(index_header.pack(INDEX_MAGIC, INDEX_VERSION, len(sections)))
+        f.write(b''.join(table))
+        f.write(b''.join(data))
+    # replace atomically, processes mapping the old file keep their pages
+    os.replace(tmp, path)
+
+
+def read_index(buf: memoryview) -> dict[bytes, memoryview]:
+    magic, version, nsections = index_header.unpack_from(buf, 0)
+    if magic != INDEX_MAGIC or version > INDEX_VERSION:
+        raise RuntimeError('invalid rules index')
+    sections = dict()
+    for i in range(nsections):
+        tag, offset, size = index_section.unpack_from(
+            buf, index_header.size + i * index_section.size)
+        sections[tag] = buf[offset:offset + size]
+    return sections
+
+
+def index_array(buf: memoryview, typecode: str) -> Sequence[int]:
+    if sys.byteorder == 'little' or typecode == 'B':
+        return buf.cast(typecode)
+    arr = array(typecode)
+    arr.frombytes(buf)
+    arr.byteswap()
+    return arr
+
+
+def index_bytes(arr: array) -> bytes:
+    if sys.byteorder == 'little' or arr.itemsize == 1:
+        return arr.tobytes()
+    arr = array(arr.typecode, arr)
+    arr.byteswap()
+    return arr.tobytes()
+
+
+def parse_ip(addr: str) -> Optional[tuple[int, int]]:
+    """Parse a literal address to (version, integer), None for domains."""
+    if len(addr) == 0:
+        return None
+    if addr[-1].isdigit():
+        try:
+            return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, addr),
+                                     'big')
+        except OSError:
+            pass
+    if ':' in addr:
+        try:
+            return 6, int.from_bytes(
+                socket.inet_pton(socket.AF_INET6, addr), 'big')
+        except OSError:
+            pass
+    return None
+
+
+class U128Array:
+    """Sequence of 128-bit integers packed big endian in a buffer."""
+    buf: Union[bytes, memoryview]
+
+    def __init__(self, buf: Union[bytes, memoryview]):
+        self.buf = buf
+
+    def __len__(self) -> int:
+        return len(self.buf) // 16
+
+    def __getitem__(self, i: int) -> int:
+        return int.from_bytes(self.buf[i * 16:i * 16 + 16], 'big')
+
+    @staticmethod
+    def pack(values: list[int]) -> bytes:
+        return b''.join(value.to_bytes(16, 'big') for value in values)
+
+
+# version -> (starts, ends, codes)
+CIDRRanges = dict[int, tuple[Sequence[int], Sequence[int], Sequence[int]]]
+
+
+class CIDRIndex:
+    """Address ranges for ip-cidr rules, looked up by bisection.
+
+    Networks are flattened into disjoint ranges, where a more specific
+    network overrides the one containing it, and kept as parallel arrays
+    of range starts, ends and rule codes per address family: 32-bit
+    arrays for IPv4 and packed 128-bit buffers for IPv6.
+    """
+    ranges: CIDRRanges
+
+    def __init__(self, ranges: Optional[CIDRRanges] = None):
+        self.ranges = ranges if ranges is not None else dict()
+
+    def __len__(self) -> int:
+        return sum(len(codes) for _, _, codes in self.ranges.values())
+
+    def items(self) -> Iterator[tuple[Hashable, int]]:
+        for version, (starts, ends, codes) in self.ranges.items():
+            for i in range(len(codes)):
+                yield (version, starts[i], ends[i]), codes[i]
+
+    def get(self, version: int, ip: int) -> Optional[Rule]:
+        ranges = self.ranges.get(version)
+        if ranges is None:
+            return None
+        starts, ends, codes = ranges
+        i = bisect.bisect_right(starts, ip) - 1
+        if i >= 0 and ip <= ends[i]:
+            return Rule(codes[i])
+        return None
+
+    @classmethod
+    def from_networks(
+        cls,
+        networks: list[tuple[Union[ipaddress.IPv4Network,
+                                   ipaddress.IPv6Network], Rule]],
+    ) -> Self:
+        ranges: CIDRRanges = dict()
+        for version in (4, 6):
+            # first rule of the same network wins, as for domains
+            nets: dict[tuple[int, int], int] = dict()
+            for net, rule in networks:
+                if net.version == version:
+                    nets.setdefault((int(net.network_address),
+                                     int(net.broadcast_address)), rule.value)
+            if len(nets) == 0:
+                continue
+            starts, ends, codes = cls.flatten(nets)
+            if version == 4:
+                ranges[version] = (array('I', starts), array('I', ends),
+                                   array('B', codes))
+            else:
+                ranges[version] = (U128Array(U128Array.pack(starts)),
+                                   U128Array(U128Array.pack(ends)),
+                                   array('B', codes))
+        return cls(ranges)
+
+    @staticmethod
+    def flatten(
+        nets: dict[tuple[int, int], int]
+    ) -> tuple[list[int], list[int], list[int]]:
+        starts: list[int] = []
+        ends: list[int] = []
+        codes: list[int] = []
+
+        def emit(start: int, end: int, code: int):
+            if start > end:
+                return
+            if len(codes) != 0 and codes[-1] == code and \
+               ends[-1] + 1 == start:
+                ends[-1] = end
+                return
+            starts.append(start)
+            ends.append(end)
+            codes.append(code)
+
+        # networks are either nested or disjoint, outer ones sort first
+        stack: list[tuple[int, int]] = []
+        pos = 0
+        for (start, end), code in sorted(nets.items(),
+                                         key=lambda i: (i[0][0], -i[0][1])):
+            while len(stack) != 0 and stack[-1][0] < start:
+                top_end, top_code = stack.pop()
+                emit(pos, top_end, top_code)
+                pos = top_end + 1
+            if len(stack) != 0:
+                emit(pos, start - 1, stack[-1][1])
+            stack.append((end, code))
+            pos = start
+        while len(stack) != 0:
+            top_end, top_code = stack.pop()
+            emit(pos, top_end, top_code)
+            pos = top_end + 1
+        return starts, ends, codes
+
+    def sections(self) -> dict[bytes, bytes]:
+        sections = dict()
+        for version, (starts, ends, codes) in self.ranges.items():
+            if version == 4:
+                assert isinstance(starts, array) and isinstance(ends, array)
+                sections[b'I4ST'] = index_bytes(starts)
+                sections[b'I4ED'] = index_bytes(ends)
+                sections[b'I4RL'] = bytes(codes)
+            else:
+                assert isinstance(starts, U128Array) and \
+                    isinstance(ends, U128Array)
+                sections[b'I6ST'] = bytes(starts.buf)
+                sections[b'I6ED'] = bytes(ends.buf)
+                sections[b'I6RL'] = bytes(codes)
+        return sections
+
+    @classmethod
+    def from_sections(cls, sections: dict[bytes, memoryview]) -> Self:
+        ranges: CIDRRanges = dict()
+        if b'I4RL' in sections:
+            ranges[4] = (index_array(sections[b'I4ST'], 'I'),
+                         index_array(sections[b'I4ED'], 'I'),
+                         index_array(sections[b'I4RL'], 'B'))
+        if b'I6RL' in sections:
+            ranges[6] = (U128Array(sections[b'I6ST']),
+                         U128Array(sections[b'I6ED']),
+                         index_array(sections[b'I6RL'], 'B'))
+        return cls(ranges)
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over keyword rules.
+
+    One scan of the text finds every keyword it contains and returns the
+    lowest order among them.
+    """
+    goto: list[dict[str, int]]
+    fail: list[int]
+    out: list[int]
+
+    def __init__(self, keywords: list[tuple[str, int]]):
+        self.goto = [dict()]
+        self.out = [-1]
+        for keyword, order in keywords:
+            state = 0
+            for c in keyword:
+                nstate = self.goto[state].get(c)
+                if nstate is None:
+                    nstate = self.goto[state][c] = len(self.goto)
+                    self.goto.append(dict())
+                    self.out.append(-1)
+                state = nstate
+            if self.out[state] < 0 or order < self.out[state]:
+                self.out[state] = order
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for c, nstate in self.goto[state].items():
+                queue.append(nstate)
+                fstate = self.fail[state]
+                while fstate != 0 and c not in self.goto[fstate]:
+                    fstate = self.fail[fstate]
+                fstate = self.goto[fstate].get(c, 0)
+                self.fail[nstate] = fstate
+                fout = self.out[fstate]
+                if fout >= 0 and (self.out[nstate] < 0
+                                  or fout < self.out[nstate]):
+                    self.out[nstate] = fout
+
+    def search(self, text: str) -> int:
+        """Return the lowest order of the keywords in text, -1 if none."""
+        goto, fail, out = self.goto, self.fail, self.out
+        best = -1
+        state = 0
+        for c in text:
+            while state != 0 and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            order = out[state]
+            if order >= 0 and (best < 0 or order < best):
+                best = order
+        return best
+
+
+# kind, pattern and rule of a keyword or regexp rule
+PatternRule = tuple[str, str, Rule]
+
+
+class PatternMatcher:
+    """Keyword and regexp rules, the first of them in the rules wins.
+
+    Keywords go to a KeywordAutomaton. Regexps are joined into a single
+    alternation inside a lookahead, with one named group per pattern, so
+    one finditer pass yields at every position the first pattern in the
+    rules that matches there. Patterns with groups of their own, whose
+    numbers would shift in the alternation, are searched on their own,
+    and only if they come before the best hit.
+    """
+    patterns: list[PatternRule]
+    compiled: dict[int, re.Pattern]
+    separate: list[int]
+    automaton: Optional[KeywordAutomaton]
+    regexp: Optional[re.Pattern]
+
+    logger = logging.getLogger('rule_matcher')
+
+    def __init__(self, patterns: list[PatternRule]):
+        self.patterns = []
+        self.compiled = dict()
+        self.separate = []
+        keywords = []
+        combined = []
+        for kind, pattern, rule in patterns:
+            order = len(self.patterns)
+            if kind == 'keyword':
+                keywords.append((pattern, order))
+            else:
+                compiled = self.compile_regexp(pattern)
+                if compiled is None:
+                    continue
+                if compiled.groups != 0 or not self.joinable(pattern):
+                    self.compiled[order] = compiled
+                    self.separate.append(order)
+                else:
+                    combined.append(f'(?P<p{order}>{pattern})')
+            self.patterns.append((kind, pattern, rule))
+        self.automaton = KeywordAutomaton(keywords) \
+            if len(keywords) != 0 else None
+        self.regexp = re.compile('(?=' + '|'.join(combined) + ')') \
+            if len(combined) != 0 else None
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def items(self) -> Iterator[tuple[Hashable, int]]:
+        for kind, pattern, rule in self.patterns:
+            yield (kind, pattern), rule.value
+
+    @classmethod
+    def compile_regexp(cls, pattern: str) -> Optional[re.Pattern]:
+        try:
+            return re.compile(pattern)
+        except re.error as e:
+            cls.logger.warning('except while compiling regexp %s: %s',
+                               pattern, e)
+            return None
+
+    @staticmethod
+    def joinable(pattern: str) -> bool:
+        """Whether pattern compiles as a group of the alternation, global
+        flags for one do not."""
+        try:
+            re.compile(f'(?P<p0>{pattern})')
+            return True
+        except re.error:
+            return False
+
+    def get(self, domain: str) -> Optional[Rule]:
+        best = len(self.patterns)
+        if self.automaton is not None:
+            order = self.automaton.search(domain)
+            if order >= 0:
+                best = order
+        if self.regexp is not None:
+            for res in self.regexp.finditer(domain):
+                assert res.lastgroup is not None
+                best = min(best, int(res.lastgroup[1:]))
+        for order in self.separate:
+            if order >= best:
+                break
+            if self.compiled[order].search(domain) is not None:
+                best = order
+                break
+        return self.patterns[best][2] if best < len(self.patterns) else None
+
+    def sections(self) -> dict[bytes, bytes]:
+        if len(self.patterns) == 0:
+            return dict()
+        return {
+            b'PTRN':
+            ''.join(f'{kind}\t{rule.value}\t{pattern}\n'
+                    for kind, pattern, rule in self.patterns).encode()
+        }
+
+    @classmethod
+    def from_sections(cls, sections: dict[bytes, memoryview]) -> Self:
+        patterns = []
+        if b'PTRN' in sections:
+            for line in bytes(sections[b'PTRN']).decode().splitlines():
+                kind, code, pattern = line.split('\t', 2)
+                patterns.append((kind, pattern, Rule(int(code))))
+        # indexes written before PTRN keep keywords and regexps apart
+        for tag, kind in ((b'KWRD', 'keyword'), (b'REGX', 'regexp')):
+            if tag in sections:
+                for line in bytes(sections[tag]).decode().splitlines():
+                    code, pattern = line.split('\t', 1)
+                    patterns.append((kind, pattern, Rule(int(code))))
+        return cls(patterns)
+
+
+class RuleIndex:
+    """Domain suffix index, one hash table per label depth.
+
+    A domain is resolved by probing its suffixes from the deepest depth
+    present in the index to the shallowest, so only depths that actually
+    hold rules are looked up, and no label list is built. Full rules
+    match the whole domain only and are looked up before the suffixes.
+    """
+    tables: dict[int, dict[str, Rule]]
+    depths: list[int]
+    fulls: dict[str, Rule]
+    networks: list[tuple[Union[ipaddress.IPv4Network, ipaddress.IPv6Network],
+                         Rule]]
+    pattern_rules: list[PatternRule]
+    _cidrs: Optional[CIDRIndex]
+    _patterns: Optional[PatternMatcher]
+
+    def __init__(self):
+        self.tables = dict()
+        self.depths = []
+        self.fulls = dict()
+        self.networks = []
+        self.pattern_rules = []
+        self._cidrs = None
+        self._patterns = None
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in self.tables.values()) + \
+            len(self.fulls) + len(self.networks) + len(self.patterns)
+
+    def items(self) -> Iterator[tuple[Hashable, int]]:
+        for table in self.tables.values():
+            for domain, rule in table.items():
+                yield rule_hash(domain), rule.value
+        for domain, rule in self.fulls.items():
+            yield ('full', rule_hash(domain)), rule.value
+        yield from self.cidrs.items()
+        yield from self.patterns.items()
+
+    @property
+    def patterns(self) -> PatternMatcher:
+        if self._patterns is None:
+            self._patterns = PatternMatcher(self.pattern_rules)
+        return self._patterns
+
+    def add_keyword(self, keyword: str, rule: Rule):
+        self.pattern_rules.append(('keyword', keyword, rule))
+        self._patterns = None
+
+    def add_regexp(self, regexp: str, rule: Rule):
+        self.pattern_rules.append(('regexp', regexp, rule))
+        self._patterns = None
+
+    @property
+    def cidrs(self) -> CIDRIndex:
+        if self._cidrs is None:
+            self._cidrs = CIDRIndex.from_networks(self.networks)
+        return self._cidrs
+
+    def add_cidr(self, cidr: str, rule: Rule):
+        net = ipaddress.ip_network(cidr, strict=False)
+        self.networks.append((net, rule))
+        self._cidrs = None
+
+    def get_ip(self, version: int, ip: int) -> Optional[Rule]:
+        return self.cidrs.get(version, ip)
+
+    def add(self, domain: str, rule: Rule) -> bool:
+        depth = domain.count('.') + 1
+        table = self.tables.get(depth)
+        if table is None:
+            table = self.tables[depth] = dict()
+            self.depths = sorted(self.tables, reverse=True)
+        if domain in table:
+            return False
+        table[domain] = rule
+        return True
+
+    def add_full(self, domain: str, rule: Rule) -> bool:
+        if domain in self.fulls:
+            return False
+        self.fulls[domain] = rule
+        return True
+
+    def get(self, domain: str) -> Optional[Rule]:
+        rule = self.fulls.get(domain)
+        if rule is not None:
+            return rule
+        rule = self.get_suffix(domain)
+        if rule is not None:
+            return rule
+        return self.patterns.get(domain)
+
+    def get_suffix(self, domain: str) -> Optional[Rule]:
+        if len(self.depths) == 0:
+            return None
+        starts = suffix_starts(domain, self.depths[0])
+        for depth in self.depths:
+            if depth >= len(starts):
+                continue
+            rule = self.tables[depth].get(domain[starts[depth]:])
+            if rule is not None:
+                return rule
+        return None
+
+    def dump(self, path: str):
+        items: dict[int, int] = dict()
+        for table in self.tables.values():
+            for domain, rule in table.items():
+                items.setdefault(rule_hash(domain), rule.value)
+        hashes = sorted(items)
+        codes = [items[h] for h in hashes]
+        fulls: dict[int, int] = dict()
+        for domain, rule in self.fulls.items():
+            fulls.setdefault(rule_hash(domain), rule.value)
+        full_hashes = sorted(fulls)
+        full_codes = [fulls[h] for h in full_hashes]
+        write_index(
+            path, {
+                b'DPTH': array('B', self.depths).tobytes(),
+                b'HASH': index_bytes(array('Q', hashes)),
+                b'RULE': array('B', codes).tobytes(),
+                b'FHSH': index_bytes(array('Q', full_hashes)),
+                b'FRUL': array('B', full_codes).tobytes(),
+                **self.cidrs.sections(),
+                **self.patterns.sections(),
+            })
+
+
+class MappedRuleIndex:
+    """Read-only RuleIndex backed by a memory-mapped binary index.
+
+    Suffixes and full domains are stored as sorted 64-bit hashes with a
+    parallel array of rule codes each, and looked up by bisection directly
+    in the mapped pages, so processes mapping the same file share them.
+    """
+    mmap: mmap.mmap
+    depths: list[int]
+    hashes: Sequence[int]
+    codes: Sequence[int]
+    full_hashes: Sequence[int]
+    full_codes: Sequence[int]
+    cidrs: CIDRIndex
+    patterns: PatternMatcher
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        sections = read_index(memoryview(self.mmap))
+        empty = memoryview(b'')
+        self.depths = list(sections.get(b'DPTH', empty))
+        self.hashes = index_array(sections.get(b'HASH', empty), 'Q')
+        self.codes = index_array(sections.get(b'RULE', empty), 'B')
+        self.full_hashes = index_array(sections.get(b'FHSH', empty), 'Q')
+        self.full_codes = index_array(sections.get(b'FRUL', empty), 'B')
+        self.cidrs = CIDRIndex.from_sections(sections)
+        self.patterns = PatternMatcher.from_sections(sections)
+
+    def __len__(self) -> int:
+        return len(self.hashes) + len(self.full_hashes) + \
+            len(self.cidrs) + len(self.patterns)
+
+    def items(self) -> Iterator[tuple[Hashable, int]]:
+        yield from zip(self.hashes, self.codes)
+        for h, code in zip(self.full_hashes, self.full_codes):
+            yield ('full', h), code
+        yield from self.cidrs.items()
+        yield from self.patterns.items()
+
+    def get_ip(self, version: int, ip: int) -> Optional[Rule]:
+        return self.cidrs.get(version, ip)
+
+    def get(self, domain: str) -> Optional[Rule]:
+        rule = self.get_full(domain)
+        if rule is not None:
+            return rule
+        rule = self.get_suffix(domain)
+        if rule is not None:
+            return rule
+        return self.patterns.get(domain)
+
+    def get_full(self, domain: str) -> Optional[Rule]:
+        hashes = self.full_hashes
+        if len(hashes) == 0:
+            return None
+        h = rule_hash(domain)
+        i = bisect.bisect_left(hashes, h)
+        if i < len(hashes) and hashes[i] == h:
+            return Rule(self.full_codes[i])
+        return None
+
+    def get_suffix(self, domain: str) -> Optional[Rule]:
+        if len(self.depths) == 0:
+            return None
+        hashes = self.hashes
+        starts = suffix_starts(domain, self.depths[0])
+        for depth in self.depths:
+            if depth >= len(starts):
+                continue
+            h = rule_hash(domain[starts[depth]:])
+            i = bisect.bisect_left(hashes, h)
+            if i < len(hashes) and hashes[i] == h:
+                return Rule(self.codes[i])
+        return None
+
+
+AnyRuleIndex = Union[RuleIndex, MappedRuleIndex]
+
+
+def count_changed_rules(old: Optional[AnyRuleIndex], new: AnyRuleIndex) -> int:
+    if old is None:
+        return len(new)
+    old_items = dict(old.items())
+    changed = 0
+    for h, code in new.items():
+        if old_items.pop(h, None) != code:
+            changed += 1
+    return changed + len(old_items)
+
+
 class RuleMatcher:
     rules_default: Rule
     rules_file: str
-    rules: Optional[dict[str, Rule]]
+    rules_index: str
+    rules_reload_interval: float
+    rules: Optional[AnyRuleIndex]
+    rules_stamp: tuple[Optional[float], Optional[float]]
+    cache: LRUCache[str, Rule]
 
     logger = logging.getLogger('rule_matcher')
 
     def __init__(self,
                  rules_default: str = RULES_DEFAULT,
-                 rules_file: str = RULES_FILE):
+                 rules_file: str = RULES_FILE,
+                 rules_index: str = RULES_INDEX,
+                 rules_cache_size: int = RULES_CACHE_SIZE,
+                 rules_reload_interval: float = RULES_RELOAD_INTERVAL):
         self.rules_default = Rule.from_str(rules_default)
         self.rules_file = rules_file
+        self.rules_index = rules_index
+        self.rules_reload_interval = rules_reload_interval
         self.rules = None
+        self.rules_stamp = (None, None)
+        self.cache = LRUCache(rules_cache_size)
 
     def load_rules(self):
-        if not os.path.exists(self.rules_file):
+        start = time.perf_counter()
+        self.rules_stamp = self.get_rules_stamp()
+        res = self.build_rules()
+        if res is None:
             self.logger.warning('rules file not exists')
             return
-        self.rules = dict()
+        rules, path = res
+        self.rules = rules
+        self.cache.clear()
+        self.logger.info('load %d rules from %s in %.3fs', len(rules), path,
+                         time.perf_counter() - start)
+
+    async def reload_rules(self):
+        start = time.perf_counter()
+        self.rules_stamp = self.get_rules_stamp()
+        old_rules = self.rules
+
+        def build() -> Optional[tuple[AnyRuleIndex, str, int]]:
+            res = self.build_rules()
+            if res is None:
+                return None
+            rules, path = res
+            return rules, path, count_changed_rules(old_rules, rules)
+
+        loop = asyncio.get_running_loop()
+        try:
+            res = await loop.run_in_executor(None, build)
+        except Exception as e:
+            self.logger.warning('except while reloading rules: %s', e)
+            return
+        if res is None:
+            self.logger.warning('rules file not exists, keep old rules')
+            return
+        rules, path, changed = res
+        # swap within one loop step, dispatches never see a stale cache
+        self.rules = rules
+        self.cache.clear()
+        self.logger.info('reload %d rules (%d changed) from %s in %.3fs',
+                         len(rules), changed, path,
+                         time.perf_counter() - start)
+
+    async def watch_rules(self):
+        """Reload rules on SIGHUP or when the rules files change."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, event.set)
+        except (NotImplementedError, RuntimeError, AttributeError):
+            pass
+        interval = self.rules_reload_interval \
+            if self.rules_reload_interval > 0 else None
+        while True:
+            try:
+                await asyncio.wait_for(event.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            forced = event.is_set()
+            event.clear()
+            if forced or self.get_rules_stamp() != self.rules_stamp:
+                await self.reload_rules()
+
+    def get_rules_stamp(self) -> tuple[Optional[float], Optional[float]]:
+
+        def mtime(path: str) -> Optional[float]:
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return None
+
+        return mtime(self.rules_file), mtime(self.rules_index)
+
+    def build_rules(self) -> Optional[tuple[AnyRuleIndex, str]]:
+        if self.index_usable():
+            return MappedRuleIndex(self.rules_index), self.rules_index
+        if os.path.exists(self.rules_file):
+            return self.parse_rules(), self.rules_file
+        return None
+
+    def index_usable(self) -> bool:
+        if len(self.rules_index) == 0 or \
+           not os.path.exists(self.rules_index):
+            return False
+        if not os.path.exists(self.rules_file):
+            return True
+        return os.path.getmtime(self.rules_index) >= \
+            os.path.getmtime(self.rules_file)
+
+    def parse_rules(self) -> RuleIndex:
+        rules = RuleIndex()
         with open(self.rules_file) as f:
             for line in f:
                 line = line.strip()
                 if len(line) == 0 or line[0] == '#':
                     continue
                 try:
-                    rule, domain = line.split(maxsplit=1)
-                    if domain not in self.rules:
-                        self.rules[domain] = Rule.from_str(rule)
+                    rule, target = line.split(maxsplit=1)
+                    kind, sep, value = target.partition(':')
+                    if not sep:
+                        rules.add(target, Rule.from_str(rule))
+                    elif kind == 'domain':
+                        rules.add(value, Rule.from_str(rule))
+                    elif kind == 'full':
+                        rules.add_full(value, Rule.from_str(rule))
+                    elif kind == 'keyword':
+                        rules.add_keyword(value, Rule.from_str(rule))
+                    elif kind == 'regexp':
+                        rules.add_regexp(value, Rule.from_str(rule))
+                    elif kind == 'ip-cidr':
+                        rules.add_cidr(value, Rule.from_str(rule))
+                    else:
+                        raise ValueError('unknown rule type')
                 except Exception as e:
                     self.logger.warning('except while loading rule %s: %s',
                                         line, e)
+        if len(rules.networks) != 0:
+            self.logger.debug('flatten %d networks to %d ranges',
+                              len(rules.networks), len(rules.cidrs))
+        if len(rules.pattern_rules) != 0:
+            self.logger.debug('compile %d patterns', len(rules.patterns))
+        return rules
+
+    def compile_rules(self):
+        rules = self.parse_rules()
+        rules.dump(self.rules_index)
+        self.logger.info('compile %d rules to %s', len(rules),
+                         self.rules_index)
 
-    @functools.cache
     def match(self, domain: str) -> Rule:
+        rule = self.cache.get(domain)
+        if rule is None:
+            rule = self.match_uncached(domain)
+            self.cache.put(domain, rule)
+            if self.cache.misses % RULES_CACHE_REPORT == 0:
+                self.logger.info('match cache %s', self.cache)
+        return rule
+
+    def match_uncached(self, domain: str) -> Rule:
         if self.rules is None:
             return self.rules_default
-        rule = self.rules.get(domain)
+        ip = parse_ip(domain)
+        if ip is not None:
+            rule = self.rules.get_ip(*ip)
+        else:
+            rule = self.rules.get(domain)
         if rule is not None:
             return rule
-        sp = domain.split('.', 1)
-        if len(sp) > 1:
-            return self.match(sp[1])
         return self.rules_default
@@ -0,0 +1,56 @@
+import asyncio
+
+from typing import TypeVar, Optional
+from collections.abc import Callable, Awaitable, Sequence
+
+T = TypeVar('T')
+
+
+async def staggered_race(
+    factories: Sequence[Callable[[], Awaitable[T]]],
+    delay: Optional[float],
+    cleanup: Optional[Callable[[T], Awaitable]] = None,
+) -> tuple[int, T]:
+    """Race the awaitables made by factories, the next one is started after
+    delay or as soon as all running ones failed, as happy eyeballs do. A
+    delay of None tries them one after another.
+
+    Return the index and result of the first to succeed, or raise the
+    exception of the first attempt if all of them failed. The others are
+    cancelled, results they produced anyway are passed to cleanup.
+    """
+    if len(factories) == 0:
+        raise ValueError('nothing to race')
+    tasks: list[asyncio.Future[T]] = []
+    winner: Optional[asyncio.Future[T]] = None
+    try:
+        pending: set[asyncio.Future[T]] = set()
+        while True:
+            if len(tasks) < len(factories):
+                task = asyncio.ensure_future(factories[len(tasks)]())
+                tasks.append(task)
+                pending.add(task)
+            if len(pending) == 0:
+                exc = tasks[0].exception()
+                assert exc is not None
+                raise exc
+            timeout = delay if len(tasks) < len(factories) else None
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task in done and task.exception() is None:
+                    winner = task
+                    return tasks.index(task), task.result()
+    finally:
+        losers = [task for task in tasks if task is not winner]
+        for task in losers:
+            task.cancel()
+        results = await asyncio.gather(*losers, return_exceptions=True)
+        if cleanup is not None:
+            for task, result in zip(losers, results):
+                if task.cancelled() or task.exception() is not None:
+                    continue
+                try:
+                    await cleanup(result)
+                except Exception:
+                    pass
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the hot paths of proxy.
+
+```
+PYTHONPATH=. ./scripts/bench.py ws-mask parser loop vmess vmess-offload \
+    vmess-handshake vmess-mux
+```
+"""
+
+import argparse
+import asyncio
+import hmac
+import logging
+import random
+import re
+import socket
+import statistics
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from hashlib import md5
+
+from cryptography.hazmat.primitives.ciphers import Cipher
+from cryptography.hazmat.primitives.ciphers.algorithms import AES
+from cryptography.hazmat.primitives.ciphers.modes import CFB
+
+from proxy import (
+    ProxyServer,
+    ProxyDispatcher,
+    RuleMatcher,
+    HTTPAcceptor,
+    TCPConnector,
+    WrappedConnector,
+    BaseConnector,
+    BaseConnection,
+)
+from proxy.acceptors.parser import HTTPRequestParser, Socks5Parser
+from proxy.connections.ws import ws_mask
+from vmessc.connector import VMESS_CMD_MUX, VmessConnector
+from vmessc.connection import (
+    VMESS_SECURITIES,
+    VmessCryptor,
+    VmessChunkDecoder,
+    VmessConnection,
+)
+from vmessc.mux import (
+    MUX_STATUS_KEEP,
+    MUX_STATUS_END,
+    MuxFrameDecoder,
+    MuxConnector,
+    mux_frame,
+)
+
+benches: dict[str, Callable[[argparse.Namespace], None]] = dict()
+
+
+def bench(name: str):
+
+    def register(func: Callable[[argparse.Namespace], None]):
+        benches[name] = func
+        return func
+
+    return register
+
+
+def timeit(func: Callable[[], object], duration: float = 1.0) -> float:
+    """Return seconds per call of func, repeated for about duration."""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return elapsed / count
+
+
+def fmt_size(size: int) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024 or unit == 'MB':
+            return f'{size}{unit}'
+        size //= 1024
+    raise ValueError
+
+
+@bench('ws-mask')
+def bench_ws_mask(args: argparse.Namespace):
+
+    def ws_mask_bytewise(buf: bytes, mask: bytes) -> bytes:
+        return bytes(c ^ mask[i % 4] for i, c in enumerate(buf))
+
+    mask = random.randbytes(4)
+    for size in (4096, 65536, 1048576):
+        buf = random.randbytes(size)
+        assert ws_mask(buf, mask) == ws_mask_bytewise(buf, mask)
+        for name, func in (('bytewise', ws_mask_bytewise),
+                           ('ws_mask', ws_mask)):
+            t = timeit(lambda: func(buf, mask), args.duration)
+            print(f'{name:>10} {fmt_size(size):>6} '
+                  f'{size / t / 1048576:10.1f} MB/s')
+
+
+@bench('parser')
+def bench_parser(args: argparse.Namespace):
+    req_re = re.compile(r'^(\w+) [^ ]+ (HTTP/[^ \r\n]+)\r\n')
+    host_re = re.compile(
+        r'\r\nHost: ([^ :\[\]\r\n]+|\[[:0-9a-fA-F]+\])(:([0-9]+))?')
+
+    def parse_regex(buf: bytes) -> tuple[str, int, bytes]:
+        headers_bytes, unwrite = buf.split(b'\r\n\r\n', 1)
+        headers = headers_bytes.decode()
+        req = req_re.search(headers)
+        host = host_re.search(headers)
+        assert req is not None and host is not None
+        port = 80 if host[3] is None else int(host[3])
+        if req[1] != 'CONNECT':
+            headers = '\r\n'.join(header
+                                  for header in headers.split('\r\n')
+                                  if not header.startswith('Proxy-'))
+            unwrite = headers.encode() + b'\r\n\r\n' + unwrite
+        return host[1], port, unwrite
+
+    def parse_http(chunks: list[bytes]) -> tuple[str, int, bytes]:
+        # as HTTPAcceptor does
+        connect = HTTPRequestParser.parse_connect(chunks[0])
+        if connect is not None:
+            return connect[0], connect[1], connect[3]
+        parser = HTTPRequestParser()
+        for chunk in chunks:
+            if parser.feed(chunk):
+                break
+        if parser.method == b'CONNECT':
+            return parser.addr, parser.port, parser.rest
+        return parser.addr, parser.port, parser.request()
+
+    def parse_socks5(chunks: list[bytes]) -> tuple[str, int, bytes]:
+        parser = Socks5Parser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        return parser.addr, parser.port, parser.rest
+
+    connect = (b'CONNECT example.com:443 HTTP/1.1\r\n'
+               b'Host: example.com:443\r\n'
+               b'User-Agent: Mozilla/5.0\r\n'
+               b'Proxy-Connection: keep-alive\r\n\r\n')
+    get = (b'GET http://example.com/index.html HTTP/1.1\r\n'
+           b'Host: example.com\r\n'
+           b'User-Agent: Mozilla/5.0\r\n'
+           b'Accept: text/html,application/xhtml+xml\r\n'
+           b'Accept-Language: en-US,en;q=0.5\r\n'
+           b'Cookie: ' + b'k=v; ' * 800 + b'\r\n'
+           b'Proxy-Connection: keep-alive\r\n'
+           b'Proxy-Authorization: Basic dXNlcjpwYXNz\r\n\r\n')
+    for name, buf in (('connect', connect), ('get', get)):
+        assert parse_regex(buf) == parse_http([buf])
+        for label, func in (
+            ('regex', lambda: parse_regex(buf)),
+            ('parser', lambda: parse_http([buf])),
+        ):
+            t = timeit(func, args.duration)
+            print(f'{name:>10} {fmt_size(len(buf)):>6} {label:>10} '
+                  f'{1 / t:12.0f} req/s')
+        # the regex path cannot take a header split over reads
+        chunks = [buf[i:i + 536] for i in range(0, len(buf), 536)]
+        t = timeit(lambda: parse_http(chunks), args.duration)
+        print(f'{name:>10} {fmt_size(len(buf)):>6} {"split":>10} '
+              f'{1 / t:12.0f} req/s')
+    socks5 = [b'\x05\x01\x00', b'\x05\x01\x00\x03\x0bexample.com\x01\xbb']
+    t = timeit(lambda: parse_socks5(socks5), args.duration)
+    print(f'{"socks5":>10} {fmt_size(sum(map(len, socks5))):>6} '
+          f'{"parser":>10} {1 / t:12.0f} req/s')
+
+
+async def echo_relay(duration: float) -> tuple[float, float]:
+    """Return connections/s and MB/s of an echo server behind a proxy
+    server, all on the running loop."""
+
+    async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while len(buf := await reader.read(262144)) != 0:
+                writer.write(buf)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    echo_server = await asyncio.start_server(echo, '127.0.0.1', 0)
+    echo_port = echo_server.sockets[0].getsockname()[1]
+    with socket.create_server(('127.0.0.1', 0)) as sock:
+        proxy_port = sock.getsockname()[1]
+    rule_matcher = RuleMatcher(rules_file='', rules_index='')
+    dispatcher = ProxyDispatcher(rule_matcher=rule_matcher, connectors=[])
+    proxy_server = ProxyServer(acceptor=HTTPAcceptor(),
+                               dispatcher=dispatcher,
+                               server_addr='127.0.0.1',
+                               server_port=proxy_port)
+    server_task = asyncio.create_task(proxy_server.start_server())
+    await asyncio.sleep(0.1)
+
+    async def connect() -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       proxy_port)
+        host = f'127.0.0.1:{echo_port}'
+        writer.write(f'CONNECT {host} HTTP/1.1\r\nHost: {host}\r\n\r\n'
+                     .encode())
+        await reader.readuntil(b'\r\n\r\n')
+        return reader, writer
+
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        reader, writer = await connect()
+        writer.write(b'x')
+        await reader.readexactly(1)
+        writer.close()
+        await writer.wait_closed()
+        count += 1
+    conns = count / (time.perf_counter() - start)
+
+    reader, writer = await connect()
+    chunk = random.randbytes(65536)
+
+    async def send():
+        while not writer.is_closing():
+            writer.write(chunk)
+            await writer.drain()
+
+    send_task = asyncio.create_task(send())
+    size = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        size += len(await reader.read(262144))
+    rate = size / (time.perf_counter() - start) / 1048576
+    send_task.cancel()
+    writer.close()
+    await writer.wait_closed()
+    # let the relay wind down before the runner cancels what is left
+    await asyncio.sleep(0.2)
+    server_task.cancel()
+    echo_server.close()
+    return conns, rate
+
+
+@bench('loop')
+def bench_loop(args: argparse.Namespace):
+    for loop_type in ('asyncio', 'uvloop'):
+        loop_factory = ProxyServer.get_loop_factory(loop_type)
+        if loop_type != 'asyncio' and loop_factory is None:
+            continue
+        conns, rate = ProxyServer.run_main(echo_relay(args.duration),
+                                           loop_factory)
+        print(f'{loop_type:>10} {conns:10.1f} conn/s {rate:10.1f} MB/s')
+
+
+async def vmess_server(
+    user: uuid.UUID,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+):
+    """Stand-in of a vmess server, echoing the stream."""
+    try:
+        auth = await reader.readexactly(16)
+        now = int(time.time())
+        for ts in range(now - 120, now + 121):
+            tsb = ts.to_bytes(8, 'big')
+            if hmac.digest(user.bytes, tsb, 'md5') == auth:
+                break
+        else:
+            raise RuntimeError('invalid auth')
+        req_key = md5(user.bytes + VmessConnector.REQ_KEY_SUFFIX).digest()
+        decryptor = Cipher(AES(req_key), CFB(md5(4 * tsb).digest())) \
+            .decryptor()
+        req = decryptor.update(await reader.readexactly(38))
+        iv, key, rv, plen = req[1:17], req[17:33], req[33], req[35] >> 4
+        mux = req[37] == VMESS_CMD_MUX
+        if not mux:
+            req += decryptor.update(await reader.readexactly(4))
+            req += decryptor.update(await reader.readexactly(req[41]))
+        req += decryptor.update(await reader.readexactly(plen + 4))
+        if VmessConnector.fnv32a(req[:-4]) != req[-4:]:
+            raise RuntimeError('invalid header')
+        security = {code: name
+                    for name, code in VMESS_SECURITIES.items()}[req[35] & 0xf]
+        rkey, riv = md5(key).digest(), md5(iv).digest()
+        encryptor = Cipher(AES(rkey), CFB(riv)).encryptor()
+        writer.write(encryptor.update(bytes((rv, 0, 0, 0))))
+        decoder = VmessChunkDecoder(VmessCryptor(key, iv[2:12], security))
+        sealer = VmessCryptor(rkey, riv[2:12], security)
+        frames = MuxFrameDecoder()
+        while not decoder.eof and \
+                len(buf := await reader.read(262144)) != 0:
+            decoder.feed(buf)
+            buf = decoder.decode()
+            if mux:
+                # echoed per stream, ended streams are ended back
+                frames.feed(buf)
+                buf = b''.join(
+                    mux_frame(sid, MUX_STATUS_KEEP, data) if
+                    status != MUX_STATUS_END else mux_frame(sid, status)
+                    for sid, status, _, data in frames.take())
+            if len(buf) != 0:
+                writer.write(sealer.seal(buf))
+                await writer.drain()
+        writer.write(sealer.seal_eof())
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    writer.close()
+
+
+async def vmess_echo(duration: float, security: str) -> float:
+    """Return MB/s echoed by a vmess stand-in server."""
+    user = uuid.uuid4()
+    server = await asyncio.start_server(
+        lambda reader, writer: vmess_server(user, reader, writer),
+        '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    connector = VmessConnector(base_connector=WrappedConnector(
+        TCPConnector(), '127.0.0.1', port, pool_size=0),
+                               uuid=user,
+                               security=security)
+    conn = await connector.connect_to('example.com', 80, b'ping')
+    assert await conn.read() == b'ping'
+    chunk = random.randbytes(65536)
+
+    async def send():
+        while True:
+            await conn.write(chunk)
+
+    send_task = asyncio.create_task(send())
+    size = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        size += len(await conn.read())
+    rate = size / (time.perf_counter() - start) / 1048576
+    send_task.cancel()
+    await conn.close()
+    server.close()
+    return rate
+
+
+@bench('vmess')
+def bench_vmess(args: argparse.Namespace):
+    key, iv = random.randbytes(16), random.randbytes(10)
+    for security in VMESS_SECURITIES:
+        for size in (4096, 65536, 1048576):
+            buf = random.randbytes(size)
+            sealer = VmessCryptor(key, iv, security)
+            decoder = VmessChunkDecoder(VmessCryptor(key, iv, security))
+
+            def codec():
+                decoder.feed(sealer.seal(buf))
+                assert len(decoder.decode()) == size
+
+            t = timeit(codec, args.duration)
+            print(f'{security:>18} {"codec":>6} {fmt_size(size):>6} '
+                  f'{size / t / 1048576:10.1f} MB/s')
+        rate = asyncio.run(vmess_echo(args.duration, security))
+        print(f'{security:>18} {"echo":>6} {"":>6} {rate:10.1f} MB/s')
+    start = time.perf_counter()
+    security = VmessCryptor.fastest_security()
+    print(f'{"auto":>18} {security} in '
+          f'{(time.perf_counter() - start) * 1000:.0f} ms')
+
+
+async def vmess_lag(duration: float, security: str,
+                    port: int, user: uuid.UUID) -> tuple[float, list[float]]:
+    """Return MB/s echoed by the vmess server at port and how late 1ms
+    sleeps of the loop woke up meanwhile."""
+    connector = VmessConnector(base_connector=WrappedConnector(
+        TCPConnector(), '127.0.0.1', port, pool_size=0),
+                               uuid=user,
+                               security=security)
+    conn = await connector.connect_to('example.com', 80)
+    chunk = random.randbytes(262144)
+
+    async def send():
+        while True:
+            await conn.write(chunk)
+
+    async def receive():
+        nonlocal size
+        while True:
+            size += len(await conn.read())
+
+    size = 0
+    lags: list[float] = []
+    tasks = [asyncio.create_task(send()), asyncio.create_task(receive())]
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        tick = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - tick - 0.001)
+    rate = size / (time.perf_counter() - start) / 1048576
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await conn.close()
+    return rate, lags
+
+
+@bench('vmess-offload')
+def bench_vmess_offload(args: argparse.Namespace):
+    user = uuid.uuid4()
+    # the server runs in a thread of its own, only the client is measured
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(
+        lambda reader, writer: vmess_server(user, reader, writer),
+        '127.0.0.1', 0))
+    port = server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    for security in VMESS_SECURITIES:
+        for threads in (0, 2):
+            VmessConnection.set_offload(threads)
+            rate, lags = asyncio.run(
+                vmess_lag(args.duration, security, port, user))
+            lags.sort()
+            p99 = lags[int(len(lags) * 0.99)]
+            print(f'{security:>18} threads {threads} {rate:8.1f} MB/s '
+                  f'lag p50 {statistics.median(lags) * 1000:.2f} '
+                  f'p99 {p99 * 1000:.2f} max {lags[-1] * 1000:.2f} ms')
+    VmessConnection.set_offload(0)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+@bench('vmess-handshake')
+def bench_vmess_handshake(args: argparse.Namespace):
+    connector = VmessConnector(base_connector=WrappedConnector(
+        TCPConnector(), '127.0.0.1', 0, pool_size=0),
+                               uuid=uuid.uuid4())
+    key, iv = random.randbytes(16), random.randbytes(16)
+
+    def uncached():
+        # as if every request fell into a second of its own
+        connector.ts_cache = None
+        connector.get_req('example.com', 443, key, iv, 0)
+
+    def cached():
+        connector.get_req('example.com', 443, key, iv, 0)
+
+    for name, func in (('uncached', uncached), ('cached', cached)):
+        t = timeit(func, args.duration)
+        print(f'{name:>10} {1 / t:10.0f} req/s {t * 1e6:6.1f} us')
+    header = random.randbytes(60)
+    t = timeit(lambda: VmessConnector.fnv32a(header), args.duration)
+    print(f'{"fnv32a":>10} {fmt_size(len(header)):>10} {t * 1e6:10.1f} us')
+
+
+async def vmess_tunnels(connector: BaseConnector, count: int,
+                        duration: float) -> tuple[float, float, float]:
+    """Return the seconds to open count tunnels and echo a ping over each,
+    the MB/s of a bulk echo and the median ping while it runs."""
+    start = time.perf_counter()
+
+    async def ping_once() -> BaseConnection:
+        conn = await connector.connect_to('example.com', 80, b'ping')
+        assert await conn.read() == b'ping'
+        return conn
+
+    conns = await asyncio.gather(*(ping_once() for _ in range(count)))
+    opened = time.perf_counter() - start
+    for conn in conns[1:]:
+        await conn.close()
+    ping_conn = conns[0]
+    bulk = await connector.connect_to('example.com', 80)
+    chunk = random.randbytes(65536)
+
+    async def send():
+        while True:
+            await bulk.write(chunk)
+
+    async def receive():
+        nonlocal size
+        while True:
+            size += len(await bulk.read())
+
+    size = 0
+    tasks = [asyncio.create_task(send()), asyncio.create_task(receive())]
+    pings = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        sent = time.perf_counter()
+        await ping_conn.write(b'ping')
+        assert await ping_conn.read() == b'ping'
+        pings.append(time.perf_counter() - sent)
+    rate = size / (time.perf_counter() - start) / 1048576
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await ping_conn.close()
+    await bulk.close()
+    return opened, rate, statistics.median(pings)
+
+
+@bench('vmess-mux')
+def bench_vmess_mux(args: argparse.Namespace):
+
+    async def run(mux: bool) -> tuple[int, float, float, float]:
+        user = uuid.uuid4()
+        sessions = 0
+
+        async def serve(reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter):
+            nonlocal sessions
+            sessions += 1
+            await vmess_server(user, reader, writer)
+
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        connector: BaseConnector = VmessConnector(
+            base_connector=WrappedConnector(TCPConnector(), '127.0.0.1',
+                                            port, pool_size=0),
+            uuid=user)
+        if mux:
+            connector = MuxConnector(connector)
+        res = await vmess_tunnels(connector, 50, args.duration)
+        if isinstance(connector, MuxConnector):
+            for session in list(connector.sessions):
+                session.close()
+        # the stand-in servers see the connections closed
+        await asyncio.sleep(0.1)
+        server.close()
+        return (sessions, *res)
+
+    for mux in (False, True):
+        sessions, opened, rate, ping = asyncio.run(run(mux))
+        print(f'{"mux" if mux else "direct":>8} 50 tunnels in '
+              f'{opened * 1000:5.1f} ms over {sessions:2} connections, '
+              f'bulk {rate:6.1f} MB/s ping {ping * 1000:5.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--duration', type=float, default=1.0)
+    parser.add_argument('names', nargs='*', metavar='|'.join(benches))
+    args = parser.parse_args()
+
+    logging.basicConfig(level='ERROR')
+    for name in args.names:
+        if name not in benches:
+            parser.error(f'unknown bench {name}')
+    for name in args.names or benches:
+        print(f'# {name}')
+        benches[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 """
 Merge https://github.com/v2fly/domain-list-community to one single file.
-The four type: domain, full, keyword and regexp, only support domain and full.
+The four type: domain, full, keyword and regexp are all supported.
 Multi-tags syntax is not supported. (So far it doesn't seem to be used.)
+CIDR list files (one network per line, e.g. a china ip list) can be given
+with -c and are emitted as direct ip-cidr rules.
 """
 
 import argparse
@@ -10,9 +12,11 @@ import re
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-d', '--datapath', default='domain-list-community/data')
+parser.add_argument('-c', '--cidr-files', action='append', default=[])
 args = parser.parse_args()
 
 datapath = args.datapath
+cidr_files = args.cidr_files
 
 tag2rule = {
     'ads': 'block',
@@ -32,11 +36,24 @@ def load_rule(rule_file: str, default_tag: str):
         target = res[3]
         tag = res[5] or default_tag
         rule = tag2rule[tag]
-        if command in ('domain', 'full'):
+        if command == 'domain':
             print(f'{rule}\t{target}')
+        elif command in ('full', 'keyword', 'regexp'):
+            print(f'{rule}\t{command}:{target}')
         elif command == 'include':
             load_rule(target, default_tag)
 
 
+def load_cidr(cidr_file: str, tag: str):
+    rule = tag2rule[tag]
+    for line in open(cidr_file):
+        line = line.strip()
+        if len(line) == 0 or line[0] == '#':
+            continue
+        print(f'{rule}\tip-cidr:{line}')
+
+
 load_rule('cn', 'cn')
 load_rule('geolocation-!cn', '!cn')
+for cidr_file in cidr_files:
+    load_cidr(cidr_file, 'cn')
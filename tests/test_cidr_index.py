@@ -0,0 +1,131 @@
+import random
+import ipaddress
+
+from proxy.rulematcher import (
+    Rule,
+    CIDRIndex,
+    RuleIndex,
+    MappedRuleIndex,
+    RuleMatcher,
+    parse_ip,
+)
+
+
+def lookup(index, addr):
+    return index.get(*parse_ip(addr))
+
+
+def reference(networks, addr):
+    """Rule of the most specific network holding addr, the first of equal
+    networks."""
+    ip = ipaddress.ip_address(addr)
+    best = None
+    for net, rule in networks:
+        if ip in net and (best is None or net.prefixlen > best[0].prefixlen):
+            best = (net, rule)
+    return best[1] if best is not None else None
+
+
+def test_nested_networks():
+    index = RuleIndex()
+    index.add_cidr('10.0.0.0/8', Rule.Direct)
+    index.add_cidr('10.1.0.0/16', Rule.Forward)
+    index.add_cidr('10.1.2.0/24', Rule.Block)
+    index.add_cidr('10.0.0.0/8', Rule.Block)
+    cidrs = index.cidrs
+    assert lookup(cidrs, '10.0.0.1') is Rule.Direct
+    assert lookup(cidrs, '10.1.0.0') is Rule.Forward
+    assert lookup(cidrs, '10.1.2.255') is Rule.Block
+    assert lookup(cidrs, '10.1.3.0') is Rule.Forward
+    assert lookup(cidrs, '10.255.255.255') is Rule.Direct
+    assert lookup(cidrs, '11.0.0.0') is None
+    assert lookup(cidrs, '9.255.255.255') is None
+    # the outer network is split around the inner ones
+    assert len(cidrs) == 5
+
+
+def test_adjacent_ranges_merge():
+    index = CIDRIndex.from_networks([
+        (ipaddress.ip_network('192.168.0.0/24'), Rule.Direct),
+        (ipaddress.ip_network('192.168.1.0/24'), Rule.Direct),
+        (ipaddress.ip_network('192.168.2.0/24'), Rule.Forward),
+    ])
+    assert len(index) == 2
+    assert lookup(index, '192.168.1.7') is Rule.Direct
+    assert lookup(index, '192.168.2.7') is Rule.Forward
+
+
+def test_ipv6():
+    index = RuleIndex()
+    index.add_cidr('2001:db8::/32', Rule.Forward)
+    index.add_cidr('2001:db8:1::/48', Rule.Direct)
+    index.add_cidr('0.0.0.0/0', Rule.Block)
+    cidrs = index.cidrs
+    assert lookup(cidrs, '2001:db8::1') is Rule.Forward
+    assert lookup(cidrs, '2001:db8:1:ffff::1') is Rule.Direct
+    assert lookup(cidrs, '2001:db9::') is None
+    assert lookup(cidrs, '::ffff:1.2.3.4') is None
+    assert lookup(cidrs, '1.2.3.4') is Rule.Block
+
+
+def test_random_against_reference():
+    rand = random.Random(4)
+    networks = []
+    for _ in range(300):
+        prefix = rand.randint(8, 28)
+        net = ipaddress.ip_network(
+            (rand.randrange(10 << 24, 12 << 24), prefix), strict=False)
+        networks.append((net, rand.choice(list(Rule))))
+    index = CIDRIndex.from_networks(networks)
+    addrs = [str(net.network_address + offset)
+             for net, _ in networks for offset in (0, 1)]
+    addrs += [str(net.broadcast_address + offset)
+              for net, _ in networks for offset in (0, 1)]
+    addrs += [str(ipaddress.ip_address(rand.randrange(10 << 24, 12 << 24)))
+              for _ in range(1000)]
+    for addr in addrs:
+        assert lookup(index, addr) is reference(networks, addr), addr
+
+
+def test_mapped_index(tmp_path):
+    index = RuleIndex()
+    index.add('example.com', Rule.Forward)
+    index.add_cidr('10.0.0.0/8', Rule.Direct)
+    index.add_cidr('10.1.0.0/16', Rule.Block)
+    index.add_cidr('fd00::/8', Rule.Forward)
+    path = str(tmp_path / 'rules.idx')
+    index.dump(path)
+    mapped = MappedRuleIndex(path)
+    assert sorted(mapped.cidrs.items()) == sorted(index.cidrs.items())
+    for addr in ('10.0.0.1', '10.1.0.1', '11.0.0.1', 'fd12::1', 'fe80::1'):
+        assert mapped.get_ip(*parse_ip(addr)) is \
+            index.get_ip(*parse_ip(addr)), addr
+    assert mapped.get('www.example.com') is Rule.Forward
+
+
+def test_full_rules(tmp_path):
+    index = RuleIndex()
+    index.add('example.com', Rule.Forward)
+    index.add_full('example.com', Rule.Block)
+    index.add_full('exact.org', Rule.Direct)
+    path = str(tmp_path / 'rules.idx')
+    index.dump(path)
+    mapped = MappedRuleIndex(path)
+    assert sorted(mapped.items(), key=repr) == \
+        sorted(index.items(), key=repr)
+    for rules in (index, mapped):
+        assert rules.get('example.com') is Rule.Block
+        assert rules.get('ads.example.com') is Rule.Forward
+        assert rules.get('exact.org') is Rule.Direct
+        assert rules.get('ads.exact.org') is None
+
+
+def test_parse_full_rules(tmp_path):
+    path = tmp_path / 'rules.txt'
+    path.write_text('block\tfull:example.com\nforward\tdomain:example.com\n')
+    matcher = RuleMatcher(rules_default='direct', rules_file=str(path),
+                          rules_index='')
+    matcher.load_rules()
+    assert matcher.match('example.com') is Rule.Block
+    assert matcher.match('www.example.com') is Rule.Forward
+    assert matcher.match('example.org') is Rule.Direct
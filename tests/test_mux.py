@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from vmessc.mux import (
+    MUX_STREAM_BUFFER,
+    MUX_STATUS_NEW,
+    MUX_STATUS_KEEP,
+    MUX_STATUS_END,
+    MUX_STATUS_KEEPALIVE,
+    MUX_OPTION_DATA,
+    MUX_OPTION_ERROR,
+    MuxFrameDecoder,
+    MuxConnector,
+    mux_frame,
+    mux_target,
+)
+
+FRAMES = [
+    (1, MUX_STATUS_NEW, MUX_OPTION_DATA, b'GET / HTTP/1.1\r\n\r\n'),
+    (2, MUX_STATUS_NEW, 0, b''),
+    (1, MUX_STATUS_KEEP, MUX_OPTION_DATA, bytes(range(256)) * 32),
+    (0, MUX_STATUS_KEEPALIVE, 0, b''),
+    (2, MUX_STATUS_END, MUX_OPTION_ERROR, b''),
+    (1, MUX_STATUS_END, 0, b''),
+]
+
+
+def encode(frames):
+    return b''.join(
+        mux_frame(sid, status, data, option & ~MUX_OPTION_DATA,
+                  mux_target('example.com', 80)
+                  if status == MUX_STATUS_NEW else b'')
+        for sid, status, option, data in frames)
+
+
+def test_frame_layout():
+    frame = mux_frame(5, MUX_STATUS_KEEP, b'abc')
+    assert frame == b'\x00\x04\x00\x05\x02\x01\x00\x03abc'
+    assert mux_frame(5, MUX_STATUS_END) == b'\x00\x04\x00\x05\x03\x00'
+
+
+@pytest.mark.parametrize('addr,port,target', [
+    ('example.com', 443, b'\x01\x01\xbb\x02\x0bexample.com'),
+    ('1.2.3.4', 80, b'\x01\x00\x50\x01\x01\x02\x03\x04'),
+    ('::1', 80, b'\x01\x00\x50\x03' + bytes(15) + b'\x01'),
+])
+def test_target(addr, port, target):
+    assert mux_target(addr, port) == target
+
+
+def test_decode_coalesced():
+    decoder = MuxFrameDecoder()
+    decoder.feed(encode(FRAMES))
+    assert decoder.take() == FRAMES
+    assert decoder.take() == []
+    assert len(decoder.buf) == 0
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 1000])
+def test_decode_split(size):
+    data = encode(FRAMES)
+    decoder = MuxFrameDecoder()
+    frames = []
+    for pos in range(0, len(data), size):
+        decoder.feed(data[pos:pos + size])
+        frames += decoder.take()
+    assert frames == FRAMES
+    assert len(decoder.buf) == 0
+
+
+def test_decode_keeps_partial_frame():
+    frame = mux_frame(3, MUX_STATUS_KEEP, b'payload')
+    decoder = MuxFrameDecoder()
+    # the metadata is complete, the data length and data are not
+    decoder.feed(frame + frame[:7])
+    assert decoder.take() == [(3, MUX_STATUS_KEEP, MUX_OPTION_DATA,
+                               b'payload')]
+    assert bytes(decoder.buf) == frame[:7]
+    decoder.feed(frame[7:])
+    assert decoder.take() == [(3, MUX_STATUS_KEEP, MUX_OPTION_DATA,
+                               b'payload')]
+
+
+def test_decode_invalid_metadata_size():
+    decoder = MuxFrameDecoder()
+    decoder.feed(b'\x00\x03\x00\x01\x02')
+    with pytest.raises(RuntimeError):
+        decoder.take()
+
+
+class PeerConnection:
+    """Mux connection end which reads what the test puts."""
+    reads: asyncio.Queue
+    nreads: int
+
+    def __init__(self):
+        self.reads = asyncio.Queue()
+        self.nreads = 0
+
+    async def read(self) -> bytes:
+        self.nreads += 1
+        return await self.reads.get()
+
+    async def write(self, buf: bytes):
+        pass
+
+    async def write_eof(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class PeerConnector:
+    conn: PeerConnection
+
+    def __init__(self):
+        self.conn = PeerConnection()
+
+    async def connect_mux(self, unwrite: bytes = b'') -> PeerConnection:
+        return self.conn
+
+
+def test_full_stream_does_not_hold_back_frames_read():
+    async def run():
+        peer = PeerConnector()
+        connector = MuxConnector(peer)
+        bulk = await connector.connect_to('example.com', 80)
+        other = await connector.connect_to('example.com', 80)
+        chunk = bytes(60000)
+        count = MUX_STREAM_BUFFER // len(chunk) + 1
+        peer.conn.reads.put_nowait(b''.join(
+            [mux_frame(1, MUX_STATUS_KEEP, chunk)] * count +
+            [mux_frame(2, MUX_STATUS_KEEPALIVE, b'padding'),
+             mux_frame(2, MUX_STATUS_KEEP, b'hello'),
+             mux_frame(2, MUX_STATUS_END)]))
+        assert await asyncio.wait_for(other.read(), 1.0) == b'hello'
+        assert await other.read() == b''
+        # the full stream holds back the next read until it is read
+        await asyncio.sleep(0.01)
+        assert peer.conn.nreads == 1
+        assert len(await bulk.read()) == count * len(chunk)
+        await asyncio.sleep(0.01)
+        assert peer.conn.nreads == 2
+        connector.sessions[0].close()
+    asyncio.run(run())
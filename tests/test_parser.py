@@ -0,0 +1,167 @@
+import pytest
+
+from proxy.acceptors.parser import (
+    HTTPRequestParser,
+    HTTPResponseParser,
+    Socks5Parser,
+)
+
+CONNECT = (b'CONNECT example.com:443 HTTP/1.1\r\n'
+           b'Host: example.com:443\r\n'
+           b'Proxy-Connection: keep-alive\r\n\r\n')
+GET = (b'GET http://example.com:8080/index.html HTTP/1.1\r\n'
+       b'host:  example.com:8080 \r\n'
+       b'Proxy-Authorization: Basic dXNlcjpwYXNz\r\n'
+       b'Accept: */*\r\n'
+       b'proxy-connection: keep-alive\r\n'
+       b'Content-Length: 5\r\n\r\n')
+GET_STRIPPED = (b'GET http://example.com:8080/index.html HTTP/1.1\r\n'
+                b'host:  example.com:8080 \r\n'
+                b'Accept: */*\r\n'
+                b'Content-Length: 5\r\n\r\n')
+
+
+def feed_split(parser, data, size):
+    """Feed data in reads of size, return the reads left unfed."""
+    chunks = [data[i:i + size] for i in range(0, len(data), size)]
+    while len(chunks) != 0:
+        if parser.feed(chunks.pop(0)):
+            break
+    return chunks
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 4, 7, 1000])
+def test_request_split(size):
+    parser = HTTPRequestParser()
+    left = feed_split(parser, GET + b'hello', size)
+    assert parser.done
+    assert (parser.method, parser.addr, parser.port) == \
+        (b'GET', 'example.com', 8080)
+    assert parser.content_length() == 5
+    assert parser.header() == GET_STRIPPED
+    # a read holding the end of the header may hold the body too
+    assert parser.request() == GET_STRIPPED + parser.rest
+    assert parser.rest + b''.join(left) == b'hello'
+
+
+def test_request_connect():
+    parser = HTTPRequestParser()
+    assert parser.feed(CONNECT + b'\x16\x03\x01')
+    assert (parser.method, parser.addr, parser.port) == \
+        (b'CONNECT', 'example.com', 443)
+    assert parser.rest == b'\x16\x03\x01'
+
+
+@pytest.mark.parametrize('authority,addr,port', [
+    (b'example.com', 'example.com', 80),
+    (b'1.2.3.4:8080', '1.2.3.4', 8080),
+    (b'[::1]', '::1', 80),
+    (b'[2001:db8::1]:443', '2001:db8::1', 443),
+])
+def test_request_host(authority, addr, port):
+    parser = HTTPRequestParser()
+    assert parser.feed(b'GET http://x/ HTTP/1.1\r\nHost: ' + authority +
+                       b'\r\n\r\n')
+    assert (parser.addr, parser.port) == (addr, port)
+
+
+@pytest.mark.parametrize('data', [
+    b'GET / HTTP/1.1\r\nAccept: */*\r\n\r\n',
+    b'GET http://x/ HTTP/1.1\r\nHost: x:0\r\n\r\n',
+    b'GET http://x/ HTTP/1.1\r\nHost: x:65536\r\n\r\n',
+    b'CONNECT [::1 HTTP/1.1\r\n\r\n',
+    b'HELLO\r\n\r\n',
+])
+def test_request_invalid(data):
+    with pytest.raises(RuntimeError):
+        HTTPRequestParser().feed(data)
+
+
+def test_request_too_large():
+    parser = HTTPRequestParser(limit=64)
+    assert not parser.feed(b'GET http://x/ HTTP/1.1\r\n')
+    with pytest.raises(RuntimeError):
+        parser.feed(b'Cookie: ' + b'x' * 64)
+
+
+@pytest.mark.parametrize('data', [
+    CONNECT,
+    CONNECT + b'rest',
+    b'CONNECT [2001:db8::1]:8443 HTTP/1.0\r\n\r\n',
+    b'CONNECT example.com HTTP/1.1\r\n\r\n',
+])
+def test_parse_connect_matches_parser(data):
+    parser = HTTPRequestParser()
+    assert parser.feed(data)
+    assert HTTPRequestParser.parse_connect(data) == \
+        (parser.addr, parser.port, parser.version, parser.rest)
+
+
+@pytest.mark.parametrize('data', [
+    CONNECT[:-2],
+    GET,
+    b'CONNECT example.com:99999 HTTP/1.1\r\n\r\n',
+])
+def test_parse_connect_falls_back(data):
+    assert HTTPRequestParser.parse_connect(data) is None
+
+
+def test_response():
+    parser = HTTPResponseParser()
+    data = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: gzip, chunked\r\n'
+            b'Connection: close\r\n\r\n5\r\nhello')
+    assert feed_split(parser, data, 5) != []
+    assert parser.status == 200
+    assert parser.chunked()
+    assert parser.content_length() is None
+    assert not parser.keep_alive()
+
+
+def test_response_keep_alive():
+    parser = HTTPResponseParser()
+    assert parser.feed(b'HTTP/1.0 200 OK\r\nConnection: Keep-Alive\r\n'
+                       b'Content-Length: 0\r\n\r\n')
+    assert parser.keep_alive()
+    assert parser.content_length() == 0
+    parser = HTTPResponseParser()
+    assert parser.feed(b'HTTP/1.0 204 No Content\r\n\r\n')
+    assert not parser.keep_alive()
+
+
+SOCKS5_DOMAIN = b'\x05\x01\x00\x03\x0bexample.com\x01\xbb'
+SOCKS5_REPLY = b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+
+
+@pytest.mark.parametrize('size', [1, 2, 5, 1000])
+def test_socks5_split(size):
+    data = b'\x05\x02\x02\x00' + SOCKS5_DOMAIN + b'early'
+    parser = Socks5Parser()
+    res = b''
+    for i in range(0, len(data), size):
+        res += parser.feed(data[i:i + size])
+    assert parser.done
+    assert res == b'\x05\x00' + SOCKS5_REPLY
+    assert (parser.addr, parser.port, parser.rest) == \
+        ('example.com', 443, b'early')
+
+
+@pytest.mark.parametrize('request_,addr', [
+    (b'\x05\x01\x00\x01\x7f\x00\x00\x01\x01\xbb', '127.0.0.1'),
+    (b'\x05\x01\x00\x04' + bytes(15) + b'\x01\x01\xbb', '::1'),
+])
+def test_socks5_addresses(request_, addr):
+    parser = Socks5Parser()
+    assert parser.feed(b'\x05\x01\x00') == b'\x05\x00'
+    assert parser.feed(request_) == SOCKS5_REPLY
+    assert (parser.addr, parser.port) == (addr, 443)
+
+
+@pytest.mark.parametrize('data', [
+    b'\x04\x01\x00',
+    b'\x05\x01\x02',
+    b'\x05\x01\x00\x05\x02\x00\x01\x00\x00',
+    b'\x05\x01\x00\x05\x01\x00\x05\x00\x00',
+])
+def test_socks5_invalid(data):
+    with pytest.raises(RuntimeError):
+        Socks5Parser().feed(data)
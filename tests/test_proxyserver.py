@@ -0,0 +1,104 @@
+import asyncio
+
+from proxy import (
+    BaseConnection,
+    BaseConnector,
+    WrappedConnector,
+    HTTPConnector,
+    WSConnector,
+    HTTPAcceptor,
+    ProxyDispatcher,
+    ProxyServer,
+    RuleMatcher,
+)
+
+CONNECT = b'CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n'
+
+
+class PeerConnection(BaseConnection):
+    """Peer end which records writes and never answers, so a connector
+    waiting for a handshake response would hang."""
+    writes: list[bytes]
+
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    async def close(self):
+        pass
+
+    async def read(self) -> bytes:
+        await asyncio.Event().wait()
+        return b''
+
+    async def write(self, buf: bytes):
+        self.writes.append(bytes(buf))
+
+    async def write_eof(self):
+        pass
+
+
+class PeerConnector(BaseConnector):
+    delay: float
+    conns: list[PeerConnection]
+
+    def __init__(self, delay: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.conns = []
+
+    async def connect_to(self, addr: str, port: int,
+                         unwrite: bytes = b'') -> BaseConnection:
+        await asyncio.sleep(self.delay)
+        conn = PeerConnection()
+        self.conns.append(conn)
+        if len(unwrite) != 0:
+            await conn.write(unwrite)
+        return conn
+
+
+def make_server(connectors: list[BaseConnector],
+                hedge_delay: float = 0.0) -> ProxyServer:
+    dispatcher = ProxyDispatcher(RuleMatcher(), connectors,
+                                 hedge_delay=hedge_delay,
+                                 health_interval=0)
+    return ProxyServer(HTTPAcceptor(), dispatcher)
+
+
+def connect(server: ProxyServer, connector: BaseConnector,
+            unwrite: bytes) -> BaseConnector:
+    async def run():
+        connector_, _ = await asyncio.wait_for(
+            server.connect(connector, 'example.com', 443, unwrite), 1.0)
+        return connector_
+    return asyncio.run(run())
+
+
+def test_optimistic_http_sends_first_bytes_with_connect():
+    peer = PeerConnector()
+    http = HTTPConnector(WrappedConnector(peer, 'peer', 8080, pool_size=0),
+                         optimistic=True)
+    assert connect(make_server([http]), http, b'ping') is http
+    assert peer.conns[0].writes == [CONNECT + b'ping']
+
+
+def test_optimistic_ws_sends_frame_behind_upgrade():
+    peer = PeerConnector()
+    ws = WSConnector(peer, optimistic=True)
+    connect(make_server([ws]), ws, b'ping')
+    upgrade, frame = peer.conns[0].writes
+    assert upgrade.startswith(b'GET / HTTP/1.1\r\n')
+    # a masked binary frame of the 4 bytes
+    assert frame[:2] == b'\x82\x84' and len(frame) == 10
+
+
+def test_hedged_race_writes_first_bytes_to_winner_only():
+    slow, fast = PeerConnector(delay=0.5), PeerConnector()
+    first = HTTPConnector(WrappedConnector(slow, 'slow', 8080, pool_size=0),
+                          optimistic=True)
+    second = HTTPConnector(WrappedConnector(fast, 'fast', 8080, pool_size=0),
+                           optimistic=True)
+    server = make_server([first, second], hedge_delay=0.01)
+    assert connect(server, first, b'ping') is second
+    assert slow.conns == []
+    assert fast.conns[0].writes == [CONNECT, b'ping']
@@ -0,0 +1,89 @@
+import re
+import random
+
+import pytest
+
+from proxy.rulematcher import (
+    Rule,
+    RuleIndex,
+    MappedRuleIndex,
+    PatternMatcher,
+)
+
+PATTERNS = [
+    ('regexp', r'^ads\d*\.', Rule.Block),
+    ('keyword', 'google', Rule.Forward),
+    ('regexp', r'tracker', Rule.Block),
+    ('keyword', 'cdn', Rule.Direct),
+    ('regexp', r'(?i)^UPPER', Rule.Direct),
+    ('regexp', r'(a|b)+\.net$', Rule.Forward),
+    ('keyword', 'ad', Rule.Direct),
+]
+
+
+def reference(patterns, domain):
+    """Rule of the first pattern in the rules that matches domain."""
+    for kind, pattern, rule in patterns:
+        if kind == 'keyword' and pattern in domain or \
+           kind == 'regexp' and re.search(pattern, domain) is not None:
+            return rule
+    return None
+
+
+@pytest.mark.parametrize('domain,rule', [
+    # the regexp comes first although the keyword matches further left
+    ('cdn.tracker.com', Rule.Block),
+    ('googletracker.com', Rule.Forward),
+    ('tracker.google.com', Rule.Forward),
+    ('ads1.google.com', Rule.Block),
+    ('my.ads1.com', Rule.Direct),
+    ('upper.example', Rule.Direct),
+    ('abab.net', Rule.Forward),
+    ('bad.net', Rule.Direct),
+    ('example.com', None),
+])
+def test_first_in_rules_wins(domain, rule):
+    matcher = PatternMatcher(PATTERNS)
+    assert matcher.get(domain) is rule
+    assert reference(PATTERNS, domain) is rule
+
+
+def test_invalid_regexp_skipped():
+    matcher = PatternMatcher([('regexp', '(', Rule.Block),
+                              ('keyword', 'x', Rule.Direct)])
+    assert len(matcher) == 1
+    assert matcher.get('x.com') is Rule.Direct
+
+
+def test_random_against_reference():
+    rand = random.Random(5)
+    words = ['ab', 'ba', 'abc', 'cab', 'b', 'ca']
+    patterns = []
+    for _ in range(60):
+        word = rand.choice(words)
+        if rand.random() < 0.5:
+            patterns.append(('keyword', word, rand.choice(list(Rule))))
+        else:
+            pattern = rand.choice([f'{word}$', f'^{word}', f'{word}.c',
+                                   f'({word})+x'])
+            patterns.append(('regexp', pattern, rand.choice(list(Rule))))
+    matcher = PatternMatcher(patterns)
+    for _ in range(2000):
+        domain = ''.join(rand.choice('abcx.')
+                         for _ in range(rand.randint(1, 12)))
+        assert matcher.get(domain) is reference(patterns, domain), domain
+
+
+def test_mapped_index_keeps_order(tmp_path):
+    index = RuleIndex()
+    for kind, pattern, rule in PATTERNS:
+        if kind == 'keyword':
+            index.add_keyword(pattern, rule)
+        else:
+            index.add_regexp(pattern, rule)
+    path = str(tmp_path / 'rules.idx')
+    index.dump(path)
+    mapped = MappedRuleIndex(path)
+    assert list(mapped.patterns.items()) == list(index.patterns.items())
+    for domain in ('cdn.tracker.com', 'tracker.google.com', 'my.ads1.com'):
+        assert mapped.get(domain) is index.get(domain), domain
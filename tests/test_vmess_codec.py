@@ -0,0 +1,120 @@
+import random
+import struct
+from hashlib import md5
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+from vmessc.connector import VmessConnector
+from vmessc.connection import (
+    VMESS_CHUNK_PAYLOAD,
+    VMESS_SECURITIES,
+    VmessCryptor,
+    VmessChunkDecoder,
+)
+
+KEY = bytes(range(16))
+IV = bytes(range(16, 26))
+SIZES = [0, 1, VMESS_CHUNK_PAYLOAD - 1, VMESS_CHUNK_PAYLOAD,
+         VMESS_CHUNK_PAYLOAD + 1, 3 * VMESS_CHUNK_PAYLOAD + 100]
+
+
+def pair(security):
+    return (VmessCryptor(KEY, IV, security),
+            VmessChunkDecoder(VmessCryptor(KEY, IV, security)))
+
+
+@pytest.mark.parametrize('security', VMESS_SECURITIES)
+@pytest.mark.parametrize('size', SIZES)
+def test_round_trip(security, size):
+    sealer, decoder = pair(security)
+    data = random.Random(size).randbytes(size)
+    decoder.feed(sealer.seal(data) + sealer.seal(b'next'))
+    assert decoder.decode() == data + b'next'
+    assert not decoder.eof
+    decoder.feed(sealer.seal_eof())
+    assert decoder.decode() == b''
+    assert decoder.eof
+
+
+@pytest.mark.parametrize('security', VMESS_SECURITIES)
+def test_split_feed(security):
+    sealer, decoder = pair(security)
+    data = random.Random(1).randbytes(2 * VMESS_CHUNK_PAYLOAD + 7)
+    sealed = sealer.seal(data) + sealer.seal_eof()
+    received = b''
+    for pos in range(0, len(sealed), 1000):
+        decoder.feed(sealed[pos:pos + 1000])
+        received += decoder.decode()
+    assert received == data
+    assert decoder.eof
+
+
+@pytest.mark.parametrize('security', VMESS_SECURITIES)
+def test_seal_with_ivs_taken_before(security):
+    sealer, decoder = pair(security)
+    data = bytes(2 * VMESS_CHUNK_PAYLOAD)
+    ivs = sealer.get_ivs(len(data))
+    tail = sealer.seal(b'tail')
+    decoder.feed(sealer.seal_with(data, ivs) + tail)
+    assert decoder.decode() == data + b'tail'
+
+
+def test_chacha20_key_and_nonce():
+    """Chunks open with the 32-byte key md5(key) + md5(md5(key)) and the
+    nonce of a 2-byte count followed by the iv, as vmess peers expect."""
+    sealer = VmessCryptor(KEY, IV, 'chacha20-poly1305')
+    sealed = sealer.seal(b'a') + sealer.seal(b'b')
+    key = md5(KEY).digest()
+    aead = ChaCha20Poly1305(key + md5(key).digest())
+    pos = 0
+    for count, expect in enumerate((b'a', b'b')):
+        size, = struct.unpack_from('!H', sealed, pos)
+        chunk = sealed[pos + 2:pos + 2 + size]
+        nonce = struct.pack('!H', count) + IV
+        assert aead.decrypt(nonce, chunk, b'') == expect
+        pos += 2 + size
+    assert pos == len(sealed)
+
+
+def test_nonce_count_wraps():
+    cryptor = VmessCryptor(KEY, IV, 'chacha20-poly1305')
+    cryptor.count = 0xffff
+    assert cryptor.get_iv() == b'\xff\xff' + IV
+    assert cryptor.get_iv() == b'\x00\x00' + IV
+
+
+@pytest.mark.parametrize('security', VMESS_SECURITIES)
+def test_tampered_chunk(security):
+    sealer, decoder = pair(security)
+    sealed = bytearray(sealer.seal(b'payload'))
+    sealed[-1] ^= 1
+    decoder.feed(bytes(sealed))
+    with pytest.raises(InvalidTag):
+        decoder.decode()
+
+
+def test_securities_do_not_mix():
+    sealer = VmessCryptor(KEY, IV, 'chacha20-poly1305')
+    decoder = VmessChunkDecoder(VmessCryptor(KEY, IV, 'aes-128-gcm'))
+    decoder.feed(sealer.seal(b'payload'))
+    with pytest.raises(InvalidTag):
+        decoder.decode()
+
+
+def test_invalid_chunk_size():
+    _, decoder = pair('chacha20-poly1305')
+    decoder.feed(b'\x00\x0f' + bytes(15))
+    with pytest.raises(RuntimeError):
+        decoder.decode()
+
+
+@pytest.mark.parametrize('buf,digest', [
+    (b'', 0x811c9dc5),
+    (b'a', 0xe40c292c),
+    (b'foobar', 0xbf9cf968),
+    (b'chongo was here!\n', 0xd49930d5),
+])
+def test_fnv32a(buf, digest):
+    assert VmessConnector.fnv32a(buf) == digest.to_bytes(4, 'big')
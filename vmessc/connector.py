@@ -3,14 +3,17 @@ import random
 import struct
 import functools
 import ssl
+import logging
 from hashlib import md5
 from hmac import HMAC
 from uuid import UUID
+from typing import Optional
 
 from cryptography.hazmat.primitives.ciphers import Cipher
 from cryptography.hazmat.primitives.ciphers.algorithms import AES
 from cryptography.hazmat.primitives.ciphers.modes import CFB
 
+from proxy.defaults import POOL_SIZE, OPTIMISTIC
 from proxy import (
     override,
     BaseConnector,
@@ -20,17 +23,61 @@ from proxy import (
     WSConnector,
 )
 
-from .connection import VmessConnection, VmessCryptor, VmessResponseValidator
+from .connection import (
+    VMESS_SECURITIES,
+    VMESS_SECURITY,
+    VmessConnection,
+    VmessCryptor,
+    VmessResponseValidator,
+)
+
+# command of the request header, mux requests carry no address
+VMESS_CMD_TCP = 1
+VMESS_CMD_MUX = 3
 
 
 class VmessConnector(BaseConnector):
     uuid: UUID
     base_connector: WrappedConnector
-
-    def __init__(self, base_connector: WrappedConnector, uuid: UUID, **kwargs):
+    security: str
+    ts_cache: Optional[tuple[int, bytes, Cipher]]
+
+    REQ_KEY_SUFFIX = b'c48619fe-8f02-49e0-b9e9-edf763e17e21'
+
+    # ver(B)          : 1
+    # iv(16s)         : iv
+    # key(16s)        : key
+    # rv(B)           : rv
+    # opts(B)         : 1
+    # plen|secmeth(B) : plen|security
+    # res(B)          : 0
+    # cmd(B)          : cmd
+    # followed by the address unless cmd is mux, plen random bytes and
+    # fnv1a of all of them
+    REQ_STRUCT = struct.Struct('!B16s16sBBBBB')
+    # port(H)         : port
+    # atype(B)        : 2
+    # alen(B)         : alen
+    # followed by addr
+    REQ_ADDR_STRUCT = struct.Struct('!HBB')
+
+    logger = logging.getLogger('vmess_connector')
+
+    def __init__(self,
+                 base_connector: WrappedConnector,
+                 uuid: UUID,
+                 security: str = VMESS_SECURITY,
+                 **kwargs):
         super().__init__(**kwargs)
         self.base_connector = base_connector
         self.uuid = uuid
+        if security == 'auto':
+            security = VmessCryptor.fastest_security()
+            self.logger.info('auto security %s', security)
+        if security not in VMESS_SECURITIES:
+            raise ValueError('invalid security')
+        self.security = security
+        self.ts_cache = None
 
     @functools.cached_property
     def req_key(self) -> bytes:
@@ -46,17 +93,25 @@ class VmessConnector(BaseConnector):
         port: int,
         unwrite: bytes = b'',
     ) -> BaseConnection:
+        return await self.open(VMESS_CMD_TCP, addr, port, unwrite)
+
+    async def connect_mux(self, unwrite: bytes = b'') -> VmessConnection:
+        """Open a connection carrying Mux.Cool frames."""
+        return await self.open(VMESS_CMD_MUX, '', 0, unwrite)
+
+    async def open(self, cmd: int, addr: str, port: int,
+                   unwrite: bytes) -> VmessConnection:
         key = random.randbytes(16)
         iv = random.randbytes(16)
         rv = random.getrandbits(8)
         rkey = md5(key).digest()
         riv = md5(iv).digest()
-        read_cryptor = VmessCryptor(rkey, riv[2:12])
-        write_cryptor = VmessCryptor(key, iv[2:12])
+        read_cryptor = VmessCryptor(rkey, riv[2:12], self.security)
+        write_cryptor = VmessCryptor(key, iv[2:12], self.security)
         response_validator = VmessResponseValidator(rkey, riv, rv)
-        buf = self.get_req(addr, port, key, iv, rv)
+        buf = self.get_req(addr, port, key, iv, rv, cmd)
         if len(unwrite) != 0:
-            buf += write_cryptor.encrypt(unwrite)
+            buf += write_cryptor.seal(unwrite)
         base_conn = await self.base_connector.connect(buf)
         conn = VmessConnection(base_connection=base_conn,
                                read_cryptor=read_cryptor,
@@ -64,57 +119,58 @@ class VmessConnector(BaseConnector):
                                response_validator=response_validator)
         return conn
 
+    def get_ts_material(self) -> tuple[bytes, Cipher]:
+        """Return the auth and the header cipher of the current second,
+        they depend on the timestamp only and are shared by its requests."""
+        now = int(time.time())
+        if self.ts_cache is None or self.ts_cache[0] != now:
+            ts = now.to_bytes(8, 'big')
+            auth = HMAC(key=self.uuid.bytes, msg=ts, digestmod='md5').digest()
+            cipher = Cipher(AES(self.req_key), CFB(md5(4 * ts).digest()))
+            self.ts_cache = (now, auth, cipher)
+        return self.ts_cache[1], self.ts_cache[2]
+
     def get_req(self, addr_str: str, port: int, key: bytes, iv: bytes,
-                rv: int) -> bytes:
-        ts = int(time.time()).to_bytes(8, 'big')
-        addr = addr_str.encode()
-        alen = len(addr)
+                rv: int, cmd: int = VMESS_CMD_TCP) -> bytes:
+        auth, cipher = self.get_ts_material()
         plen = random.getrandbits(4)
-
-        # ver(B)          : 1
-        # iv(16s)         : iv
-        # key(16s)        : key
-        # rv(B)           : rv
-        # opts(B)         : 1
-        # plen|secmeth(B) : plen|3
-        # res(B)          : 0
-        # cmd(B)          : 1
-        # port(H)         : port
-        # atype(B)        : 2
-        # alen(B)         : alen
-        # addr({alen}s)   : addr
-        # random({plen}s) : randbytes
-        req = struct.pack(
-            f'!B16s16sBBBBBHBB{alen}s{plen}s',
+        req = self.REQ_STRUCT.pack(
             1,
             iv,
             key,
             rv,
             1,
-            (plen << 4) + 3,
+            (plen << 4) + VMESS_SECURITIES[self.security],
             0,
-            1,
-            port,
-            2,
-            alen,
-            addr,
-            random.randbytes(plen),
+            cmd,
         )
+        if cmd != VMESS_CMD_MUX:
+            addr = addr_str.encode()
+            req += self.REQ_ADDR_STRUCT.pack(port, 2, len(addr)) + addr
+        req += random.randbytes(plen)
         req += self.fnv32a(req)
-        cipher = Cipher(AES(self.req_key), CFB(md5(4 * ts).digest()))
         encryptor = cipher.encryptor()
-        req = encryptor.update(req) + encryptor.finalize()
-        auth = HMAC(key=self.uuid.bytes, msg=ts, digestmod='md5').digest()
-        return auth + req
+        return auth + encryptor.update(req) + encryptor.finalize()
 
     @staticmethod
     def fnv32a(buf: bytes) -> bytes:
+        """FNV-1a, 4 bytes per step. The xor only touches the low byte, so
+        masking once per step gives the same low 32 bits."""
         r, p, m = 0x811c9dc5, 0x01000193, 0xffffffff
-        for c in buf:
+        n = len(buf) & ~3
+        it = iter(buf[:n])
+        for c0, c1, c2, c3 in zip(it, it, it, it):
+            r = (((((r ^ c0) * p ^ c1) * p ^ c2) * p ^ c3) * p) & m
+        for c in buf[n:]:
             r = ((r ^ c) * p) & m
         return r.to_bytes(4, 'big')
 
 
+# servers drop connections without a request header after a few seconds,
+# the default handshake policy of v2ray is 4s
+VMESS_POOL_TTL = 3.0
+
+
 class VmessSerConnector(VmessConnector):
     net: str
     addr: str
@@ -123,8 +179,17 @@ class VmessSerConnector(VmessConnector):
     ws_path: str
     ws_host: str
 
-    def __init__(self, net: str, addr: str, port: str, tls_host: str,
-                 ws_path: str, ws_host: str, **kwargs):
+    def __init__(self,
+                 net: str,
+                 addr: str,
+                 port: str,
+                 tls_host: str,
+                 ws_path: str,
+                 ws_host: str,
+                 pool_size: int = POOL_SIZE,
+                 pool_ttl: float = VMESS_POOL_TTL,
+                 optimistic: bool = OPTIMISTIC,
+                 **kwargs):
         self.net = net
         self.addr = addr
         self.port = port
@@ -147,6 +212,7 @@ class VmessSerConnector(VmessConnector):
                 base_connector=tcp_connector,
                 path=ws_path,
                 host=ws_host,
+                optimistic=optimistic,
             )
         else:
             base_connector = tcp_connector
@@ -154,5 +220,7 @@ class VmessSerConnector(VmessConnector):
             base_connector=base_connector,
             addr=addr,
             port=port,
+            pool_size=pool_size,
+            pool_ttl=pool_ttl,
         )
         super().__init__(base_connector=wrapped_connector, **kwargs)
@@ -0,0 +1,497 @@
+import time
+import struct
+import asyncio
+import logging
+import ipaddress
+
+from collections import deque
+from typing import Optional
+
+from proxy import override, BaseConnector, BaseConnection
+
+from .connection import VmessConnection
+from .connector import VmessConnector
+
+# limits of a session, the concurrency and lifetime streams are those of
+# v2ray clients, new streams go to another session above the rate
+MUX_STREAMS = 8
+MUX_STREAMS_TOTAL = 128
+MUX_SESSION_RATE = 16 * 1048576
+# seconds of per second byte counts the rate is averaged over
+MUX_RATE_WINDOW = 4
+# sessions without streams are closed after this, as v2ray clients do
+MUX_IDLE_TIMEOUT = 16.0
+
+# data per frame, v2ray splits at 8KB as well, streams take turns by frame
+MUX_FRAME_SIZE = 8192
+# bytes of a stream queued to send or left unread before it blocks
+MUX_STREAM_BUFFER = 262144
+# frames coalesced into one write of the session
+MUX_WRITE_SIZE = 65536
+
+MUX_STATUS_NEW = 1
+MUX_STATUS_KEEP = 2
+MUX_STATUS_END = 3
+MUX_STATUS_KEEPALIVE = 4
+MUX_OPTION_DATA = 1
+MUX_OPTION_ERROR = 2
+MUX_NETWORK_TCP = 1
+
+MUX_SIZE_STRUCT = struct.Struct('!H')
+MUX_META_STRUCT = struct.Struct('!HBB')
+
+
+def mux_frame(sid: int,
+              status: int,
+              data: bytes = b'',
+              option: int = 0,
+              target: bytes = b'') -> bytes:
+    if len(data) != 0:
+        option |= MUX_OPTION_DATA
+    meta = MUX_META_STRUCT.pack(sid, status, option) + target
+    frame = len(meta).to_bytes(2, 'big') + meta
+    if len(data) != 0:
+        frame += len(data).to_bytes(2, 'big') + data
+    return frame
+
+
+def mux_target(addr: str, port: int) -> bytes:
+    """Target of a new stream: network, port and address."""
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        host = addr.encode()
+        return struct.pack('!BHBB', MUX_NETWORK_TCP, port, 2,
+                           len(host)) + host
+    atype = 1 if ip.version == 4 else 3
+    return struct.pack('!BHB', MUX_NETWORK_TCP, port, atype) + ip.packed
+
+
+class MuxFrameDecoder:
+    """Incremental decoder of Mux.Cool frames: a 2-byte length, metadata of
+    session id, status and option, then 2-byte length prefixed data if the
+    option has it."""
+    buf: bytearray
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data: bytes):
+        self.buf += data
+
+    def take(self) -> list[tuple[int, int, int, bytes]]:
+        """Return the complete frames, (sid, status, option, data)."""
+        buf = self.buf
+        frames = []
+        pos = 0
+        # payloads are copied once out of the view, released before the
+        # buffer is resized
+        with memoryview(buf) as view:
+            while len(buf) - pos >= 2:
+                size, = MUX_SIZE_STRUCT.unpack_from(buf, pos)
+                if size < MUX_META_STRUCT.size:
+                    raise RuntimeError('invalid mux frame')
+                end = pos + 2 + size
+                if len(buf) < end:
+                    break
+                sid, status, option = MUX_META_STRUCT.unpack_from(buf,
+                                                                  pos + 2)
+                data = b''
+                if option & MUX_OPTION_DATA:
+                    if len(buf) < end + 2:
+                        break
+                    size, = MUX_SIZE_STRUCT.unpack_from(buf, end)
+                    if len(buf) < end + 2 + size:
+                        break
+                    data = bytes(view[end + 2:end + 2 + size])
+                    end += 2 + size
+                frames.append((sid, status, option, data))
+                pos = end
+        del buf[:pos]
+        return frames
+
+
+class MuxStream(BaseConnection):
+    """Sub-stream of a mux session.
+
+    Writes are queued as frames, which the session sends in turns with
+    other streams, and wait while more than MUX_STREAM_BUFFER bytes are
+    queued. Data received is buffered until read, the session stops
+    reading while the buffer is over MUX_STREAM_BUFFER, as v2ray does.
+    """
+    session: 'MuxSession'
+    sid: int
+    frames: deque[bytes]
+    pending: int
+    received: deque[bytes]
+    buffered: int
+    readable: asyncio.Event
+    writable: asyncio.Event
+    drained: asyncio.Event
+    eof: bool
+    ended: bool
+    error: Optional[Exception]
+
+    def __init__(self, session: 'MuxSession', sid: int, **kwargs):
+        super().__init__(**kwargs)
+        self.session = session
+        self.sid = sid
+        self.frames = deque()
+        self.pending = 0
+        self.received = deque()
+        self.buffered = 0
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.eof = False
+        self.ended = False
+        self.error = None
+
+    @override(BaseConnection)
+    async def close(self):
+        if not self.ended:
+            self.ended = True
+            self.session.send(self, mux_frame(self.sid, MUX_STATUS_END))
+        self.session.remove(self)
+
+    @override(BaseConnection)
+    async def read(self) -> bytes:
+        if len(self.unread) != 0:
+            return self.read_nonblock()
+        while len(self.received) == 0 and not self.eof:
+            self.readable.clear()
+            await self.readable.wait()
+        buf = self.read_nonblock()
+        if len(buf) == 0 and self.error is not None:
+            # a fresh copy, raising the shared one would grow its traceback
+            raise type(self.error)(*self.error.args)
+        return buf
+
+    @override(BaseConnection)
+    def read_nonblock(self) -> bytes:
+        buf, self.unread = self.unread, b''
+        if len(self.received) != 0:
+            buf += b''.join(self.received)
+            self.received.clear()
+            self.buffered = 0
+            self.drained.set()
+        return buf
+
+    @override(BaseConnection)
+    async def write(self, buf: bytes):
+        if self.error is not None:
+            raise type(self.error)(*self.error.args)
+        if self.ended:
+            raise RuntimeError('write after mux stream end')
+        for pos in range(0, len(buf), MUX_FRAME_SIZE):
+            self.session.send(self, mux_frame(
+                self.sid, MUX_STATUS_KEEP, buf[pos:pos + MUX_FRAME_SIZE]))
+        while self.pending > MUX_STREAM_BUFFER and self.error is None:
+            self.writable.clear()
+            await self.writable.wait()
+
+    @override(BaseConnection)
+    async def write_eof(self):
+        if not self.ended:
+            self.ended = True
+            self.session.send(self, mux_frame(self.sid, MUX_STATUS_END))
+
+    @override(BaseConnection)
+    def at_eof(self) -> bool:
+        return self.eof
+
+    def feed(self, data: bytes):
+        """Buffer data received."""
+        self.received.append(data)
+        self.buffered += len(data)
+        self.readable.set()
+
+    async def drain(self):
+        """Wait while the buffer is full."""
+        while self.buffered > MUX_STREAM_BUFFER and self.error is None and \
+                self.sid in self.session.streams:
+            self.drained.clear()
+            await self.drained.wait()
+
+    def finish(self, error: Optional[Exception] = None):
+        """Mark the stream ended by the peer."""
+        self.eof = True
+        if error is not None and self.error is None:
+            self.error = error
+        self.readable.set()
+        self.writable.set()
+        self.drained.set()
+
+
+class MuxSession:
+    """Vmess connection carrying the frames of streams.
+
+    The frames queued before the connection opens go out with its request.
+    Streams with queued frames send one at a time in turns, so a bulk
+    stream does not hold back the others for more than a frame each. A
+    session out of stream ids retires: it sends what is queued, then ends
+    its side and reads until the peer ends the connection.
+    """
+    connector: 'MuxConnector'
+    conn: Optional[VmessConnection]
+    streams: dict[int, MuxStream]
+    ready: deque[MuxStream]
+    wake: asyncio.Event
+    connected: asyncio.Future
+    task: asyncio.Task
+    idle_handle: Optional[asyncio.TimerHandle]
+    next_sid: int
+    retiring: bool
+    closed: bool
+    rate_counts: list[int]
+    rate_second: int
+
+    logger = logging.getLogger('mux_session')
+
+    def __init__(self, connector: 'MuxConnector'):
+        self.connector = connector
+        self.conn = None
+        self.streams = dict()
+        self.ready = deque()
+        self.wake = asyncio.Event()
+        self.connected = asyncio.get_running_loop().create_future()
+        self.idle_handle = None
+        self.next_sid = 1
+        self.retiring = False
+        self.closed = False
+        self.rate_counts = [0] * MUX_RATE_WINDOW
+        self.rate_second = int(time.monotonic())
+        self.task = asyncio.create_task(self.run())
+
+    def __str__(self) -> str:
+        return 'mux session streams {} total {} rate {:.1f}MB/s'.format(
+            len(self.streams), self.next_sid - 1, self.rate() / 1048576)
+
+    def available(self) -> bool:
+        """Whether a new stream may join."""
+        return not self.closed and \
+            len(self.streams) < self.connector.max_streams and \
+            self.next_sid <= self.connector.max_total and \
+            self.rate() < self.connector.max_rate
+
+    def rate(self) -> float:
+        """Bytes/s sent and received over the last MUX_RATE_WINDOW
+        seconds."""
+        self.advance_rate()
+        return sum(self.rate_counts) / MUX_RATE_WINDOW
+
+    def count_rate(self, size: int):
+        self.advance_rate()
+        self.rate_counts[self.rate_second % MUX_RATE_WINDOW] += size
+
+    def advance_rate(self):
+        """Clear the counts of the seconds passed since the last call."""
+        second = int(time.monotonic())
+        for passed in range(max(self.rate_second + 1,
+                                second - MUX_RATE_WINDOW + 1), second + 1):
+            self.rate_counts[passed % MUX_RATE_WINDOW] = 0
+        self.rate_second = second
+
+    def open_stream(self, addr: str, port: int, unwrite: bytes) -> MuxStream:
+        stream = MuxStream(self, self.next_sid)
+        self.next_sid += 1
+        self.streams[stream.sid] = stream
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        data, unwrite = unwrite[:MUX_FRAME_SIZE], unwrite[MUX_FRAME_SIZE:]
+        self.send(stream, mux_frame(stream.sid, MUX_STATUS_NEW, data,
+                                    target=mux_target(addr, port)))
+        for pos in range(0, len(unwrite), MUX_FRAME_SIZE):
+            self.send(stream, mux_frame(
+                stream.sid, MUX_STATUS_KEEP,
+                unwrite[pos:pos + MUX_FRAME_SIZE]))
+        return stream
+
+    def remove(self, stream: MuxStream):
+        if self.streams.pop(stream.sid, None) is None:
+            return
+        stream.finish()
+        if len(self.streams) != 0 or self.closed:
+            return
+        if self.next_sid > self.connector.max_total:
+            # out of stream ids, ends once the frames queued are sent
+            self.retiring = True
+            self.wake.set()
+        elif self.idle_handle is None:
+            self.idle_handle = asyncio.get_running_loop().call_later(
+                self.connector.idle_timeout, self.close)
+
+    def send(self, stream: MuxStream, frame: bytes):
+        if self.closed:
+            return
+        if len(stream.frames) == 0:
+            self.ready.append(stream)
+        stream.frames.append(frame)
+        stream.pending += len(frame)
+        self.wake.set()
+
+    def take_frames(self) -> bytes:
+        """Take up to MUX_WRITE_SIZE bytes of frames, a frame per stream
+        in turn."""
+        frames = []
+        size = 0
+        while len(self.ready) != 0 and size < MUX_WRITE_SIZE:
+            stream = self.ready.popleft()
+            frame = stream.frames.popleft()
+            stream.pending -= len(frame)
+            if stream.pending <= MUX_STREAM_BUFFER:
+                stream.writable.set()
+            if len(stream.frames) != 0:
+                self.ready.append(stream)
+            frames.append(frame)
+            size += len(frame)
+        self.count_rate(size)
+        return b''.join(frames)
+
+    async def run(self):
+        try:
+            self.conn = await self.connector.base_connector.connect_mux(
+                self.take_frames())
+        except Exception as e:
+            self.connected.set_exception(e)
+            self.shutdown()
+            return
+        self.connected.set_result(None)
+        send_task = asyncio.create_task(self.send_frames())
+        receive_task = asyncio.create_task(self.receive_frames())
+        tasks = [send_task, receive_task]
+        try:
+            done, _ = await asyncio.wait(tasks,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if done == {send_task} and send_task.exception() is None:
+                # retired, what the peer still sends is read until it
+                # ends the connection, closing first would reset it
+                timeout = self.connector.idle_timeout
+                done, _ = await asyncio.wait([receive_task], timeout=timeout)
+            for task in done:
+                if (exc := task.exception()) is not None:
+                    self.logger.debug('except in %s: %.40s', self, exc)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.shutdown()
+            try:
+                await self.conn.close()
+            except Exception:
+                pass
+
+    async def send_frames(self):
+        assert self.conn is not None
+        while True:
+            while len(self.ready) == 0:
+                # retired and drained, the peer ends the connection
+                if self.retiring:
+                    await self.conn.write_eof()
+                    return
+                self.wake.clear()
+                await self.wake.wait()
+            await self.conn.write(self.take_frames())
+
+    async def receive_frames(self):
+        assert self.conn is not None
+        decoder = MuxFrameDecoder()
+        while len(buf := await self.conn.read()) != 0:
+            self.count_rate(len(buf))
+            decoder.feed(buf)
+            fed = dict()
+            for sid, status, option, data in decoder.take():
+                stream = self.streams.get(sid)
+                # closed here already, or keepalive of the session
+                if stream is None:
+                    continue
+                # keepalive data is padding, not stream data
+                if len(data) != 0 and not stream.eof and status in (
+                        MUX_STATUS_NEW, MUX_STATUS_KEEP, MUX_STATUS_END):
+                    stream.feed(data)
+                    fed[sid] = stream
+                if status == MUX_STATUS_END:
+                    stream.finish(RuntimeError('mux stream closed with error')
+                                  if option & MUX_OPTION_ERROR else None)
+                    if stream.ended:
+                        self.remove(stream)
+            # the frames of a read all reach their streams, then a full
+            # stream holds back the next read
+            for stream in fed.values():
+                await stream.drain()
+
+    def close(self):
+        """Close the session, its streams are reset."""
+        self.task.cancel()
+        self.shutdown()
+
+    def shutdown(self):
+        if self.closed:
+            return
+        self.closed = True
+        error = ConnectionResetError('mux session closed')
+        if not self.connected.done():
+            self.connected.set_exception(error)
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        for stream in self.streams.values():
+            stream.finish(error)
+        self.streams.clear()
+        self.ready.clear()
+        self.connector.sessions.remove(self)
+
+
+class MuxConnector(BaseConnector):
+    """Connector carrying streams as Mux.Cool sub-streams of a few
+    long-lived vmess connections.
+
+    A stream joins the session with the fewest streams among those below
+    max_streams streams, max_total streams over their lifetime and
+    max_rate bytes/s, otherwise it opens a new session. Sessions without
+    streams are closed after idle_timeout.
+    """
+    base_connector: VmessConnector
+    max_streams: int
+    max_total: int
+    max_rate: float
+    idle_timeout: float
+    sessions: list[MuxSession]
+
+    def __init__(self,
+                 base_connector: VmessConnector,
+                 max_streams: int = MUX_STREAMS,
+                 max_total: int = MUX_STREAMS_TOTAL,
+                 max_rate: float = MUX_SESSION_RATE,
+                 idle_timeout: float = MUX_IDLE_TIMEOUT,
+                 **kwargs):
+        super().__init__(**kwargs)
+        if not 0 < max_total < 65536:
+            raise ValueError('invalid mux streams total')
+        self.base_connector = base_connector
+        self.max_streams = max_streams
+        self.max_total = max_total
+        self.max_rate = max_rate
+        self.idle_timeout = idle_timeout
+        self.sessions = list()
+
+    @override(BaseConnector)
+    async def connect_to(
+        self,
+        addr: str,
+        port: int,
+        unwrite: bytes = b'',
+    ) -> BaseConnection:
+        session = min(filter(MuxSession.available, self.sessions),
+                      key=lambda session: len(session.streams),
+                      default=None)
+        if session is None:
+            session = MuxSession(self)
+            self.sessions.append(session)
+        stream = session.open_stream(addr, port, unwrite)
+        try:
+            await asyncio.shield(session.connected)
+        except BaseException:
+            # cancelled or failed, the session carries on for the others
+            await stream.close()
+            raise
+        return stream